@@ -20,6 +20,7 @@ from subprocess import (
     CalledProcessError,
 )
 import sys
+import time
 import yaml
 
 
@@ -43,6 +44,7 @@ from charmhelpers.core.hookenv import (
     action_fail,
     action_get,
     action_set,
+    config,
 )
 from charmhelpers.contrib.hahelpers.cluster import (
     is_elected_leader,
@@ -51,12 +53,21 @@ from charmhelpers.contrib.openstack.utils import (
     set_unit_paused,
     clear_unit_paused,
 )
-from hooks.swift_hooks import CONFIGS
+from hooks.swift_hooks import CONFIGS, storage_nodes
 from lib.swift_utils import (
     assess_status,
     balance_rings,
+    flush_ring_changes,
+    get_ring_convergence_history,
+    get_ring_convergence_status,
+    get_weight_ramp_status,
+    preview_rebalance,
+    queue_ring_change,
+    ramp_weight_in_ring,
     remove_from_ring,
+    ring_changes_deferred,
     services,
+    update_ring_convergence,
     set_weight_in_ring,
     SWIFT_CONF_DIR,
     SWIFT_HA_RES,
@@ -129,6 +140,18 @@ def diskusage(args):
         raise
 
 
+def _flush_queued_ring_changes():
+    """Apply the queued ring changes if they are due and report the outcome.
+
+    See the ring-change-interval config option.
+    """
+    if flush_ring_changes(storage_nodes):
+        action_set({'output': 'Ring changes applied'})
+    else:
+        action_set({'output': 'Ring change queued, it will be applied by '
+                              'the update-status hook'})
+
+
 def remove_devices(args):
     """ Removes the device(s) from the ring(s).
 
@@ -152,11 +175,23 @@ def remove_devices(args):
         rings_to_update.extend(['account', 'container', 'object'])
     else:
         rings_to_update.append(ring)
+    ramp = bool(config('weight-ramp-step') and not action_get('immediate'))
+    if ring_changes_deferred():
+        for ring_to_update in rings_to_update:
+            queue_ring_change({'type': 'remove', 'ring': ring_to_update,
+                               'search_value': action_get('search-value'),
+                               'ramp': ramp})
+        _flush_queued_ring_changes()
+        return
     for ring_to_update in rings_to_update:
         ring_to_update_builder = ring_to_update + '.builder'
         ring_to_update_path = os.path.join(SWIFT_CONF_DIR,
                                            ring_to_update_builder)
-        remove_from_ring(ring_to_update_path, action_get('search-value'))
+        if ramp:
+            ramp_weight_in_ring(ring_to_update_path,
+                                action_get('search-value'), 0, remove=True)
+        else:
+            remove_from_ring(ring_to_update_path, action_get('search-value'))
     balance_rings()
 
 
@@ -181,15 +216,149 @@ def set_weight(args):
         rings_to_update = ['account', 'container', 'object']
     else:
         rings_to_update = [ring]
+    ramp = bool(config('weight-ramp-step') and not action_get('immediate'))
+    if ring_changes_deferred():
+        for ring_to_update in rings_to_update:
+            queue_ring_change({'type': 'set-weight', 'ring': ring_to_update,
+                               'search_value': action_get('search-value'),
+                               'weight': float(action_get('weight')),
+                               'ramp': ramp})
+        _flush_queued_ring_changes()
+        return
     for ring_to_update in rings_to_update:
         ring_to_update_builder = ring_to_update + '.builder'
         ring_to_update_path = os.path.join(SWIFT_CONF_DIR,
                                            ring_to_update_builder)
-        set_weight_in_ring(ring_to_update_path, action_get('search-value'),
-                           str(action_get('weight')))
+        if ramp:
+            ramp_weight_in_ring(ring_to_update_path,
+                                action_get('search-value'),
+                                float(action_get('weight')))
+        else:
+            set_weight_in_ring(ring_to_update_path,
+                               action_get('search-value'),
+                               str(action_get('weight')))
     balance_rings()
 
 
+def weight_ramp_status(args):
+    """Reports the progress of the device weight ramps.
+
+    See the weight-ramp-step config option.
+    """
+    if not is_elected_leader(SWIFT_HA_RES):
+        action_fail('Must run action on leader unit')
+        return
+
+    results = {'step': config('weight-ramp-step')}
+    status = get_weight_ramp_status()
+    for ring, ring_status in status.items():
+        results['{}.next-step'.format(ring)] = time.strftime(
+            '%Y-%m-%d %H:%M:%S', time.localtime(ring_status['next-step']))
+        results['{}.devices'.format(ring)] = '\n'.join(
+            'd{} {}/{} weight={} target={}{}'.format(
+                dev['id'], dev['ip'], dev['device'], dev['weight'],
+                dev['target'], ' (then remove)' if dev['remove'] else '')
+            for dev in ring_status['devices'])
+    if not status:
+        results['ramps'] = 'none'
+    action_set(results)
+
+
+def _format_seconds(seconds):
+    return 'pending' if seconds is None else '{:.1f}s'.format(seconds)
+
+
+def ring_sync_status(args):
+    """Reports how far the last ring change has got to the units.
+
+    See start_ring_convergence() in lib/swift_utils.py.
+    """
+    if not is_elected_leader(SWIFT_HA_RES):
+        action_fail('Must run action on leader unit')
+        return
+
+    update_ring_convergence()
+    status = get_ring_convergence_status()
+    if not status:
+        action_set({'generation': 'none'})
+        return
+
+    results = {
+        'generation': status['generation'],
+        'started': time.strftime('%Y-%m-%d %H:%M:%S',
+                                 time.localtime(status['started'])),
+        'synced': '{}/{}'.format(status['synced'], status['units']),
+        'untracked': status['untracked'],
+        'lag': '\n'.join(
+            '{} {}'.format(unit, _format_seconds(lag))
+            for unit, lag in sorted(status['lag'].items(),
+                                    key=lambda item: -item[1])),
+        'stragglers': '\n'.join(
+            '{} waiting {}'.format(unit, _format_seconds(waited))
+            for unit, waited in sorted(status['stragglers'].items())),
+        'history': '\n'.join(
+            'generation {}: {}'.format(
+                old['generation'], ', '.join(
+                    '{}% {}'.format(percent, _format_seconds(
+                        old['converged-{}'.format(percent)]))
+                    for percent in (50, 90, 100)))
+            for old in reversed(get_ring_convergence_history())),
+    }
+    for percent in (50, 90, 100):
+        key = 'converged-{}'.format(percent)
+        results[key] = _format_seconds(status[key])
+    action_set(results)
+
+
+def rebalance_preview(args):
+    """Estimates what rebalancing the ring(s) would move.
+
+    The rings are rebalanced in memory only; nothing is saved.
+
+    :raises SwiftProxyCharmException: if a ring can't be rebalanced.
+    """
+    if not is_elected_leader(SWIFT_HA_RES):
+        action_fail('Must run action on leader unit')
+        return
+
+    rings_valid = ['account', 'container', 'object', 'all']
+    ring = action_get('ring') or 'all'
+    if ring not in rings_valid:
+        action_fail("Invalid ring name '{}'. Should be one of: {}".format(
+            ring, ', '.join(rings_valid)))
+        return
+    if ring == 'all':
+        rings_to_preview = ['account', 'container', 'object']
+    else:
+        rings_to_preview = [ring]
+    partition_size = (action_get('partition-size') or
+                      config('rebalance-partition-size') or None)
+    results = {}
+    for ring_to_preview in rings_to_preview:
+        preview = preview_rebalance(
+            os.path.join(SWIFT_CONF_DIR, ring_to_preview + '.builder'),
+            partition_size)
+        results.update({
+            '{}.parts-moved'.format(ring_to_preview): preview['parts'],
+            '{}.replicas-moved'.format(ring_to_preview):
+                preview['replicas_moved'],
+            '{}.bytes-moved'.format(ring_to_preview):
+                preview['bytes'] if preview['bytes'] is not None
+                else 'unknown',
+            '{}.balance'.format(ring_to_preview):
+                '{:.2f}'.format(preview['balance']),
+            '{}.dispersion'.format(ring_to_preview):
+                '{:.2f}'.format(preview['dispersion']),
+            '{}.devices'.format(ring_to_preview): '\n'.join(
+                'd{id} r{region}z{zone}-{ip}/{device} in={parts_in} '
+                'out={parts_out}'.format(**dev) for dev in preview['devices']),
+            '{}.zones'.format(ring_to_preview): '\n'.join(
+                'r{region}z{zone} in={parts_in} out={parts_out}'.format(**zone)
+                for zone in preview['zones']),
+        })
+    action_set(results)
+
+
 def dispersion_populate(args):
     """Runs swift-dispersion-populate command and returns the output
     @raises CalledProcessError
@@ -224,6 +393,9 @@ ACTIONS = {
     'diskusage': diskusage,
     'remove-devices': remove_devices,
     'set-weight': set_weight,
+    'weight-ramp-status': weight_ramp_status,
+    'ring-sync-status': ring_sync_status,
+    'rebalance-preview': rebalance_preview,
     "dispersion-populate": dispersion_populate,
     "dispersion-report": dispersion_report}
 
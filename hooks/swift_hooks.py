@@ -13,11 +13,11 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import json
 import os
 import sys
 from subprocess import (
     check_call,
-    CalledProcessError,
 )
 import time
 
@@ -36,6 +36,8 @@ _add_path(_parent)
 
 from lib.swift_utils import (
     SwiftProxyCharmException,
+    RingFetchError,
+    advance_rolling_ring_sync,
     register_configs,
     restart_map,
     services,
@@ -45,20 +47,34 @@ from lib.swift_utils import (
     get_www_dir,
     initialize_ring,
     SWIFT_HA_RES,
-    get_zone,
+    ZoneAssigner,
     do_openstack_upgrade,
     setup_ipv6,
     update_rings,
+    advance_weight_ramps,
+    flush_ring_changes,
+    queue_ring_change,
+    ring_changes_deferred,
+    ring_sync_stops_proxy,
+    get_synced_ring_generation,
+    set_synced_ring_generation,
+    request_resync_if_stale,
     balance_rings,
     fully_synced,
     sync_proxy_rings,
     broadcast_rings_available,
-    mark_www_rings_deleted,
     SwiftProxyClusterRPC,
     get_first_available_value,
     all_responses_equal,
     ensure_www_dir_permissions,
     sync_builders_and_rings_if_changed,
+    ring_transaction,
+    get_rings_checksum,
+    get_rings_url,
+    publish_synced_rings,
+    update_rings_mirrors,
+    order_rings_mirrors,
+    update_ring_convergence,
     cluster_sync_rings,
     is_most_recent_timestamp,
     timestamps_available,
@@ -76,6 +92,7 @@ from lib.swift_utils import (
 )
 
 from lib.swift_context import get_swift_hash
+from lib.swift_relations import relation_get
 
 import charmhelpers.contrib.openstack.utils as openstack
 import charmhelpers.contrib.openstack.policyd as policyd
@@ -96,7 +113,6 @@ from charmhelpers.core.hookenv import (
     remote_unit,
     relation_set,
     relation_ids,
-    relation_get,
     related_units,
     log,
     DEBUG,
@@ -211,12 +227,22 @@ def config_changed():
         status_set('maintenance', 'Running openstack upgrade')
 
     if not leader_get('swift-proxy-rings-consumer'):
-        status_set('maintenance', 'Updating and (maybe) balancing rings')
-        update_rings(min_part_hours=config('min-hours'),
-                     replicas=config('replicas'))
-
-    if not config('disable-ring-balance') and is_elected_leader(SWIFT_HA_RES):
-        # Try ring balance. If rings are balanced, no sync will occur.
+        if ring_changes_deferred():
+            if is_elected_leader(SWIFT_HA_RES):
+                queue_ring_change({'type': 'config',
+                                   'min_part_hours': config('min-hours'),
+                                   'replicas': config('replicas')})
+            flush_ring_changes(storage_nodes)
+        else:
+            status_set('maintenance', 'Updating and (maybe) balancing rings')
+            update_rings(min_part_hours=config('min-hours'),
+                         replicas=config('replicas'))
+        advance_weight_ramps()
+
+    if (not config('disable-ring-balance') and not ring_changes_deferred() and
+            is_elected_leader(SWIFT_HA_RES)):
+        # Try ring balance. If rings are balanced, no sync will occur. With
+        # ring changes deferred, flushing them is what rebalances the rings.
         balance_rings()
 
     for r_id in relation_ids('identity-service'):
@@ -277,15 +303,14 @@ def keystone_changed():
 @hooks.hook('swift-storage-relation-joined')
 def storage_joined(rid=None):
     if not is_elected_leader(SWIFT_HA_RES):
-        log("New storage relation joined - stopping proxy until ring builder "
-            "synced", level=INFO)
-        service_stop('swift-proxy')
-
-        # This unit is not currently responsible for distributing rings but
-        # may become so at some time in the future so we do this to avoid the
-        # possibility of storage nodes getting out-of-date rings by deprecating
-        # any existing ones from the www dir.
-        mark_www_rings_deleted()
+        # The current rings stay valid until the leader publishes a new
+        # generation that includes the new unit, so keep serving with them,
+        # to the proxies and to storage units mirroring from this unit.
+        log("New storage relation joined - proxy will sync rings once the "
+            "leader publishes them", level=INFO)
+
+        # Storage units only sync from the rings_url of the leader and the
+        # mirrors it lists, never from this unit's own relation settings.
         clear_storage_rings_available()
 
     try_initialize_swauth()
@@ -337,50 +362,55 @@ def update_rsync_acls():
         relation_set(relation_id=rid, **settings)
 
 
-@hooks.hook('swift-storage-relation-changed')
-@restart_on_change(restart_map())
-def storage_changed():
-    """Storage relation.
+def storage_unit_nodes(rid, unit, zones):
+    """Build the ring nodes for each device of a swift-storage unit.
 
-    Only the leader unit can update and distribute rings so if we are not the
-    leader we ignore this event and wait for a resync request from the leader.
+    :param rid: the relation id
+    :param unit: the storage unit
+    :param zones: ZoneAssigner for the storage units
+    :returns: list of nodes, or None if the unit's relation data isn't
+        complete yet
     """
-    if not is_elected_leader(SWIFT_HA_RES):
-        log("Not the leader - deferring storage relation change to leader "
-            "unit.", level=DEBUG)
-        return
-
-    log("Storage relation changed -processing", level=DEBUG)
-    host_ip = get_host_ip()
+    host_ip = get_host_ip(rid=rid, unit=unit)
     if not host_ip:
-        log("No host ip found in storage relation - deferring storage "
-            "relation", level=WARNING)
-        return
-
-    update_rsync_acls()
+        log("No host ip found in storage relation for {} - deferring"
+            .format(unit), level=WARNING)
+        return None
 
-    zone = get_zone(config('zone-assignment'))
+    settings = relation_get(rid=rid, unit=unit) or {}
     node_settings = {
         'ip': host_ip,
-        'zone': zone,
-        'account_port': relation_get('account_port'),
-        'object_port': relation_get('object_port'),
-        'container_port': relation_get('container_port'),
+        'account_port': settings.get('account_port'),
+        'object_port': settings.get('object_port'),
+        'container_port': settings.get('container_port'),
     }
     node_repl_settings = {
-        'ip_rep': relation_get('ip_rep'),
-        'region': relation_get('region'),
-        'account_port_rep': relation_get('account_port_rep'),
-        'object_port_rep': relation_get('object_port_rep'),
-        'container_port_rep': relation_get('container_port_rep')}
+        'ip_rep': settings.get('ip_rep'),
+        'region': settings.get('region'),
+        'account_port_rep': settings.get('account_port_rep'),
+        'object_port_rep': settings.get('object_port_rep'),
+        'container_port_rep': settings.get('container_port_rep')}
 
     if any(node_repl_settings.values()):
         node_settings.update(node_repl_settings)
 
     if None in node_settings.values():
         missing = [k for k, v in node_settings.items() if v is None]
-        log("Relation not ready - some required values not provided by "
-            "relation (missing={})".format(', '.join(missing)), level=INFO)
+        log("Relation not ready for {} - some required values not provided "
+            "by relation (missing={})".format(unit, ', '.join(missing)),
+            level=INFO)
+        return None
+
+    # Allow for multiple devs per unit, passed along as a : separated list
+    devs = [dev for dev in (settings.get('device') or '').split(':') if dev]
+    if not devs:
+        return []
+
+    node_settings['zone'] = zones.zone(host_ip, len(devs), rid=rid,
+                                       unit=unit)
+    if node_settings['zone'] is None:
+        log("Relation not ready for {} - some required values not provided "
+            "by relation (missing=zone)".format(unit), level=INFO)
         return None
 
     for k in ['region', 'zone', 'account_port', 'account_port_rep',
@@ -389,19 +419,59 @@ def storage_changed():
         if node_settings.get(k) is not None:
             node_settings[k] = int(node_settings[k])
 
-    CONFIGS.write_all()
+    return [dict(node_settings, device=dev) for dev in devs]
 
-    # Allow for multiple devs per unit, passed along as a : separated list
-    # Update and balance rings.
+
+def storage_nodes():
+    """Build the ring nodes for the devices of all the swift-storage units.
+
+    :returns: list of nodes of the units whose relation data is complete
+    """
+    zones = ZoneAssigner(config('zone-assignment'))
     nodes = []
-    devs = relation_get('device')
-    if devs:
-        for dev in devs.split(':'):
-            node = {k: v for k, v in node_settings.items()}
-            node['device'] = dev
-            nodes.append(node)
-
-    update_rings(nodes)
+    for rid in relation_ids('swift-storage'):
+        for unit in related_units(rid):
+            nodes.extend(storage_unit_nodes(rid, unit, zones) or [])
+    return nodes
+
+
+def reconcile_storage_rings():
+    """Add or update the devices of all swift-storage units in the rings.
+
+    The devices of every unit are gathered in a single pass and applied by a
+    single update_rings(), so however many units have joined the rings are
+    rebalanced and synced at most once.  If ring changes are deferred the
+    reconciliation is queued instead; see queue_ring_change().
+    """
+    if ring_changes_deferred():
+        queue_ring_change({'type': 'storage'})
+        flush_ring_changes(storage_nodes)
+    else:
+        update_rings(storage_nodes())
+
+
+@hooks.hook('swift-storage-relation-changed')
+@restart_on_change(restart_map())
+def storage_changed():
+    """Storage relation.
+
+    Only the leader unit can update and distribute rings so if we are not the
+    leader we ignore this event and wait for a resync request from the leader.
+
+    Rather than just the unit that changed, the devices of all the storage
+    units are reconciled with the rings; see reconcile_storage_rings().
+    """
+    if not is_elected_leader(SWIFT_HA_RES):
+        log("Not the leader - deferring storage relation change to leader "
+            "unit.", level=DEBUG)
+        return
+
+    update_ring_convergence()
+    log("Storage relation changed - reconciling storage units",
+        level=DEBUG)
+    update_rsync_acls()
+    CONFIGS.write_all()
+    reconcile_storage_rings()
     if not openstack.is_unit_paused_set():
         # Restart proxy here in case no config changes made (so
         # restart_on_change() ineffective).
@@ -484,6 +554,10 @@ def cluster_leader_actions():
     tx_rq_token = tx_settings.get(SwiftProxyClusterRPC.KEY_STOP_PROXY_SVC)
     tx_ack_token = tx_settings.get(SwiftProxyClusterRPC.KEY_STOP_PROXY_SVC_ACK)
 
+    if rx_settings.get(SwiftProxyClusterRPC.KEY_RINGS_CHECKSUM):
+        update_rings_mirrors()
+        update_ring_convergence()
+
     rx_leader_changed = \
         rx_settings.get(SwiftProxyClusterRPC.KEY_NOTIFY_LEADER_CHANGED)
     if rx_leader_changed:
@@ -512,7 +586,9 @@ def cluster_leader_actions():
     # attempt to restore the original leader so to be able to complete the
     # sync.
 
-    if rx_ack_token and rx_ack_token == tx_rq_token:
+    if advance_rolling_ring_sync():
+        log("Rolling ring sync in progress", level=DEBUG)
+    elif rx_ack_token and rx_ack_token == tx_rq_token:
         # Find out if all peer units have been stopped.
         responses = []
         for rid in relation_ids('cluster'):
@@ -571,8 +647,16 @@ def cluster_non_leader_actions():
     rx_settings = relation_get() or {}
     tx_settings = relation_get(unit=local_unit()) or {}
 
+    stop_proxy = ring_sync_stops_proxy()
     token = rx_settings.get(SwiftProxyClusterRPC.KEY_NOTIFY_LEADER_CHANGED)
     if token:
+        if not stop_proxy:
+            log("Leader-changed notification received from peer unit - "
+                "rings are only ever swapped in whole so the proxy keeps "
+                "serving until a fresh sync request is sent out",
+                level=WARNING)
+            return
+
         log("Leader-changed notification received from peer unit. Since "
             "this most likely occurred during a ring sync proxies will "
             "be disabled until the leader is restored and a fresh sync "
@@ -583,7 +667,13 @@ def cluster_non_leader_actions():
     rx_rq_token = rx_settings.get(SwiftProxyClusterRPC.KEY_STOP_PROXY_SVC)
 
     # Check whether we have been requested to stop proxy service
-    if rx_rq_token:
+    rq_units = rx_settings.get(SwiftProxyClusterRPC.KEY_STOP_PROXY_UNITS)
+    if rx_rq_token and rq_units and local_unit() not in rq_units.split():
+        log("Peer request to stop proxy service received ({}) for other "
+            "units only ({}) - ignoring".format(rx_rq_token, rq_units),
+            level=DEBUG)
+        return
+    elif rx_rq_token:
         log("Peer request to stop proxy service received ({}) - sending ack"
             .format(rx_rq_token), level=INFO)
         service_stop('swift-proxy')
@@ -605,7 +695,14 @@ def cluster_non_leader_actions():
 
         return
     elif broker_token:
-        if tx_ack_token:
+        sync_units = rx_settings.get(SwiftProxyClusterRPC.KEY_RING_SYNC_UNITS)
+        if sync_units and local_unit() not in sync_units.split():
+            log("Ring/builder update notification received ({}) for other "
+                "units only ({}) - ignoring".format(broker_token, sync_units),
+                level=DEBUG)
+            return
+
+        if tx_ack_token and stop_proxy:
             if broker_token == tx_ack_token:
                 log("Broker and ACK tokens match ({})".format(broker_token),
                     level=DEBUG)
@@ -634,16 +731,35 @@ def cluster_non_leader_actions():
 
         return
 
-    log("Ring/builder update available", level=DEBUG)
-    builders_only = int(rx_settings.get('sync-only-builders', 0))
-    path = os.path.basename(get_www_dir())
-    try:
-        sync_proxy_rings('http://{}/{}'.format(broker, path),
-                         rings=not builders_only)
-    except CalledProcessError:
-        log("Ring builder sync failed, builders not yet available - "
-            "leader not ready?", level=WARNING)
-        return
+    generation = rx_settings.get(SwiftProxyClusterRPC.KEY_RING_GENERATION)
+    if (generation and int(generation) <= get_synced_ring_generation() and
+            fully_synced()):
+        log("Ring generation {} already synced".format(generation),
+            level=DEBUG)
+    else:
+        log("Ring/builder update available", level=DEBUG)
+        builders_only = int(rx_settings.get('sync-only-builders', 0))
+        checksums = rx_settings.get(SwiftProxyClusterRPC.KEY_RING_CHECKSUMS)
+        if checksums:
+            checksums = json.loads(checksums)
+
+        path = os.path.basename(get_www_dir())
+        try:
+            sync_proxy_rings('http://{}/{}'.format(broker, path),
+                             rings=not builders_only, checksums=checksums)
+        except RingFetchError:
+            log("Ring builder sync failed, builders not yet available - "
+                "leader not ready?", level=WARNING)
+            return
+        except SwiftProxyCharmException as exc:
+            # Most likely the leader has changed the rings again since this
+            # request, in which case another one will follow.
+            log("Ring builder sync failed, keeping current rings: {}"
+                .format(exc), level=WARNING)
+            return
+
+        if generation:
+            set_synced_ring_generation(generation)
 
     # Re-enable the proxy once all builders and rings are synced
     if fully_synced():
@@ -651,6 +767,14 @@ def cluster_non_leader_actions():
         CONFIGS.write_all()
         if not openstack.is_unit_paused_set():
             service_start('swift-proxy')
+
+        # Serve the rings to storage units as well once the leader lists this
+        # unit as a mirror.
+        publish_synced_rings()
+        relation_set(relation_settings={
+            SwiftProxyClusterRPC.KEY_RING_SYNC_ACK: broker_token,
+            SwiftProxyClusterRPC.KEY_RINGS_CHECKSUM: get_rings_checksum(),
+            SwiftProxyClusterRPC.KEY_RINGS_URL: get_rings_url()})
     else:
         log("Not all builders and rings synced yet - waiting for peer sync "
             "before starting proxy", level=INFO)
@@ -665,6 +789,13 @@ def cluster_changed():
         cluster_non_leader_actions()
 
 
+@hooks.hook('cluster-relation-departed')
+def cluster_departed():
+    if is_elected_leader(SWIFT_HA_RES):
+        # Stop sending storage units to the departed unit.
+        update_rings_mirrors()
+
+
 @hooks.hook('ha-relation-changed')
 @sync_builders_and_rings_if_changed
 def ha_relation_changed():
@@ -757,6 +888,13 @@ def upgrade_charm():
 @harden()
 def update_status():
     log('Updating status.')
+    if not leader_get('swift-proxy-rings-consumer'):
+        flush_ring_changes(storage_nodes)
+        advance_weight_ramps()
+
+    request_resync_if_stale()
+    if is_elected_leader(SWIFT_HA_RES):
+        update_ring_convergence()
 
 
 @hooks.hook('amqp-relation-joined')
@@ -826,6 +964,8 @@ def rings_distributor_joined():
 
 @hooks.hook('rings-distributor-relation-changed')
 def rings_distributor_changed():
+    if is_elected_leader(SWIFT_HA_RES):
+        update_ring_convergence()
     broadcast_rings_available()
 
 
@@ -863,11 +1003,16 @@ def rings_consumer_changed():
         msg = "Swift hash has to be unique in multi-region setup"
         status_set('blocked', msg)
         raise SwiftProxyCharmException(msg)
-    try:
-        fetch_swift_rings_and_builders(rings_url)
-    except CalledProcessError:
-        log("Failed to sync rings from {} - no longer available from that "
-            "unit?".format(rings_url), level=WARNING)
+    mirrors = json.loads(relation_get('rings_mirrors') or '[]')
+    for url in order_rings_mirrors(mirrors) or [rings_url]:
+        try:
+            fetch_swift_rings_and_builders(url)
+            # Let the distributor know which rings are installed here.
+            relation_set(rings_checksum=get_rings_checksum())
+            break
+        except RingFetchError:
+            log("Failed to sync rings from {} - no longer available from that "
+                "unit?".format(url), level=WARNING)
     broadcast_rings_available()
 
 
@@ -879,7 +1024,8 @@ def rings_consumer_departed():
 
 def main():
     try:
-        hooks.execute(sys.argv)
+        with ring_transaction():
+            hooks.execute(sys.argv)
     except UnregisteredHookError as e:
         log('Unknown hook {} - skipping.'.format(e), level=DEBUG)
     assess_status(CONFIGS)
@@ -7,7 +7,6 @@ from charmhelpers.core.hookenv import (
     log,
     relation_ids,
     related_units,
-    relation_get,
     unit_get,
     service_name,
     leader_get,
@@ -34,6 +33,8 @@ from charmhelpers.contrib.openstack.utils import (
     get_host_ip,
 )
 
+from lib.swift_relations import relation_get
+
 
 SWIFT_HASH_FILE = '/var/lib/juju/swift-hash-path.conf'
 WWW_DIR = '/var/www/swift-rings'
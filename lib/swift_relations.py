@@ -0,0 +1,49 @@
+"""Relation data of remote units, fetched once per hook.
+
+charmhelpers caches relation_get() per exact argument tuple, so asking for
+one attribute of a unit, then another, or the same one with differently
+passed arguments, each runs a relation-get process. The relation_get() here
+fetches all of a remote unit's settings with the first lookup and answers
+every further lookup for that unit from memory. The data of remote units
+can't change during a hook, so the snapshot lives as long as the hook
+process.
+
+The local unit's settings, which relation_set() changes, and lookups that
+rely on the hook's relation context are left to charmhelpers.
+"""
+
+from charmhelpers.core import hookenv
+
+# Settings of remote units for the current hook, keyed by (rid, unit).
+_SNAPSHOT = {}
+
+
+def relation_get(attribute=None, unit=None, rid=None, app=None):
+    """Get relation information, as charmhelpers' relation_get() does.
+
+    :param attribute: the setting to get, all of them if None
+    :type attribute: Optional[str]
+    :param unit: the unit, the remote unit of the hook by default
+    :type unit: Optional[str]
+    :param rid: the relation id, the hook's relation by default
+    :type rid: Optional[str]
+    :param app: the application to get application settings of
+    :type app: Optional[str]
+    :returns: the setting, or all of the settings
+    :rtype: Union[None, str, Dict[str, str]]
+    """
+    if (app is not None or unit is None or rid is None or
+            unit == hookenv.local_unit()):
+        return hookenv.relation_get(attribute=attribute, unit=unit, rid=rid,
+                                    app=app)
+
+    key = (rid, unit)
+    if key not in _SNAPSHOT:
+        _SNAPSHOT[key] = hookenv.relation_get(unit=unit, rid=rid)
+
+    settings = _SNAPSHOT[key]
+    if attribute is None:
+        # a copy, so that callers can't change the snapshot
+        return dict(settings) if settings is not None else None
+
+    return (settings or {}).get(attribute)
@@ -1,18 +1,27 @@
+import atexit
+import contextlib
 import copy
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import functools
 import glob
+import gzip
 import hashlib
+import http.client
+import importlib.util
 import json
 import os
 import pwd
+import random
 import shutil
 import subprocess
 import sys
 import tempfile
 import threading
 import time
+import urllib.parse
 import uuid
+import zlib
 
 from lib.swift_context import (
     get_swift_hash,
@@ -24,6 +33,7 @@ from lib.swift_context import (
     MemcachedContext,
     SwiftS3Context,
 )
+from lib.swift_relations import relation_get
 
 import charmhelpers.contrib.openstack.context as context
 import charmhelpers.contrib.openstack.templating as templating
@@ -50,7 +60,6 @@ from charmhelpers.core.hookenv import (
     INFO,
     WARNING,
     local_unit,
-    relation_get,
     unit_get,
     relation_set,
     relation_ids,
@@ -79,8 +88,12 @@ from charmhelpers.contrib.network.ip import (
     get_ipv6_addr,
     is_ipv6,
 )
-from charmhelpers.core.decorators import (
-    retry_on_exception,
+from charmhelpers.core.unitdata import kv
+
+from swift_manager import manager as swift_manager
+from swift_manager.manager import (
+    find_missing_devices,
+    next_zone,
 )
 
 
@@ -104,7 +117,58 @@ APACHE_SITE_24_CONF = os.path.join(APACHE_SITES_AVAILABLE,
 WWW_DIR = '/var/www/swift-rings'
 ALTERNATE_WWW_DIR = '/var/www/html/swift-rings'
 
-RING_SYNC_SEMAPHORE = threading.Semaphore()
+# The ring transaction of the current hook; see ring_transaction().
+_RING_TRANSACTION = None
+
+# Extension of the ring index sidecar stored next to each builder.
+RING_INDEX_EXT = 'index.json'
+
+# Ring indexes loaded during this hook, keyed by builder path.
+_RING_INDEXES = {}
+
+# Weight of a device once it is fully in a ring.
+DEFAULT_DEVICE_WEIGHT = 100
+
+# unitdata key of the pending weight ramps; see schedule_weight_ramps().
+WEIGHT_RAMPS_KEY = 'weight-ramps'
+
+# unitdata key of the queued ring changes; see queue_ring_change().
+RING_CHANGES_KEY = 'ring-changes'
+
+# unitdata key of the rolling ring sync in progress; see
+# start_rolling_ring_sync().
+ROLLING_RING_SYNC_KEY = 'rolling-ring-sync'
+
+# leader setting holding the generation of the published rings, and unitdata
+# key of the generation a peer has synced; see publish_ring_generation().
+RING_GENERATION_KEY = 'ring-generation'
+SYNCED_RING_GENERATION_KEY = 'synced-ring-generation'
+
+# unitdata key of the generation a peer last requested a resync for; see
+# request_resync_if_stale().
+RESYNC_REQUESTED_GENERATION_KEY = 'resync-requested-generation'
+
+# unitdata key of the cached ring and builder checksums; see
+# cached_file_checksums().
+FILE_CHECKSUMS_KEY = 'file-checksums'
+
+# unitdata key of the leader's ring convergence table; see
+# start_ring_convergence().
+RING_CONVERGENCE_KEY = 'ring-convergence'
+# Number of completed convergence rounds kept for reporting.
+RING_CONVERGENCE_HISTORY = 10
+
+# Ring and builder downloads; see fetch_files().
+FETCH_WORKERS = 3
+FETCH_ATTEMPTS = 10
+FETCH_TIMEOUT = 60
+FETCH_CHUNK_SIZE = 1024 * 1024
+
+# Published next to the rings and builders in the www dir; see
+# update_www_rings().
+RING_MANIFEST = 'manifest.json'
+# Symlink to the generation directory currently published in the www dir.
+WWW_CURRENT = 'current'
 
 VERSION_PACKAGE = 'swift-proxy'
 
@@ -216,6 +280,10 @@ class SwiftProxyCharmException(Exception):
     pass
 
 
+class RingFetchError(SwiftProxyCharmException):
+    pass
+
+
 def nodes_have_rep_data(nodes=None):
     """ Checks if data received from remote nodes are compatible and have
     replication data.
@@ -246,6 +314,13 @@ class SwiftProxyClusterRPC(object):
     KEY_NOTIFY_LEADER_CHANGED = 'leader-changed-notification'
     KEY_REQUEST_RESYNC = 'resync-request'
     KEY_REQUEST_RESYNC_ACK = 'resync-request-ack'
+    KEY_RING_CHECKSUMS = 'ring-checksums'
+    KEY_STOP_PROXY_UNITS = 'stop-proxy-units'
+    KEY_RING_SYNC_UNITS = 'ring-sync-units'
+    KEY_RING_SYNC_ACK = 'ring-sync-ack'
+    KEY_RING_GENERATION = 'ring-generation'
+    KEY_RINGS_CHECKSUM = 'rings-checksum'
+    KEY_RINGS_URL = 'rings-url'
 
     def __init__(self, version=1):
         self._version = version
@@ -264,13 +339,17 @@ class SwiftProxyClusterRPC(object):
                          'broker-timestamp': None,
                          self.KEY_STOP_PROXY_SVC: None,
                          self.KEY_STOP_PROXY_SVC_ACK: None,
+                         self.KEY_STOP_PROXY_UNITS: None,
+                         self.KEY_RING_SYNC_UNITS: None,
                          self.KEY_NOTIFY_LEADER_CHANGED: None,
                          self.KEY_REQUEST_RESYNC: None,
+                         self.KEY_RING_CHECKSUMS: None,
+                         self.KEY_RING_GENERATION: None,
                          'peers-only': None,
                          'sync-only-builders': None}}
         return copy.deepcopy(templates[self._version])
 
-    def stop_proxy_request(self, peers_only=False, token=None):
+    def stop_proxy_request(self, peers_only=False, token=None, units=None):
         """Request to stop peer proxy service.
 
         A token can optionally be supplied in case we want to restart a
@@ -282,6 +361,8 @@ class SwiftProxyClusterRPC(object):
                            (i.e. proxy not storage) units to be notified.
         :param token: optional request token expected to be echoed in ACK from
                       peer. If token not provided, a new one is generated.
+        :param units: optional list of the peer units that should stop. If not
+                      provided, all of them should.
         """
         if not is_elected_leader(SWIFT_HA_RES):
             errmsg = "Leader function called by non-leader"
@@ -296,6 +377,9 @@ class SwiftProxyClusterRPC(object):
         if peers_only:
             rq['peers-only'] = 1
 
+        if units:
+            rq[self.KEY_STOP_PROXY_UNITS] = ' '.join(sorted(units))
+
         rq['builder-broker'] = self._hostname
         return rq
 
@@ -316,7 +400,8 @@ class SwiftProxyClusterRPC(object):
         return rq
 
     def sync_rings_request(self, broker_token, broker_timestamp,
-                           builders_only=False):
+                           builders_only=False, checksums=None,
+                           generation=None, units=None):
         """Request for peers to sync rings from leader.
 
         NOTE: this action must only be performed by the cluster leader.
@@ -327,6 +412,12 @@ class SwiftProxyClusterRPC(object):
                                  sync.
         :param builders_only: if False, tell peers to sync builders only (not
                               rings).
+        :param checksums: sha256 of each file to sync, keyed by file name, so
+                          that peers can verify what they download.
+        :param generation: generation of the rings to sync, so that peers
+                           which already have it can skip the download.
+        :param units: optional list of the peer units that should sync. If not
+                      provided, all of them should.
         """
         if not is_elected_leader(SWIFT_HA_RES):
             errmsg = "Leader function called by non-leader"
@@ -338,6 +429,16 @@ class SwiftProxyClusterRPC(object):
         if builders_only:
             rq['sync-only-builders'] = 1
 
+        if checksums:
+            rq[self.KEY_RING_CHECKSUMS] = json.dumps(checksums,
+                                                     sort_keys=True)
+
+        if generation:
+            rq[self.KEY_RING_GENERATION] = generation
+
+        if units:
+            rq[self.KEY_RING_SYNC_UNITS] = ' '.join(sorted(units))
+
         rq['broker-token'] = broker_token
         rq['broker-timestamp'] = broker_timestamp
         rq['builder-broker'] = self._hostname
@@ -560,16 +661,100 @@ def initialize_ring(path, part_power, replicas, min_hours):
     get_manager().initialize_ring(path, part_power, replicas, min_hours)
 
 
+def _ring_index_path(path):
+    return '{}.{}'.format(path, RING_INDEX_EXT)
+
+
+def _builder_signature(path):
+    """Return the stat signature used to tell if a builder has changed."""
+    st = os.stat(path)
+    return [st.st_ino, st.st_size, st.st_mtime_ns]
+
+
+def get_ring_index(path):
+    """Return the metadata index of a builder.
+
+    The index (see manager.py:ring_index()) is stored in a sidecar file next
+    to the builder, along with the stat signature of the builder it was
+    generated from.  It is only regenerated, by loading the builder, when the
+    builder's signature no longer matches.
+
+    :param path: the path of the builder
+    :type path: str
+    :returns: the index
+    :rtype: dict
+    """
+    signature = _builder_signature(path)
+    index = _RING_INDEXES.get(path)
+    if index and index['signature'] == signature:
+        return index
+
+    index_path = _ring_index_path(path)
+    try:
+        with open(index_path) as fd:
+            index = json.load(fd)
+    except (OSError, ValueError):
+        index = None
+
+    if not index or index.get('signature') != signature:
+        log("Generating ring index for {}".format(path), level=DEBUG)
+        index = get_manager().ring_index(path)
+        index['signature'] = signature
+        # Don't store the index if the builder changed while it was being
+        # generated.
+        if _builder_signature(path) == signature:
+            tmp_path = "{}.tmp".format(index_path)
+            try:
+                with open(tmp_path, 'w') as fd:
+                    json.dump(index, fd, **JSON_ENCODE_OPTIONS)
+                os.rename(tmp_path, index_path)
+            except OSError as e:
+                log("Unable to store ring index {}: {}"
+                    .format(index_path, str(e)), level=WARNING)
+
+    _RING_INDEXES[path] = index
+    return index
+
+
 def exists_in_ring(ring_path, node):
     node['port'] = _ring_port(ring_path, node)
-    result = get_manager().exists_in_ring(ring_path, node)
+    result = not missing_devices(ring_path, [node])['missing']
     if result:
         log('Node already exists in ring ({}).'
             .format(ring_path), level=INFO)
     return result
 
 
-def add_to_ring(ring_path, node):
+def missing_devices(ring_path, nodes):
+    """Determine which nodes are missing from, or need updating in, a ring.
+
+    Answered from the ring index (see get_ring_index()) using
+    manager.py:find_missing_devices(), so the ring's devices are only indexed
+    once for all of the nodes.
+
+    :param ring_path: path to the ring
+    :type ring_path: str
+    :param nodes: storage nodes, with 'port' (and 'port_rep' if replication
+        is in use) set for the ring
+    :type nodes: list
+    :returns: {'missing': [<node index>, ...], 'update': [<node index>, ...]}
+    :rtype: dict
+    """
+    return find_missing_devices(get_ring_index(ring_path)['devs'], nodes)
+
+
+def ring_device(ring_path, node, weight=DEFAULT_DEVICE_WEIGHT):
+    """Build the device to add to a ring for a storage node.
+
+    :param ring_path: path to the ring
+    :type ring_path: str
+    :param node: storage node
+    :type node: dict
+    :param weight: the device's weight
+    :type weight: float
+    :returns: device in the manager.py:add_dev() format
+    :rtype: dict
+    """
     port = _ring_port(ring_path, node)
     port_rep = _ring_port_rep(ring_path, node)
 
@@ -583,7 +768,7 @@ def add_to_ring(ring_path, node):
         'ip': node['ip'],
         'port': port,
         'device': node['device'],
-        'weight': 100,
+        'weight': weight,
         'meta': '',
     }
     if port_rep:
@@ -592,42 +777,55 @@ def add_to_ring(ring_path, node):
             'replication_ip': node['ip_rep'],
             'replication_port': port_rep,
         })
+    return new_dev
+
+
+def add_to_ring(ring_path, node):
+    new_dev = ring_device(ring_path, node)
     get_manager().add_dev(ring_path, new_dev)
     msg = 'Added new device to ring {}: {}'.format(ring_path, new_dev)
     log(msg, level=INFO)
 
 
-def update_ring_node_ports(ring_name, ring_path, node):
-    """ Updates ring port and replication for each device node
+def node_ports_operation(ring_name, node):
+    """Build the ring operation that updates the ports of a device node.
+
+    :param ring_name: account, container or object
+    :type ring_name: str
+    :param node: device node
+    :type node: dict
+    :returns: a set_info operation for manager.py:apply_ring_operations()
+    :rtype: dict
+    """
+    return {
+        'op': 'set_info',
+        'search': {
+            'ip': node['ip'],
+            'replication_ip': node['ip_rep'],
+            'device': node['device'],
+        },
+        'changes': {
+            'port': int(node["{}_port".format(ring_name)]),
+            'replication_port': int(node["{}_port_rep".format(ring_name)]),
+        },
+    }
 
-     :param ring_name: account, container or object
-     :type ring_name: str
-     :param ring_path: path to the ring
-     :type ring_path: str
-     :param node: device node
-     :type node: dict
-     :raises: SwiftProxyCharmException
-     """
 
-    log("Updating ports and replication ports for {} ring.".format(ring_name),
-        level=INFO)
+def apply_ring_operations(path, operations):
+    """Just a proxy to the manager.py:apply_ring_operations() function
 
-    port_field_name = "{}_port".format(ring_name)
-    portrep_field_name = "{}_port_rep".format(ring_name)
-    cmd = ['swift-ring-builder', ring_path, 'set_info',
-           '--ip', node['ip'],
-           '--replication-ip', node['ip_rep'],
-           '--device', node['device'],
-           '--change-port', str(node[port_field_name]),
-           '--change-replication-port', str(node[portrep_field_name])]
+    :param path: the path of the ring to apply the operations to
+    :type path: str
+    :param operations: the operations to apply
+    :type operations: list
+    :returns: the result of each operation
+    :rtype: list
+    """
     try:
-        subprocess.check_call(cmd)
-    except subprocess.CalledProcessError as e:
+        return get_manager().apply_ring_operations(path, operations)
+    except RuntimeError as e:
         raise SwiftProxyCharmException(
-            "Failed to update device (host={}, rep_host={}, "
-            "dev_name={}) on {} ring: {}".format(
-                node['ip'], node['ip_rep'], node['device'],
-                ring_name, e))
+            "Failed to update ring {}: {}".format(path, e))
 
 
 def remove_from_ring(ring_path, search_value):
@@ -719,8 +917,7 @@ def get_zone(assignment_policy):
     if assignment_policy == 'manual':
         return relation_get('zone')
     elif assignment_policy == 'auto':
-        _manager = get_manager()
-        potential_zones = [_manager.get_zone(ring_path)
+        potential_zones = [get_ring_index(ring_path)['zone']
                            for ring_path in SWIFT_RINGS.values()]
         return set(potential_zones).pop()
     else:
@@ -728,14 +925,87 @@ def get_zone(assignment_policy):
             'Invalid zone assignment policy: {}'.format(assignment_policy))
 
 
-def balance_ring(ring_path):
+class ZoneAssigner(object):
+    """Assigns zones to storage units when reconciling them in one pass.
+
+    With the manual policy each unit's zone comes from its relation data.
+    With the auto policy a unit whose ip is already in the rings keeps that
+    zone, and each new unit gets the zone that get_zone() would return if the
+    units assigned before it had already been added, so that the units are
+    spread across the zones as if they had been added one hook at a time.
+    """
+
+    def __init__(self, assignment_policy):
+        if assignment_policy not in ('manual', 'auto'):
+            raise SwiftProxyCharmException(
+                'Invalid zone assignment policy: {}'
+                .format(assignment_policy))
+        self.assignment_policy = assignment_policy
+        self._rings = []
+        self._ip_zones = {}
+        if assignment_policy == 'auto':
+            for ring_path in SWIFT_RINGS.values():
+                index = get_ring_index(ring_path)
+                self._rings.append((index['replicas'],
+                                    [dev['zone'] for dev in index['devs']]))
+                for dev in index['devs']:
+                    self._ip_zones.setdefault(dev['ip'], dev['zone'])
+
+    def zone(self, ip, devices, rid=None, unit=None):
+        """Return the zone for a storage unit.
+
+        :param ip: the unit's storage ip
+        :type ip: str
+        :param devices: the number of devices the unit has
+        :type devices: int
+        :param rid: the unit's relation id
+        :type rid: str
+        :param unit: the unit
+        :type unit: str
+        :returns: the zone, which is None if a manual zone hasn't been set
+        """
+        if self.assignment_policy == 'manual':
+            return relation_get('zone', rid=rid, unit=unit)
+        if ip not in self._ip_zones:
+            zone = set(next_zone(replicas, zones)
+                       for replicas, zones in self._rings).pop()
+            for _, zones in self._rings:
+                zones.extend([zone] * devices)
+            self._ip_zones[ip] = zone
+        return self._ip_zones[ip]
+
+
+def balance_ring(ring_path, seed=None):
     """Balance a ring.
 
     Returns True if it needs redistribution.
+
+    :param seed: the seed to rebalance with, e.g. the one a preview was made
+        with (see choose_rebalance_seeds()); a random one if None
     """
+    attempts = config('rebalance-attempts') or 1
+    if attempts > 1:
+        try:
+            result = get_manager().rebalance_best_of(
+                ring_path, attempts, config('rebalance-max-workers') or None,
+                seed=seed)
+        except RuntimeError as e:
+            raise SwiftProxyCharmException(
+                'balance_ring: rebalance of {} failed: {}'
+                .format(ring_path, str(e)))
+        log("Best of {} rebalances of {}: seed={}, parts moved={}, "
+            "balance={:.2f}, dispersion={:.2f}, saved={}"
+            .format(attempts, ring_path, result['seed'], result['parts'],
+                    result['balance'], result['dispersion'],
+                    result['written']), level=INFO)
+        # as for swift-ring-builder, a warning means no redistribution
+        return result['written'] and not result['warning']
+
     # shell out to swift-ring-builder instead, since the balancing code there
     # does a bunch of un-importable validation.
     cmd = ['swift-ring-builder', ring_path, 'rebalance']
+    if seed is not None:
+        cmd += ['--seed', str(seed)]
     try:
         subprocess.check_call(cmd)
     except subprocess.CalledProcessError as e:
@@ -758,6 +1028,110 @@ def balance_ring(ring_path):
     return True
 
 
+def preview_rebalance(ring_path, partition_size=None, seed=None):
+    """Estimate what rebalancing a ring would move.
+
+    See manager.py:preview_rebalance() for the result.
+
+    :param ring_path: path to the builder
+    :type ring_path: str
+    :param partition_size: average size of a partition replica in bytes
+    :type partition_size: Optional[int]
+    :param seed: the seed to rebalance with, a random one if None
+    :type seed: Optional[int]
+    :returns: the preview
+    :rtype: dict
+    :raises: SwiftProxyCharmException
+    """
+    try:
+        return get_manager().preview_rebalance(ring_path, partition_size,
+                                               seed=seed)
+    except RuntimeError as e:
+        raise SwiftProxyCharmException(
+            "Failed to preview rebalance of {}: {}".format(ring_path, str(e)))
+
+
+def rebalance_budget_enabled():
+    """Determine whether rebalances are checked against a move budget.
+
+    :returns: True if rebalance-move-budget and rebalance-partition-size are
+        both set
+    :rtype: bool
+    """
+    return bool(config('rebalance-move-budget') and
+                config('rebalance-partition-size'))
+
+
+def choose_rebalance_seeds(rings):
+    """Pick the seed to rebalance each ring with.
+
+    With rebalance-attempts > 1 this is the seed the best of that many
+    rebalances would pick (see manager.py:best_rebalance_seed()), otherwise a
+    random one. A preview made with these seeds moves exactly what the
+    rebalance with them does.
+
+    :param rings: paths to the builders
+    :type rings: List[str]
+    :returns: the seeds, keyed by path
+    :rtype: Dict[str, int]
+    :raises: SwiftProxyCharmException
+    """
+    attempts = config('rebalance-attempts') or 1
+    seeds = {}
+    for path in rings:
+        if attempts > 1:
+            try:
+                seeds[path] = get_manager().best_rebalance_seed(
+                    path, attempts,
+                    config('rebalance-max-workers') or None)['seed']
+            except RuntimeError as e:
+                raise SwiftProxyCharmException(
+                    "Failed to pick a rebalance seed for {}: {}"
+                    .format(path, str(e)))
+        else:
+            seeds[path] = random.SystemRandom().randint(0, 2 ** 32 - 1)
+    return seeds
+
+
+def rebalance_within_budget(rings, seeds=None):
+    """Determine whether rebalancing the rings would stay within the budget.
+
+    The bytes moved are estimated from a preview of each rebalance and
+    compared against the rebalance-move-budget config option.
+
+    :param rings: paths to the builders
+    :type rings: List[str]
+    :param seeds: the seeds the rings will be rebalanced with, keyed by path
+        (see choose_rebalance_seeds())
+    :type seeds: Optional[Dict[str, int]]
+    :returns: False if the estimated bytes moved exceed the budget
+    :rtype: bool
+    """
+    budget = config('rebalance-move-budget')
+    if not budget:
+        return True
+    partition_size = config('rebalance-partition-size')
+    if not partition_size:
+        log("rebalance-move-budget is ignored without "
+            "rebalance-partition-size", level=WARNING)
+        return True
+
+    total = 0
+    for path in rings:
+        preview = preview_rebalance(path, partition_size,
+                                    seed=(seeds or {}).get(path))
+        log("Rebalance of {} would move {} partition replicas (~{} bytes)"
+            .format(path, preview['replicas_moved'], preview['bytes']),
+            level=DEBUG)
+        total += preview['bytes']
+    if total > budget:
+        log("Not rebalancing rings: estimated {} bytes to move exceeds "
+            "rebalance-move-budget of {}".format(total, budget),
+            level=WARNING)
+        return False
+    return True
+
+
 def should_balance(rings):
     """Determine whether or not a re-balance is required and allowed.
 
@@ -815,39 +1189,196 @@ def setup_ipv6():
         apt_install('haproxy/trusty-backports', fatal=True)
 
 
-@retry_on_exception(3, base_delay=2, exc_type=subprocess.CalledProcessError)
-def sync_proxy_rings(broker_url, builders=True, rings=True):
+def fetch_files(base_url, names, target_dir, max_workers=FETCH_WORKERS,
+                attempts=FETCH_ATTEMPTS, retry_delay=1, timeout=FETCH_TIMEOUT,
+                compressed=(), checksums=None):
+    """Download files from a ring broker into a directory.
+
+    The files are fetched concurrently by up to max_workers threads. Each
+    thread keeps one HTTP/1.1 connection to the broker open and reuses it for
+    all of its files, and streams the responses to disk in chunks. A file
+    that fails is retried on its own, up to attempts times, without touching
+    the ones already fetched. A 404 is not retried since the broker doesn't
+    have the file (yet).
+
+    A download cut short is resumed with an HTTP Range request from where it
+    stopped, rather than started again. Files with a checksum are verified as
+    they are written, and one that doesn't match is fetched again from the
+    start.
+
+    :param base_url: URL of the directory holding the files
+    :type base_url: str
+    :param names: names of the files to fetch
+    :type names: List[str]
+    :param target_dir: directory to write the files to
+    :type target_dir: str
+    :param max_workers: maximum number of concurrent downloads
+    :type max_workers: int
+    :param attempts: maximum number of attempts per file
+    :type attempts: int
+    :param retry_delay: seconds to wait before the first retry of a file,
+                        doubled for each further one (up to 10s)
+    :type retry_delay: float
+    :param timeout: socket timeout in seconds
+    :type timeout: float
+    :param compressed: names of the files to fetch gzip compressed, as
+                       <name>.gz, and decompress while writing them
+    :type compressed: Iterable[str]
+    :param checksums: sha256 of the files, keyed by file name
+    :type checksums: Optional[Dict[str, str]]
+    :raises: RingFetchError if any file could not be fetched or verified
+    """
+    checksums = checksums or {}
+    url = urllib.parse.urlsplit(base_url)
+    conn_class = (http.client.HTTPSConnection if url.scheme == 'https'
+                  else http.client.HTTPConnection)
+    local = threading.local()
+    connections = []
+    lock = threading.Lock()
+
+    def _connection():
+        conn = getattr(local, 'conn', None)
+        if conn is None:
+            conn = conn_class(url.hostname, url.port, timeout=timeout)
+            local.conn = conn
+            with lock:
+                connections.append(conn)
+
+        return conn
+
+    def _fetch(name):
+        remote = '{}.gz'.format(name) if name in compressed else name
+        path = '{}/{}'.format(url.path.rstrip('/'), remote)
+        # what has been received so far, as bytes of the remote file, and the
+        # state of decompressing and hashing it for a resumed download
+        received = 0
+        gunzip = sha = None
+        error = None
+        for attempt in range(1, attempts + 1):
+            if error:
+                log("Fetching {}{} failed (attempt {}/{}): {}"
+                    .format(base_url, path, attempt - 1, attempts, error),
+                    level=WARNING)
+                time.sleep(min(retry_delay * 2 ** (attempt - 2), 10))
+
+            conn = _connection()
+            try:
+                headers = {}
+                if received:
+                    headers['Range'] = 'bytes={}-'.format(received)
+
+                conn.request('GET', path, headers=headers)
+                rsp = conn.getresponse()
+                if rsp.status == 200 or (rsp.status == 206 and received):
+                    if rsp.status == 200:
+                        received = 0
+                        sha = hashlib.sha256()
+                        gunzip = None
+                        if name in compressed:
+                            gunzip = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                    else:
+                        log("Resuming {}{} from byte {}"
+                            .format(base_url, path, received), level=DEBUG)
+
+                    mode = 'ab' if received else 'wb'
+                    with open(os.path.join(target_dir, name), mode) as fd:
+                        for chunk in iter(lambda: rsp.read(FETCH_CHUNK_SIZE),
+                                          b''):
+                            data = (gunzip.decompress(chunk) if gunzip
+                                    else chunk)
+                            fd.write(data)
+                            sha.update(data)
+                            received += len(chunk)
+
+                        if rsp.length:
+                            # read() stops short if the connection is lost
+                            raise http.client.IncompleteRead(b'', rsp.length)
+
+                        if gunzip:
+                            data = gunzip.flush()
+                            fd.write(data)
+                            sha.update(data)
+
+                    received = 0
+                    expected = checksums.get(name)
+                    if expected is None or sha.hexdigest() == expected:
+                        return None
+
+                    error = 'checksum mismatch'
+                    continue
+
+                rsp.read()
+                # anything else, including a 416 for a Range that no longer
+                # fits the file, starts the download again
+                received = 0
+                error = 'HTTP {} {}'.format(rsp.status, rsp.reason)
+                if rsp.status == 404:
+                    break
+            except zlib.error as exc:
+                conn.close()
+                received = 0
+                error = exc
+            except (OSError, http.client.HTTPException) as exc:
+                # The connection is reopened by the next request, which
+                # resumes from what was received.
+                conn.close()
+                error = exc
+
+        return '{} ({})'.format(name, error)
+
+    log("Fetching {} from {}".format(', '.join(names), base_url),
+        level=DEBUG)
+    try:
+        with ThreadPoolExecutor(
+                max_workers=max(1, min(max_workers, len(names)))) as pool:
+            failed = [f for f in pool.map(_fetch, names) if f]
+    finally:
+        for conn in connections:
+            conn.close()
+
+    if failed:
+        raise RingFetchError("Failed to fetch {} from {}"
+                             .format(', '.join(failed), base_url))
+
+
+def sync_proxy_rings(broker_url, builders=True, rings=True, checksums=None):
     """The leader proxy is responsible for intialising, updating and
     rebalancing the ring. Once the leader is ready the rings must then be
     synced into each other proxy unit.
 
     Note that we sync the ring builder and .gz files since the builder itself
     is linked to the underlying .gz ring.
+
+    Only the files that differ from the local ones are downloaded (see
+    fetch_changed_ring_files()). They are downloaded into a staging directory
+    next to the rings and only renamed into place once all of them have been
+    fetched and verified. Each rename is atomic, so a running swift-proxy
+    sees either the old ring or the new one, and reloads it by itself once the
+    ring file's mtime changes.
+
+    :param checksums: sha256 of each file, keyed by file name, as returned by
+                      get_ring_file_checksums() on the leader.
+    :raises: RingFetchError if a file can't be fetched or doesn't match its
+             checksum (see fetch_files()), in which case nothing is moved
+             into place.
     """
     log('Fetching swift rings & builders from proxy @ {}.'.format(broker_url),
         level=DEBUG)
     target = SWIFT_CONF_DIR
     synced = []
-    tmpdir = tempfile.mkdtemp(prefix='swiftrings')
+    for server in ['account', 'object', 'container']:
+        if builders:
+            synced.append('{}.builder'.format(server))
+
+        if rings:
+            synced.append('{}.{}'.format(server, SWIFT_RING_EXT))
+
+    # Staged on the same filesystem as the target so that the renames are
+    # atomic.
+    tmpdir = tempfile.mkdtemp(prefix='.swiftrings', dir=target)
     try:
-        for server in ['account', 'object', 'container']:
-            if builders:
-                url = '{}/{}.builder'.format(broker_url, server)
-                log('Fetching {}.'.format(url), level=DEBUG)
-                builder = "{}.builder".format(server)
-                cmd = ['wget', url, '--retry-connrefused', '-t', '10', '-O',
-                       os.path.join(tmpdir, builder)]
-                subprocess.check_call(cmd)
-                synced.append(builder)
-
-            if rings:
-                url = '{}/{}.{}'.format(broker_url, server, SWIFT_RING_EXT)
-                log('Fetching {}.'.format(url), level=DEBUG)
-                ring = '{}.{}'.format(server, SWIFT_RING_EXT)
-                cmd = ['wget', url, '--retry-connrefused', '-t', '10', '-O',
-                       os.path.join(tmpdir, ring)]
-                subprocess.check_call(cmd)
-                synced.append(ring)
+        synced = fetch_changed_ring_files(broker_url, synced, tmpdir,
+                                          checksums=checksums)
 
         # Once all have been successfully downloaded, move them to actual
         # location.
@@ -857,6 +1388,111 @@ def sync_proxy_rings(broker_url, builders=True, rings=True):
         shutil.rmtree(tmpdir)
 
 
+def file_checksum(path):
+    """Return the sha256 of a file."""
+    sha = hashlib.sha256()
+    with open(path, 'rb') as fd:
+        for chunk in iter(lambda: fd.read(1024 * 1024), b''):
+            sha.update(chunk)
+
+    return sha.hexdigest()
+
+
+def cached_file_checksums(paths):
+    """Return the sha256 of each of paths that exists.
+
+    Checksums are cached in unitdata keyed by the (inode, size, mtime_ns) of
+    the file they were computed from, so a file is only read again once it
+    has changed. The inode alone isn't enough: rings are replaced by a
+    rename, but builders are rewritten in place (RingBuilder.save()).
+
+    :param paths: paths of the files
+    :type paths: Iterable[str]
+    :returns: checksums keyed by path
+    :rtype: Dict[str, str]
+    """
+    checksums = {}
+    db = None
+    cache = {}
+    changed = False
+    for path in paths:
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+
+        if db is None:
+            db = kv()
+            cache = db.get(FILE_CHECKSUMS_KEY) or {}
+
+        key = [st.st_ino, st.st_size, st.st_mtime_ns]
+        cached = cache.get(path)
+        if cached and cached[:3] == key:
+            checksums[path] = cached[3]
+            continue
+
+        checksums[path] = file_checksum(path)
+        cache[path] = key + [checksums[path]]
+        changed = True
+
+    if changed:
+        db.set(FILE_CHECKSUMS_KEY, cache)
+        db.flush()
+
+    return checksums
+
+
+def get_ring_file_checksums(builders=True, rings=True):
+    """Returns the sha256 of each ring and builder in /etc/swift.
+
+    :returns: checksums keyed by file name, e.g. {'object.ring.gz': <sha256>}
+    :rtype: Dict[str, str]
+    """
+    paths = []
+    for ring, builder in SWIFT_RINGS.items():
+        if builders:
+            paths.append(builder)
+
+        if rings:
+            paths.append(os.path.join(SWIFT_CONF_DIR, '{}.{}'
+                                      .format(ring, SWIFT_RING_EXT)))
+
+    return {os.path.basename(path): checksum
+            for path, checksum in cached_file_checksums(paths).items()}
+
+
+def ring_sync_stops_proxy():
+    """Determine whether peers stop swift-proxy while they sync rings.
+
+    :returns: True if ring-sync-mode is 'stop-proxy' or 'rolling'
+    :rtype: bool
+    """
+    return config('ring-sync-mode') in ('stop-proxy', 'rolling')
+
+
+def ring_sync_batch_size(num_peers):
+    """Return how many peers a rolling ring sync stops at once.
+
+    :param num_peers: number of peer units
+    :type num_peers: int
+    :returns: the ring-sync-batch-size, a number of units or a percentage of
+              num_peers, bounded to [1, num_peers]
+    :rtype: int
+    :raises: SwiftProxyCharmException if ring-sync-batch-size is invalid
+    """
+    value = str(config('ring-sync-batch-size') or 1).strip()
+    try:
+        if value.endswith('%'):
+            size = int(num_peers * float(value[:-1]) / 100)
+        else:
+            size = int(value)
+    except ValueError:
+        raise SwiftProxyCharmException(
+            "Invalid ring-sync-batch-size '{}'".format(value))
+
+    return max(1, min(size, num_peers))
+
+
 def ensure_www_dir_permissions(www_dir):
     if not os.path.isdir(www_dir):
         os.mkdir(www_dir, 0o755)
@@ -868,63 +1504,296 @@ def ensure_www_dir_permissions(www_dir):
 
 
 def update_www_rings(rings=True, builders=True):
-    """Copy rings to apache www dir.
-
-    Try to do this as atomically as possible to avoid races with storage nodes
-    syncing rings.
+    """Publish rings to apache www dir.
+
+    Each publication is an immutable generation directory, gen-<timestamp>,
+    in the www dir. Rings are hard linked from /etc/swift where possible,
+    since swift always replaces them by a rename, otherwise copied. Builders
+    are always copied: swift rewrites them in place (RingBuilder.save()), so
+    a link would change the published generations with the next rebalance.
+    The generation is complete before the 'current' symlink is flipped to it
+    atomically, and the files in the www dir itself are symlinks through
+    'current', so fetchers never see a missing or partial set. The manifest
+    names the generation directory, so a fetcher can get all of its files
+    from the same generation even if another one is published meanwhile.
+    The last published-ring-generations generations are kept. Builders are
+    also published gzip compressed (see compress_builder()).
     """
     if not (rings or builders):
         return
 
-    tmp_dir = tempfile.mkdtemp(prefix='swift-rings-www-tmp')
+    www_dir = get_www_dir()
+    tmp_dir = tempfile.mkdtemp(prefix='.gen-tmp', dir=www_dir)
     for ring, builder_path in SWIFT_RINGS.items():
         if rings:
             ringfile = '{}.{}'.format(ring, SWIFT_RING_EXT)
             src = os.path.join(SWIFT_CONF_DIR, ringfile)
-            dst = os.path.join(tmp_dir, ringfile)
-            shutil.copyfile(src, dst)
+            _link_or_copy(src, os.path.join(tmp_dir, ringfile))
 
         if builders:
-            src = builder_path
-            dst = os.path.join(tmp_dir, os.path.basename(builder_path))
-            shutil.copyfile(src, dst)
-
-    www_dir = get_www_dir()
-    deleted = "{}.deleted".format(www_dir)
+            shutil.copyfile(builder_path, os.path.join(
+                tmp_dir, os.path.basename(builder_path)))
+
+    previous = os.path.join(www_dir, RING_MANIFEST)
+    if builders:
+        for builder_path in SWIFT_RINGS.values():
+            compress_builder(os.path.join(
+                tmp_dir, os.path.basename(builder_path)), www_dir,
+                _read_ring_manifest(previous))
+
+    name = 'gen-{:.6f}'.format(time.time())
+    write_ring_manifest(tmp_dir, previous, location=name)
     ensure_www_dir_permissions(tmp_dir)
-    os.rename(www_dir, deleted)
-    os.rename(tmp_dir, www_dir)
-    shutil.rmtree(deleted)
+    os.rename(tmp_dir, os.path.join(www_dir, name))
+    _replace_with_symlink(name, os.path.join(www_dir, WWW_CURRENT))
+
+    files = os.listdir(os.path.join(www_dir, name))
+    for f in files:
+        _replace_with_symlink(os.path.join(WWW_CURRENT, f),
+                              os.path.join(www_dir, f))
+
+    # Drop anything left over from earlier publications, e.g. files that are
+    # no longer published and anything marked deleted.
+    generations = sorted((f for f in os.listdir(www_dir)
+                          if f.startswith('gen-')),
+                         key=lambda f: float(f[len('gen-'):]))
+    retain = max(1, config('published-ring-generations') or 1)
+    for f in os.listdir(www_dir):
+        path = os.path.join(www_dir, f)
+        if f in files or f == WWW_CURRENT or f in generations[-retain:]:
+            continue
+        elif os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
 
 
-def get_rings_checksum():
-    """Returns sha256 checksum for rings in /etc/swift."""
-    sha = hashlib.sha256()
-    for ring in SWIFT_RINGS.keys():
-        path = os.path.join(SWIFT_CONF_DIR, '{}.{}'
-                            .format(ring, SWIFT_RING_EXT))
-        if not os.path.isfile(path):
-            continue
+def _link_or_copy(src, dst):
+    """Hard link src to dst, or copy it if they're not on one filesystem."""
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
 
-        with open(path, 'rb') as fd:
-            sha.update(fd.read())
 
-    return sha.hexdigest()
+def _replace_with_symlink(target, path):
+    """Atomically replace path with a symlink to target."""
+    tmp_path = '{}.tmp'.format(path)
+    if os.path.lexists(tmp_path):
+        os.remove(tmp_path)
 
+    os.symlink(target, tmp_path)
+    os.rename(tmp_path, path)
 
-def get_builders_checksum():
-    """Returns sha256 checksum for builders in /etc/swift."""
-    sha = hashlib.sha256()
-    for builder in SWIFT_RINGS.values():
-        if not os.path.exists(builder):
+
+def write_ring_manifest(path, previous=None, location=None):
+    """Write a manifest of the rings and builders in a directory.
+
+    The manifest lets fetchers download only the files that differ from
+    theirs, and verify them:
+
+    {"generation": <generation>,
+     "path": <location>,
+     "files": {"<name>": {"sha256": <sha256>, "size": <bytes>,
+                          "generation": <generation it last changed in>}}}
+
+    :param path: directory holding the files; the manifest is written there
+    :type path: str
+    :param previous: path of the previously published manifest, so that
+                     files which haven't changed keep their generation
+    :type previous: Optional[str]
+    :param location: where the files are published, relative to the www dir
+    :type location: Optional[str]
+    """
+    old_files = _read_ring_manifest(previous).get('files', {})
+    generation = get_ring_generation()
+    files = {}
+    for name in sorted(os.listdir(path)):
+        if name == RING_MANIFEST:
             continue
 
-        with open(builder, 'rb') as fd:
-            sha.update(fd.read())
+        sha256 = file_checksum(os.path.join(path, name))
+        old = old_files.get(name, {})
+        files[name] = {'sha256': sha256,
+                       'size': os.path.getsize(os.path.join(path, name)),
+                       'generation': (old.get('generation', generation)
+                                      if old.get('sha256') == sha256
+                                      else generation)}
+
+    manifest = {'generation': generation, 'files': files}
+    if location:
+        manifest['path'] = location
+
+    with open(os.path.join(path, RING_MANIFEST), 'w') as fd:
+        json.dump(manifest, fd, sort_keys=True)
+
+
+def _file_matches(path, sha256, size=None):
+    """Whether a file exists with the given checksum (and size)."""
+    if not os.path.isfile(path):
+        return False
+
+    if size is not None and os.path.getsize(path) != size:
+        return False
+
+    return file_checksum(path) == sha256
+
+
+def _read_ring_manifest(path):
+    """Return the manifest at path, or {} if there is no valid one."""
+    if not path or not os.path.isfile(path):
+        return {}
+
+    try:
+        with open(path) as fd:
+            return json.load(fd)
+    except ValueError:
+        log("Ignoring invalid manifest {}".format(path), level=WARNING)
+        return {}
+
+
+def compress_builder(path, www_dir, previous):
+    """Publish a gzip compressed copy, <builder>.gz, of a published builder.
+
+    Builders are by far the largest files published and compress well. If
+    the builder is unchanged since the previous generation, that
+    generation's compressed copy is reused rather than compressing it again.
+
+    :param path: path of the builder in the generation directory
+    :type path: str
+    :param www_dir: the www dir
+    :type www_dir: str
+    :param previous: the manifest of the previous generation
+    :type previous: dict
+    """
+    name = os.path.basename(path)
+    old = previous.get('files', {}).get(name, {})
+    old_gz = os.path.join(www_dir, previous.get('path', ''),
+                          '{}.gz'.format(name))
+    if (previous.get('path') and old.get('sha256') == file_checksum(path) and
+            os.path.isfile(old_gz)):
+        _link_or_copy(old_gz, '{}.gz'.format(path))
+        return
+
+    # mtime=0 so that the same builder always compresses to the same bytes
+    with open(path, 'rb') as src, \
+            gzip.GzipFile('{}.gz'.format(path), 'wb', compresslevel=6,
+                          mtime=0) as dst:
+        shutil.copyfileobj(src, dst, FETCH_CHUNK_SIZE)
+
+
+def fetch_ring_manifest(base_url, staging_dir):
+    """Fetch the manifest published by a ring broker.
+
+    :param base_url: URL of the broker's www dir
+    :type base_url: str
+    :param staging_dir: directory to download it to
+    :type staging_dir: str
+    :returns: the manifest (see write_ring_manifest()), or None if the broker
+              doesn't publish one (or it can't be fetched)
+    :rtype: Optional[dict]
+    """
+    try:
+        fetch_files(base_url, [RING_MANIFEST], staging_dir, attempts=1)
+        with open(os.path.join(staging_dir, RING_MANIFEST)) as fd:
+            manifest = json.load(fd)
+    except (RingFetchError, ValueError) as exc:
+        log("No ring manifest from {} - fetching all files: {}"
+            .format(base_url, exc), level=DEBUG)
+        return None
+    finally:
+        path = os.path.join(staging_dir, RING_MANIFEST)
+        if os.path.exists(path):
+            os.remove(path)
+
+    return manifest
+
+
+def fetch_changed_ring_files(base_url, names, staging_dir, checksums=None):
+    """Fetch the ring and builder files that differ from those in /etc/swift.
+
+    Which files differ is decided from the checksums if given, otherwise from
+    the broker's manifest. Without either all of the files are fetched. The
+    fetched files are verified against the same checksums. If the manifest
+    names the generation directory the files are published in, they are all
+    fetched from there so that they belong together. Builders the manifest
+    lists a compressed copy of are fetched compressed.
+
+    A file that fails to download or verify is retried on its own, so a bad
+    transfer costs that file rather than the whole sync (see fetch_files()).
+
+    :param base_url: URL of the broker's www dir
+    :type base_url: str
+    :param names: names of the files wanted
+    :type names: List[str]
+    :param staging_dir: directory to download the files to
+    :type staging_dir: str
+    :param checksums: sha256 of each file, keyed by file name
+    :type checksums: Optional[Dict[str, str]]
+    :returns: names of the files fetched into staging_dir
+    :rtype: List[str]
+    :raises: RingFetchError if a file can't be fetched or doesn't match its
+             checksum
+    """
+    manifest = fetch_ring_manifest(base_url, staging_dir) or {}
+    sizes = {}
+    if not checksums:
+        files = manifest.get('files', {})
+        checksums = {name: f['sha256'] for name, f in files.items()}
+        sizes = {name: f['size'] for name, f in files.items()}
+
+    changed = [name for name in names
+               if name not in checksums or
+               not _file_matches(os.path.join(SWIFT_CONF_DIR, name),
+                                 checksums[name], sizes.get(name))]
+
+    unchanged = set(names) - set(changed)
+    if unchanged:
+        log("Already up to date: {}".format(', '.join(sorted(unchanged))),
+            level=DEBUG)
+
+    if changed:
+        if manifest.get('path'):
+            base_url = '{}/{}'.format(base_url.rstrip('/'), manifest['path'])
+
+        files = manifest.get('files', {})
+        compressed = [name for name in changed
+                      if name.endswith('.builder') and
+                      '{}.gz'.format(name) in files]
+        missing = [name for name in changed if name not in checksums]
+        if checksums and missing:
+            log("No checksum for {} - not verified".format(', '.join(missing)),
+                level=WARNING)
+
+        fetch_files(base_url, changed, staging_dir, compressed=compressed,
+                    checksums=checksums)
+
+    return changed
+
+
+def _combined_checksum(paths):
+    """Return a sha256 of the checksums of paths, in order."""
+    checksums = cached_file_checksums(paths)
+    sha = hashlib.sha256()
+    for path in paths:
+        if path in checksums:
+            sha.update(checksums[path].encode())
 
     return sha.hexdigest()
 
 
+def get_rings_checksum():
+    """Returns sha256 checksum for rings in /etc/swift."""
+    return _combined_checksum([
+        os.path.join(SWIFT_CONF_DIR, '{}.{}'.format(ring, SWIFT_RING_EXT))
+        for ring in SWIFT_RINGS.keys()])
+
+
+def get_builders_checksum():
+    """Returns sha256 checksum for builders in /etc/swift."""
+    return _combined_checksum(list(SWIFT_RINGS.values()))
+
+
 def non_null_unique(data):
     """Return True if data is a list containing all non-null values that are
     all equal.
@@ -948,169 +1817,742 @@ def previously_synced():
     return False
 
 
+class RingTransaction(object):
+    """The rings and builders as they were when a ring transaction started.
+
+    See ring_transaction().
+    """
+
+    def __init__(self, leader):
+        self.leader = leader
+        # ring operations run in the transaction; see
+        # sync_builders_and_rings_if_changed().
+        self.operations = 0
+        if leader:
+            self.rings = get_rings_checksum()
+            self.builders = get_builders_checksum()
+
+    def commit(self):
+        """Publish and sync the rings and builders if they have changed since
+        the transaction started.
+        """
+        rings_after = get_rings_checksum()
+        builders_after = get_builders_checksum()
+
+        rings_path = os.path.join(SWIFT_CONF_DIR, '*.{}'
+                                  .format(SWIFT_RING_EXT))
+        rings_ready = len(glob.glob(rings_path)) == len(SWIFT_RINGS)
+        rings_changed = ((rings_after != self.rings) or
+                         not previously_synced())
+        builders_changed = builders_after != self.builders
+        if rings_changed or builders_changed:
+            # Copy builders and rings (if available) to the server dir.
+            generation = publish_ring_generation()
+            update_www_rings(rings=rings_ready)
+            if rings_changed and rings_ready:
+                start_ring_convergence(generation, rings_after)
+                # Trigger sync
+                cluster_sync_rings(peers_only=not rings_changed)
+            else:
+                log("Rings not ready for sync - syncing builders",
+                    level=DEBUG)
+                cluster_sync_rings(peers_only=True, builders_only=True)
+        else:
+            log("Rings/builders unchanged - skipping sync", level=DEBUG)
+
+
+@contextlib.contextmanager
+def ring_transaction():
+    """Publish and sync ring and builder changes once, when the outermost
+    transaction ends.
+
+    The hooks run within a transaction, so however many rings are updated or
+    balanced by a hook, the rings are snapshotted once when it starts and
+    published to peers and storage units at most once when it ends, if any
+    ring operation ran (see sync_builders_and_rings_if_changed()). Nested
+    transactions join the outermost one. Changes are published even if the
+    transaction ends with an exception, as they are already on disk; if
+    publishing them fails too, the failure is logged and the original
+    exception is raised.
+
+    Only the leader publishes; on other units the transaction does nothing.
+
+    :returns: the transaction
+    :rtype: RingTransaction
+    """
+    global _RING_TRANSACTION
+    if _RING_TRANSACTION is not None:
+        yield _RING_TRANSACTION
+        return
+
+    transaction = _RING_TRANSACTION = RingTransaction(
+        is_elected_leader(SWIFT_HA_RES))
+    try:
+        yield transaction
+    except BaseException:
+        _RING_TRANSACTION = None
+        if transaction.leader and transaction.operations:
+            # keep the hook's own exception if publishing fails as well
+            try:
+                transaction.commit()
+            except Exception as exc:
+                log("Failed to publish ring changes after the hook failed: "
+                    "{}".format(exc), level=ERROR)
+        raise
+
+    _RING_TRANSACTION = None
+    if transaction.leader and transaction.operations:
+        transaction.commit()
+
+
 def sync_builders_and_rings_if_changed(f):
     """Only trigger a ring or builder sync if they have changed as a result of
     the decorated operation.
+
+    The operation runs in a ring transaction (see ring_transaction()), so
+    within a hook the sync happens once, when the hook ends. It is skipped on
+    non-leader units.
     """
     @functools.wraps(f)
     def _inner_sync_builders_and_rings_if_changed(*args, **kwargs):
-        if not is_elected_leader(SWIFT_HA_RES):
-            log("Sync rings called by non-leader - skipping", level=INFO)
-            return
-
-        try:
-            # Ensure we don't do a double sync if we are nested.
-            do_sync = False
-            if RING_SYNC_SEMAPHORE.acquire(blocking=0):
-                do_sync = True
-                rings_before = get_rings_checksum()
-                builders_before = get_builders_checksum()
-
-            ret = f(*args, **kwargs)
-
-            if not do_sync:
-                return ret
-
-            rings_after = get_rings_checksum()
-            builders_after = get_builders_checksum()
-
-            rings_path = os.path.join(SWIFT_CONF_DIR, '*.{}'
-                                      .format(SWIFT_RING_EXT))
-            rings_ready = len(glob.glob(rings_path)) == len(SWIFT_RINGS)
-            rings_changed = ((rings_after != rings_before) or
-                             not previously_synced())
-            builders_changed = builders_after != builders_before
-            if rings_changed or builders_changed:
-                # Copy builders and rings (if available) to the server dir.
-                update_www_rings(rings=rings_ready)
-                if rings_changed and rings_ready:
-                    # Trigger sync
-                    cluster_sync_rings(peers_only=not rings_changed)
-                else:
-                    log("Rings not ready for sync - syncing builders",
-                        level=DEBUG)
-                    cluster_sync_rings(peers_only=True, builders_only=True)
-            else:
-                log("Rings/builders unchanged - skipping sync", level=DEBUG)
+        with ring_transaction() as transaction:
+            if not transaction.leader:
+                log("Sync rings called by non-leader - skipping", level=INFO)
+                return
 
-            return ret
-        finally:
-            RING_SYNC_SEMAPHORE.release()
+            transaction.operations += 1
+            return f(*args, **kwargs)
 
     return _inner_sync_builders_and_rings_if_changed
 
 
 @sync_builders_and_rings_if_changed
-def update_rings(nodes=None, min_part_hours=None, replicas=None):
+def update_rings(nodes=None, min_part_hours=None, replicas=None,
+                 operations=None):
     """Update builder with node settings and balance rings if necessary.
 
     Also update min_part_hours if provided.
+
+    All of the changes to a ring are applied by a single call to
+    manager.py:apply_ring_operations() so that each builder is only loaded and
+    written once. The exception is min_part_hours, which is set on its own so
+    that failing to set it is only logged, and doesn't lose the other changes.
+
+    :param operations: additional set_weight and remove operations, keyed by
+        builder path, to apply before the others
+    :returns: whether the rings were rebalanced
     """
     if not is_elected_leader(SWIFT_HA_RES):
         log("Update rings called by non-leader - skipping", level=INFO)
-        return
+        return False
 
     balance_required = False
     rep_enabled = False
     if nodes is not None:
         rep_enabled = nodes_have_rep_data(nodes)
 
+    extra_operations = operations or {}
+    operations = OrderedDict((path, list(extra_operations.get(path, [])))
+                             for path in SWIFT_RINGS.values())
     if min_part_hours is not None:
         # NOTE: no need to stop the proxy since we are not changing the rings,
         # only the builder.
 
         # Only update if all exist
         if all(os.path.exists(p) for p in SWIFT_RINGS.values()):
-            for ring_path, path in SWIFT_RINGS.items():
-                current_min_part_hours = get_min_part_hours(path)
-                if min_part_hours != current_min_part_hours:
+            for path in SWIFT_RINGS.values():
+                if get_min_part_hours(path) == min_part_hours:
+                    continue
+
+                try:
+                    apply_ring_operations(path, [
+                        {'op': 'set_min_part_hours',
+                         'min_part_hours': min_part_hours}])
+                except SwiftProxyCharmException as exc:
+                    # TODO: ignore for now since this should not be critical
+                    # but in the future we should support a rollback.
+                    log(str(exc), level=WARNING)
+                else:
                     log("Setting ring {} min_part_hours to {}"
-                        .format(ring_path, min_part_hours), level=INFO)
-                    try:
-                        set_min_part_hours(path, min_part_hours)
-                    except SwiftProxyCharmException as exc:
-                        # TODO: ignore for now since this should not be
-                        # critical but in the future we should support a
-                        # rollback.
-                        log(str(exc), level=WARNING)
-                    else:
-                        balance_required = True
+                        .format(path, min_part_hours), level=INFO)
+                    balance_required = True
 
     log("Updading rings: nodes={}".format(nodes), level=DEBUG)
-    if nodes is not None:
-        for node in nodes:
-            for ring_path, path in SWIFT_RINGS.items():
-                if not exists_in_ring(path, node):
-                    add_to_ring(path, node)
-                    balance_required = True
+    if nodes:
+        for ring_name, path in SWIFT_RINGS.items():
+            ring_nodes = []
+            for node in nodes:
+                ring_node = dict(node, port=_ring_port(path, node))
                 if rep_enabled:
-                    update_ring_node_ports(ring_path, path, node)
+                    ring_node['port_rep'] = _ring_port_rep(path, node)
+                ring_nodes.append(ring_node)
+
+            found = missing_devices(path, ring_nodes)
+            for i in found['missing']:
+                operations[path].append({
+                    'op': 'add_dev',
+                    'dev': ring_device(path, nodes[i],
+                                       weight=initial_device_weight())})
+            if rep_enabled:
+                for i in found['update']:
+                    operations[path].append(
+                        node_ports_operation(ring_name, nodes[i]))
 
     if replicas is not None:
-        for ring_path, path in SWIFT_RINGS.items():
-            current_replicas = get_current_replicas(path)
-            if replicas != current_replicas:
-                update_replicas(path, replicas)
-                balance_required = True
+        for path in SWIFT_RINGS.values():
+            operations[path].append({'op': 'set_replicas',
+                                     'replicas': replicas})
 
     if rep_enabled:
         # Updates the ring with the builder contents even if re-balance is not
         # needed. That makes sure that ports and replication ports changes are
         # written into the ring. See Bug #1903762.
-        write_rings()
-
-    if balance_required:
-        balance_rings()
+        for path in SWIFT_RINGS.values():
+            operations[path].append({'op': 'write_ring'})
 
+    ramps = {}
+    for path, ops in operations.items():
+        if not ops:
+            continue
 
-def get_current_replicas(path):
+        log("Applying {} operation(s) to ring {}".format(len(ops), path),
+            level=DEBUG)
+        results = apply_ring_operations(path, ops)
+        for op, result in zip(ops, results):
+            if op['op'] == 'add_dev':
+                log('Added new device to ring {}: {}'.format(path, op['dev']),
+                    level=INFO)
+                if op['dev']['weight'] != DEFAULT_DEVICE_WEIGHT:
+                    ramps.setdefault(path, []).append(
+                        dict(op['dev'], id=result))
+                balance_required = True
+            elif op['op'] == 'set_replicas' and result:
+                log("Setting ring {} replicas to {}".format(path, replicas),
+                    level=INFO)
+                balance_required = True
+            elif op['op'] in ('set_weight', 'remove'):
+                log("Applied {} of {} to ring {}".format(
+                    op['op'], op['search_value'], path), level=INFO)
+                balance_required = True
+
+    for path, devs in ramps.items():
+        schedule_weight_ramps(path, devs, DEFAULT_DEVICE_WEIGHT,
+                              first_step=False)
+
+    if balance_required:
+        balance_rings()
+    return balance_required
+
+
+def ring_changes_deferred():
+    """Determine whether ring changes are queued rather than applied at once.
+
+    :returns: True if the ring-change-interval config option is set
+    :rtype: bool
+    """
+    return bool(config('ring-change-interval'))
+
+
+def queue_ring_change(change):
+    """Queue a ring change to be applied by flush_ring_changes().
+
+    The changes are stored in the leader's unitdata:
+
+    {'type': 'storage'}
+        reconcile the devices of all storage units
+    {'type': 'config', 'min_part_hours': <hours>, 'replicas': <replicas>}
+        apply the ring config
+    {'type': 'set-weight', 'ring': <ring>, 'search_value': <search value>,
+     'weight': <weight>, 'ramp': <bool>}
+        set (or ramp) the weight of devices; see ramp_weight_in_ring()
+    {'type': 'remove', 'ring': <ring>, 'search_value': <search value>,
+     'ramp': <bool>}
+        remove (or drain then remove) devices
+
+    :param change: the change
+    :type change: dict
+    """
+    db = kv()
+    queue = db.get(RING_CHANGES_KEY) or {'changes': []}
+    queue['changes'].append(change)
+    queue['last-change'] = time.time()
+    db.set(RING_CHANGES_KEY, queue)
+    db.flush()
+    log("Queued ring change {} ({} pending)"
+        .format(change, len(queue['changes'])), level=INFO)
+
+
+def get_ring_changes():
+    """Return the queued ring changes.
+
+    :returns: {'changes': [<change>, ...], 'last-change': <time>} or None
+    :rtype: Optional[dict]
+    """
+    return kv().get(RING_CHANGES_KEY)
+
+
+def flush_ring_changes(storage_nodes, force=False):
+    """Apply the queued ring changes once they are due.
+
+    The changes are due once ring-change-interval seconds have passed since
+    the last one was queued, or once ring-change-threshold of them are queued.
+    They are then applied together by a single update_rings(), so the rings
+    are rebalanced and synced at most once however many changes there were.
+
+    The changes are only dequeued once applied. Applying them is all or
+    nothing (see apply_ring_changes()), so if applying them together fails,
+    they are applied one at a time instead and any change that fails on its
+    own is dropped. If every one of them fails, the failure isn't down to the
+    changes, so they all stay queued to be retried.
+
+    :param storage_nodes: callable returning the nodes of all the storage
+        units, used if a storage change is queued
+    :type storage_nodes: Callable[[], List[dict]]
+    :param force: apply the changes even if they are not due yet
+    :type force: bool
+    :returns: whether the changes were applied
+    :rtype: bool
+    """
+    if not is_elected_leader(SWIFT_HA_RES):
+        log("Flush ring changes called by non-leader - skipping",
+            level=DEBUG)
+        return False
+
+    queue = get_ring_changes()
+    if not queue or not queue['changes']:
+        return False
+
+    changes = list(queue['changes'])
+    interval = config('ring-change-interval') or 0
+    threshold = config('ring-change-threshold') or 0
+    quiet = time.time() - queue['last-change'] >= interval
+    if not (force or quiet or (threshold and len(changes) >= threshold)):
+        log("Deferring {} queued ring change(s)".format(len(changes)),
+            level=DEBUG)
+        return False
+
+    log("Applying {} queued ring change(s)".format(len(changes)), level=INFO)
+    try:
+        apply_ring_changes(changes, storage_nodes)
+    except Exception as exc:
+        if len(changes) == 1:
+            log("Failed to apply queued ring change {}, keeping it queued: {}"
+                .format(changes[0], exc), level=ERROR)
+            raise
+
+        log("Failed to apply queued ring changes together, applying them one "
+            "at a time: {}".format(exc), level=WARNING)
+        failed = 0
+        for change in changes:
+            try:
+                apply_ring_changes([change], storage_nodes)
+            except Exception as change_exc:
+                log("Dropping queued ring change {} which failed: {}"
+                    .format(change, change_exc), level=ERROR)
+                failed += 1
+
+        if failed == len(changes):
+            log("Every queued ring change failed, keeping them queued",
+                level=ERROR)
+            raise
+
+    _dequeue_ring_changes(len(changes))
+    return True
+
+
+def _dequeue_ring_changes(count):
+    """Remove the first count queued ring changes, keeping any queued since.
+    """
+    db = kv()
+    queue = db.get(RING_CHANGES_KEY) or {'changes': []}
+    queue['changes'] = queue['changes'][count:]
+    if queue['changes']:
+        db.set(RING_CHANGES_KEY, queue)
+    else:
+        db.unset(RING_CHANGES_KEY)
+
+    db.flush()
+
+
+def apply_ring_changes(changes, storage_nodes):
+    """Apply ring changes, as queued by queue_ring_change(), together.
+
+    The changes are applied all or nothing: the first step of each ramp is
+    applied by the same update_rings() as the other changes, the ramps are
+    only tracked once that succeeded, and the builders and rings are restored
+    if it fails part way (see restore_rings_on_error()).
+
+    :param changes: the changes
+    :type changes: List[dict]
+    :param storage_nodes: callable returning the nodes of all the storage
+        units
+    :type storage_nodes: Callable[[], List[dict]]
+    """
+    nodes = None
+    update_kwargs = {}
+    operations = {}
+    ramps = []
+    for change in changes:
+        if change['type'] == 'storage':
+            nodes = True
+        elif change['type'] == 'config':
+            update_kwargs = {'min_part_hours': change['min_part_hours'],
+                             'replicas': change['replicas']}
+        elif change['type'] in ('set-weight', 'remove'):
+            path = SWIFT_RINGS[change['ring']]
+            remove = change['type'] == 'remove'
+            if change.get('ramp'):
+                ramps.append((path, find_ring_devices(path,
+                                                      change['search_value']),
+                              0 if remove else change['weight'], remove))
+            elif remove:
+                operations.setdefault(path, []).append(
+                    {'op': 'remove', 'search_value': change['search_value']})
+            else:
+                operations.setdefault(path, []).append(
+                    {'op': 'set_weight',
+                     'search_value': change['search_value'],
+                     'weight': float(change['weight'])})
+        else:
+            log("Ignoring unknown ring change {}".format(change),
+                level=WARNING)
+
+    for path, devs, weight, _ in ramps:
+        operations.setdefault(path, []).extend(
+            first_ramp_step(path, devs, weight))
+
+    if nodes:
+        nodes = storage_nodes()
+    with restore_rings_on_error():
+        update_rings(nodes, operations=operations, **update_kwargs)
+
+    # Only track the ramps once their first step is in the rings, so that
+    # advance_weight_ramps() doesn't step them if that failed.
+    for path, devs, weight, remove in ramps:
+        schedule_weight_ramps(path, devs, weight, remove=remove,
+                              first_step=False)
+
+
+@contextlib.contextmanager
+def restore_rings_on_error():
+    """Restore the builders and rings as they were if the block raises.
+
+    update_rings() writes one builder at a time, so without this a failure on
+    one ring would leave the changes to the rings before it in place.
+    """
+    paths = []
+    for ring, builder_path in SWIFT_RINGS.items():
+        paths.append(builder_path)
+        paths.append(os.path.join(SWIFT_CONF_DIR,
+                                  '{}.{}'.format(ring, SWIFT_RING_EXT)))
+
+    # In the conf dir so that the files can be renamed back into place.
+    tmp_dir = tempfile.mkdtemp(prefix='.rings-', dir=SWIFT_CONF_DIR)
+    try:
+        saved = {}
+        for path in paths:
+            if os.path.exists(path):
+                saved[path] = os.path.join(tmp_dir, os.path.basename(path))
+                shutil.copy2(path, saved[path])
+                st = os.stat(path)
+                os.chown(saved[path], st.st_uid, st.st_gid)
+
+        try:
+            yield
+        except Exception:
+            log("Restoring builders and rings after a failed update",
+                level=WARNING)
+            for path in paths:
+                if path in saved:
+                    os.rename(saved[path], path)
+                elif os.path.exists(path):
+                    os.remove(path)
+            raise
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def get_current_replicas(path):
     """ Gets replicas from the ring (lp1815879)
 
-    Proxy to the 'manager.py:get_current_replicas()' function
+    Answered from the ring index (see get_ring_index())
 
     :param path: path to the ring
     :type path: str
     :returns: replicas
     :rtype: int
     """
-    return get_manager().get_current_replicas(path)
+    return get_ring_index(path)['replicas']
 
 
 def get_min_part_hours(path):
-    """Just a proxy to the manager.py:get_min_part_hours() function
+    """Get the min_part_hours of a ring from the ring index
 
     :param path: the path to get the min_part_hours for
     :returns: integer
     """
-    return get_manager().get_min_part_hours(path)
+    return get_ring_index(path)['min_part_hours']
 
 
-def set_min_part_hours(path, value):
-    cmd = ['swift-ring-builder', path, 'set_min_part_hours', str(value)]
-    try:
-        subprocess.check_call(cmd)
-    except subprocess.CalledProcessError:
-        raise SwiftProxyCharmException(
-            "Failed to set min_part_hours={} on {}".format(value, path))
+def _ring_name(ring_path):
+    """Return the name (account, container or object) of a builder path."""
+    for name, path in SWIFT_RINGS.items():
+        if path == ring_path:
+            return name
+    raise SwiftProxyCharmException("Unknown ring {}".format(ring_path))
 
 
-def update_replicas(path, replicas):
-    """ Updates replicas (lp1815879)
+def initial_device_weight():
+    """Determine the weight that new devices are added to the rings with.
 
-    Updates the number of replicas in the ring.
+    :returns: the first step of the weight ramp if weight-ramp-step is set,
+        otherwise the full weight
+    :rtype: float
+    """
+    step = config('weight-ramp-step')
+    if step and step < DEFAULT_DEVICE_WEIGHT:
+        return step
+    return DEFAULT_DEVICE_WEIGHT
+
+
+def next_ramp_weight(weight, target, step):
+    """Return the next weight on the ramp from weight to target.
+
+    :param weight: the current weight
+    :type weight: float
+    :param target: the weight being ramped to
+    :type target: float
+    :param step: the maximum change in weight; 0 means no limit
+    :type step: float
+    :returns: the next weight
+    :rtype: float
+    """
+    if not step:
+        return target
+    if weight < target:
+        return min(weight + step, target)
+    return max(weight - step, target)
+
+
+def get_weight_ramps():
+    """Return the pending weight ramps.
+
+    The ramps are stored in the leader's unitdata, keyed by ring name:
+
+    {
+        <ring>: {
+            'last-step': <time the last step was applied>,
+            'devices': {
+                <device id>: {'ip': <ip>, 'device': <device>,
+                              'target': <weight>, 'remove': <bool>},
+            },
+        },
+    }
 
-    :param path: path to the ring
-    :param replicas: number of replicas
-    :type path: str
-    :type replicas: int
-    :raises: SwiftProxyCharmException
+    :returns: the ramps
+    :rtype: dict
+    """
+    return kv().get(WEIGHT_RAMPS_KEY) or {}
+
+
+def set_weight_ramps(ramps):
+    db = kv()
+    db.set(WEIGHT_RAMPS_KEY, ramps)
+    db.flush()
+
+
+def schedule_weight_ramps(ring_path, devs, target, remove=False,
+                          first_step=True):
+    """Ramp the weight of devices towards target, one step per rebalance.
+
+    Unless first_step is False, e.g. for new devices that were added with the
+    weight of the first step, the devices are given their first step straight
+    away.  The remaining steps are applied by advance_weight_ramps().
+
+    :param ring_path: path to the builder
+    :type ring_path: str
+    :param devs: the devices, with at least their id, ip, device and weight
+    :type devs: List[dict]
+    :param target: the weight to ramp the devices to
+    :type target: float
+    :param remove: whether to remove the devices from the ring once they
+        reach the target and have been drained by a rebalance
+    :type remove: bool
+    :param first_step: whether to apply the first step now
+    :type first_step: bool
+    """
+    ramps = get_weight_ramps()
+    ring = ramps.setdefault(_ring_name(ring_path), {'devices': {}})
+    for dev in devs:
+        ring['devices'][str(dev['id'])] = {'ip': dev['ip'],
+                                           'device': dev['device'],
+                                           'target': float(target),
+                                           'remove': remove}
+    if first_step:
+        operations = first_ramp_step(ring_path, devs, target)
+        if operations:
+            apply_ring_operations(ring_path, operations)
+    ring['last-step'] = time.time()
+    set_weight_ramps(ramps)
+
+
+def first_ramp_step(ring_path, devs, target):
+    """Return the operations of the first step of ramping devices to target.
+
+    :param ring_path: path to the builder
+    :type ring_path: str
+    :param devs: the devices, with at least their id, ip, device and weight
+    :type devs: List[dict]
+    :param target: the weight to ramp the devices to
+    :type target: float
+    :returns: the set_weight operations
+    :rtype: List[dict]
+    """
+    step = config('weight-ramp-step')
+    operations = []
+    for dev in devs:
+        weight = next_ramp_weight(dev['weight'], target, step)
+        if weight != dev['weight']:
+            operations.append({'op': 'set_weight',
+                               'search_value': 'd{}'.format(dev['id']),
+                               'weight': weight})
+            log("Ramping weight of d{} {}/{} in {} from {} to {} (target {})"
+                .format(dev['id'], dev['ip'], dev['device'], ring_path,
+                        dev['weight'], weight, target), level=INFO)
+    return operations
+
+
+def ramp_weight_in_ring(ring_path, search_value, weight, remove=False):
+    """Ramp the weight of the devices matching search_value in a ring.
+
+    :param ring_path: path to the builder
+    :type ring_path: str
+    :param search_value: swift-ring-builder search value
+    :type search_value: str
+    :param weight: the weight to ramp the devices to
+    :type weight: float
+    :param remove: whether to remove the devices once drained
+    :type remove: bool
+    :raises: SwiftProxyCharmException if no devices match
+    """
+    devs = find_ring_devices(ring_path, search_value)
+    schedule_weight_ramps(ring_path, devs, weight, remove=remove)
+
+
+def find_ring_devices(ring_path, search_value):
+    """Find the devices matching search_value in a ring.
+
+    :param ring_path: path to the builder
+    :type ring_path: str
+    :param search_value: swift-ring-builder search value
+    :type search_value: str
+    :returns: the devices
+    :rtype: List[dict]
+    :raises: SwiftProxyCharmException if no devices match
     """
-    cmd = ['swift-ring-builder', path, 'set_replicas', str(replicas)]
     try:
-        subprocess.check_call(cmd)
-    except subprocess.CalledProcessError:
+        return get_manager().search_devices(ring_path, search_value)
+    except RuntimeError as e:
         raise SwiftProxyCharmException(
-            "Failed to set replicas={} on {}".format(replicas, path))
+            "Failed to find devices for {} pattern on {}: {}"
+            .format(search_value, ring_path, str(e)))
+
+
+def get_weight_ramp_status():
+    """Report the progress of the pending weight ramps.
+
+    :returns: {<ring>: {'next-step': <time the next step is due>,
+                        'devices': [{'id', 'ip', 'device', 'weight',
+                                     'target', 'remove'}, ...]}}
+        where weight is None if the device is no longer in the ring
+    :rtype: dict
+    """
+    status = {}
+    for ring_name, ring in get_weight_ramps().items():
+        path = SWIFT_RINGS[ring_name]
+        devs = dict((dev['id'], dev) for dev in get_ring_index(path)['devs'])
+        status[ring_name] = {
+            'next-step': (ring.get('last-step', 0) +
+                          get_min_part_hours(path) * 3600),
+            'devices': [
+                dict(ramp, id=int(dev_id),
+                     weight=devs.get(int(dev_id), {}).get('weight'))
+                for dev_id, ramp in sorted(ring['devices'].items(),
+                                           key=lambda item: int(item[0]))],
+        }
+    return status
+
+
+def advance_weight_ramps():
+    """Apply the next step of each pending weight ramp and rebalance.
+
+    A ring's ramps are only stepped once its min_part_hours have passed since
+    the last step.  Devices being removed are removed the step after their
+    weight reaches zero, so that a rebalance has drained them first.
+    """
+    if not is_elected_leader(SWIFT_HA_RES):
+        log("Advance weight ramps called by non-leader - skipping",
+            level=DEBUG)
+        return
+
+    ramps = get_weight_ramps()
+    if not ramps or config('disable-ring-balance'):
+        return
+
+    step = config('weight-ramp-step')
+    stepped = False
+    now = time.time()
+    for ring_name, ring in list(ramps.items()):
+        path = SWIFT_RINGS[ring_name]
+        due = ring.get('last-step', 0) + get_min_part_hours(path) * 3600
+        if now < due:
+            log("Next weight ramp step for {} is due at {}"
+                .format(path, time.ctime(due)), level=DEBUG)
+            continue
+
+        devs = dict((dev['id'], dev) for dev in get_ring_index(path)['devs'])
+        operations = []
+        for dev_id, dev_ramp in list(ring['devices'].items()):
+            dev = devs.get(int(dev_id))
+            if (not dev or dev['ip'] != dev_ramp['ip'] or
+                    dev['device'] != dev_ramp['device']):
+                log("Device d{} {}/{} is no longer in {}, dropping its weight "
+                    "ramp".format(dev_id, dev_ramp['ip'], dev_ramp['device'],
+                                  path), level=WARNING)
+                del ring['devices'][dev_id]
+            elif dev['weight'] != dev_ramp['target']:
+                weight = next_ramp_weight(dev['weight'], dev_ramp['target'],
+                                          step)
+                log("Ramping weight of d{} {}/{} in {} from {} to {} "
+                    "(target {})".format(dev_id, dev['ip'], dev['device'],
+                                         path, dev['weight'], weight,
+                                         dev_ramp['target']), level=INFO)
+                operations.append({'op': 'set_weight',
+                                   'search_value': 'd{}'.format(dev_id),
+                                   'weight': weight})
+            elif dev_ramp['remove']:
+                log("Removing drained device d{} {}/{} from {}"
+                    .format(dev_id, dev['ip'], dev['device'], path),
+                    level=INFO)
+                operations.append({'op': 'remove',
+                                   'search_value': 'd{}'.format(dev_id)})
+                del ring['devices'][dev_id]
+            else:
+                log("Weight ramp of d{} {}/{} in {} is complete"
+                    .format(dev_id, dev['ip'], dev['device'], path),
+                    level=INFO)
+                del ring['devices'][dev_id]
+
+        if operations:
+            apply_ring_operations(path, operations)
+            ring['last-step'] = now
+            stepped = True
+        if not ring['devices']:
+            del ramps[ring_name]
+
+    set_weight_ramps(ramps)
+    if stepped:
+        balance_rings()
 
 
 @sync_builders_and_rings_if_changed
@@ -1146,10 +2588,31 @@ def balance_rings():
             level=INFO)
         return
 
+    paths = list(SWIFT_RINGS.values())
+    seeds = {}
+    if rebalance_budget_enabled():
+        # The same seeds for the preview and the rebalance, so that what is
+        # checked against the budget is what gets moved.
+        seeds = choose_rebalance_seeds(paths)
+    if not rebalance_within_budget(paths, seeds):
+        return
+
     rebalanced = False
     log("Rebalancing rings", level=INFO)
-    for path in SWIFT_RINGS.values():
-        if balance_ring(path):
+    if (config('rebalance-attempts') or 1) > 1:
+        # manager.py already spreads the attempts for each ring over several
+        # processes, and calls to it can't be made from more than one thread.
+        results = [balance_ring(path, seeds.get(path)) for path in paths]
+    else:
+        # Each rebalance is a separate swift-ring-builder process, so the
+        # rings are rebalanced concurrently.  Any error is raised once all
+        # have finished.
+        with ThreadPoolExecutor(max_workers=len(paths)) as executor:
+            results = list(executor.map(
+                balance_ring, paths, [seeds.get(path) for path in paths]))
+
+    for path, balanced in zip(paths, results):
+        if balanced:
             log('Balanced ring {}'.format(path), level=DEBUG)
             rebalanced = True
         else:
@@ -1172,7 +2635,7 @@ def mark_www_rings_deleted():
 
 
 def notify_peers_builders_available(broker_token, broker_timestamp,
-                                    builders_only=False):
+                                    builders_only=False, units=None):
     """Notify peer swift-proxy units that they should synchronise ring and
     builder files.
 
@@ -1180,6 +2643,7 @@ def notify_peers_builders_available(broker_token, broker_timestamp,
 
     @param broker_timestamp: timestamp for peer and storage sync - this MUST be
     the same as the one used for storage sync.
+    @param units: the peer units that should sync, all of them if None.
     """
     if not is_elected_leader(SWIFT_HA_RES):
         log("Ring availability peer broadcast requested by non-leader - "
@@ -1203,20 +2667,22 @@ def notify_peers_builders_available(broker_token, broker_timestamp,
     # Notify peers that builders are available
     log("Notifying peer(s) that {} are ready for sync."
         .format(_type), level=INFO)
-    rq = SwiftProxyClusterRPC().sync_rings_request(broker_token,
-                                                   broker_timestamp,
-                                                   builders_only=builders_only)
+    checksums = get_ring_file_checksums(rings=not builders_only)
+    rq = SwiftProxyClusterRPC().sync_rings_request(
+        broker_token, broker_timestamp, builders_only=builders_only,
+        checksums=checksums, generation=get_ring_generation(), units=units)
     for rid in cluster_rids:
         log("Notifying rid={} ({})".format(rid, rq), level=DEBUG)
         relation_set(relation_id=rid, relation_settings=rq)
 
 
 def broadcast_rings_available(storage=True, builders_only=False,
-                              broker_token=None):
+                              broker_token=None, units=None):
     """Notify storage relations and cluster (peer) relations that rings and
     builders are availble for sync.
 
-    We can opt to only notify peer or storage relations if needs be.
+    We can opt to only notify peer or storage relations if needs be, and to
+    only have some of the peer units sync.
     """
 
     # NOTE: this MUST be the same for peer and storage sync
@@ -1233,13 +2699,18 @@ def broadcast_rings_available(storage=True, builders_only=False,
     # units join
     notify_peers_builders_available(broker_token,
                                     broker_timestamp,
-                                    builders_only=builders_only)
+                                    builders_only=builders_only,
+                                    units=units)
 
 
 def cluster_sync_rings(peers_only=False, builders_only=False, token=None):
-    """Notify peer relations that they should stop their proxy services.
+    """Notify peer relations that rings are available for sync.
 
-    Peer units will then be expected to do a relation_set with
+    By default peers swap the new rings in while still serving (see
+    sync_proxy_rings()), so they are notified straight away.
+
+    With ring-sync-mode=stop-proxy peer relations are first told to stop their
+    proxy services. Peer units will then be expected to do a relation_set with
     stop-proxy-service-ack set rq value. Once all peers have responded, the
     leader will send out notification to all relations that rings are available
     for sync.
@@ -1268,6 +2739,16 @@ def cluster_sync_rings(peers_only=False, builders_only=False, token=None):
         broadcast_rings_available(storage=False, builders_only=True,
                                   broker_token=token)
         return
+    elif not ring_sync_stops_proxy():
+        if not token:
+            token = str(uuid.uuid4())
+
+        log("Notifying all peers that rings are available", level=INFO)
+        broadcast_rings_available(broker_token=token, storage=not peers_only)
+        return
+    elif config('ring-sync-mode') == 'rolling':
+        start_rolling_ring_sync(peers_only=peers_only, token=token)
+        return
 
     log("Sending stop proxy service request to all peers", level=INFO)
     rq = SwiftProxyClusterRPC().stop_proxy_request(peers_only, token=token)
@@ -1275,6 +2756,363 @@ def cluster_sync_rings(peers_only=False, builders_only=False, token=None):
         relation_set(relation_id=rid, relation_settings=rq)
 
 
+def get_ring_generation():
+    """Return the generation of the rings last published by the leader.
+
+    :returns: the generation, 0 if none has been published yet
+    :rtype: int
+    """
+    return int(leader_get(RING_GENERATION_KEY) or 0)
+
+
+def publish_ring_generation():
+    """Start a new generation of the rings and builders in the www dir.
+
+    NOTE: this action must only be performed by the cluster leader.
+
+    :returns: the new generation
+    :rtype: int
+    """
+    generation = get_ring_generation() + 1
+    leader_set({RING_GENERATION_KEY: generation})
+    log("Published ring generation {}".format(generation), level=INFO)
+    return generation
+
+
+def get_synced_ring_generation():
+    """Return the generation of the rings this (non-leader) unit has synced.
+
+    :returns: the generation, 0 if unknown
+    :rtype: int
+    """
+    return int(kv().get(SYNCED_RING_GENERATION_KEY) or 0)
+
+
+def set_synced_ring_generation(generation):
+    db = kv()
+    db.set(SYNCED_RING_GENERATION_KEY, int(generation))
+    db.flush()
+
+
+def request_resync_if_stale():
+    """Ask the leader for a resync if this unit's rings are out of date.
+
+    Peers keep serving with their current rings until the leader publishes a
+    new generation. If one was published but this unit has not synced it
+    (e.g. the download failed), a resync is requested, once per generation:
+    the generation requested is recorded, and no new request is made until
+    the leader publishes another one. Only done with ring-sync-mode=atomic,
+    since a resync request would interfere with a stop-proxy handshake in
+    progress.
+
+    NOTE: this action must not be performed by the cluster leader.
+
+    :returns: True if a resync was requested
+    :rtype: bool
+    """
+    if is_elected_leader(SWIFT_HA_RES) or ring_sync_stops_proxy():
+        return False
+
+    published = get_ring_generation()
+    synced = get_synced_ring_generation()
+    if published <= synced:
+        return False
+
+    db = kv()
+    if db.get(RESYNC_REQUESTED_GENERATION_KEY) == published:
+        log("Resync of ring generation {} already requested"
+            .format(published), level=DEBUG)
+        return False
+
+    log("Rings are at generation {} but the leader has published {} - "
+        "requesting resync".format(synced, published), level=WARNING)
+    rq = SwiftProxyClusterRPC().request_resync(
+        'generation-{}'.format(published))
+    for rid in relation_ids('cluster'):
+        relation_set(relation_id=rid, relation_settings=rq)
+
+    db.set(RESYNC_REQUESTED_GENERATION_KEY, published)
+    db.flush()
+    return True
+
+
+def start_ring_convergence(generation, checksum):
+    """Start tracking how long the units take to install new rings.
+
+    The leader keeps a convergence table in its unitdata:
+
+    {'generation': <generation>, 'checksum': <rings checksum>,
+     'started': <time>, 'synced': {<unit>: <time>}, 'pending': [<unit>],
+     'untracked': <count>, 'history': [<summary>, ...]}
+
+    Receivers echo the checksum of the rings they have installed: peers as
+    rings-checksum on the cluster relation, and storage and consumer units
+    as rings_checksum on theirs. Units that don't echo one (e.g. storage
+    units whose charm doesn't) are only counted as untracked. The table is
+    brought up to date by update_ring_convergence(). The summary of the
+    previous round, as returned by get_ring_convergence_status(), is kept in
+    the history.
+
+    NOTE: this action must only be performed by the cluster leader.
+
+    :param generation: the generation of the new rings
+    :type generation: int
+    :param checksum: the new rings checksum; see get_rings_checksum()
+    :type checksum: str
+    """
+    db = kv()
+    table = db.get(RING_CONVERGENCE_KEY)
+    history = []
+    if table:
+        history = (table.get('history', []) +
+                   [get_ring_convergence_status(table)])
+        history = history[-RING_CONVERGENCE_HISTORY:]
+
+    db.set(RING_CONVERGENCE_KEY, {'generation': generation,
+                                  'checksum': checksum,
+                                  'started': time.time(),
+                                  'synced': {},
+                                  'pending': [],
+                                  'untracked': 0,
+                                  'history': history})
+    db.flush()
+
+
+def _ring_receivers():
+    """Yield the unit and echoed rings checksum of each ring receiver."""
+    for relation, key in (('cluster', SwiftProxyClusterRPC.KEY_RINGS_CHECKSUM),
+                          ('swift-storage', 'rings_checksum'),
+                          ('rings-distributor', 'rings_checksum')):
+        for rid in relation_ids(relation):
+            for unit in related_units(rid):
+                settings = relation_get(rid=rid, unit=unit) or {}
+                yield unit, settings.get(key)
+
+
+def update_ring_convergence():
+    """Record the units that have installed the rings of the current round.
+
+    See start_ring_convergence().
+
+    NOTE: this action must only be performed by the cluster leader.
+
+    :returns: the updated table, None if no round has been started
+    :rtype: Optional[dict]
+    """
+    db = kv()
+    table = db.get(RING_CONVERGENCE_KEY)
+    if not table:
+        return None
+
+    now = time.time()
+    pending = []
+    untracked = 0
+    changed = False
+    for unit, checksum in _ring_receivers():
+        if checksum is None:
+            untracked += 1
+        elif unit in table['synced']:
+            continue
+        elif checksum == table['checksum']:
+            log("{} synced ring generation {} after {:.1f}s"
+                .format(unit, table['generation'], now - table['started']),
+                level=DEBUG)
+            table['synced'][unit] = now
+            changed = True
+        else:
+            pending.append(unit)
+
+    pending.sort()
+    if (changed or pending != table['pending'] or
+            untracked != table['untracked']):
+        table['pending'] = pending
+        table['untracked'] = untracked
+        db.set(RING_CONVERGENCE_KEY, table)
+        db.flush()
+
+    return table
+
+
+def get_ring_convergence_status(table=None):
+    """Summarise a ring convergence round.
+
+    :param table: the convergence table, the leader's current one by default
+    :type table: Optional[dict]
+    :returns: {'generation', 'started', 'units', 'synced', 'untracked',
+               'lag': {<unit>: <seconds to sync>},
+               'stragglers': {<unit>: <seconds waited so far>},
+               'converged-50', 'converged-90', 'converged-100': <seconds
+               until that percentage of the units had synced, or None>},
+              or None if no round has been started
+    :rtype: Optional[dict]
+    """
+    if table is None:
+        table = kv().get(RING_CONVERGENCE_KEY)
+    if not table:
+        return None
+
+    started = table['started']
+    lag = {unit: t - started for unit, t in table['synced'].items()}
+    units = len(lag) + len(table['pending'])
+    status = {'generation': table['generation'],
+              'started': started,
+              'units': units,
+              'synced': len(lag),
+              'untracked': table['untracked'],
+              'lag': lag,
+              'stragglers': {unit: time.time() - started
+                             for unit in table['pending']}}
+    times = sorted(lag.values())
+    for percent in (50, 90, 100):
+        # the number of units that makes up the percentage, rounded up
+        needed = -(-units * percent // 100)
+        status['converged-{}'.format(percent)] = (
+            times[needed - 1] if units and len(times) >= needed else None)
+
+    return status
+
+
+def get_ring_convergence_history():
+    """Return the summaries of the previous convergence rounds, oldest first.
+
+    :returns: see get_ring_convergence_status()
+    :rtype: List[dict]
+    """
+    return (kv().get(RING_CONVERGENCE_KEY) or {}).get('history', [])
+
+
+def get_rolling_ring_sync():
+    """Return the rolling ring sync in progress, if any.
+
+    :returns: {'token': <token>, 'peers-only': <bool>,
+               'storage-notified': <bool>, 'batch-size': <units>,
+               'batch': [<unit>, ...], 'pending': [<unit>, ...],
+               'stopped': <bool>} or None
+    :rtype: Optional[dict]
+    """
+    return kv().get(ROLLING_RING_SYNC_KEY)
+
+
+def _set_rolling_ring_sync(sync):
+    db = kv()
+    if sync:
+        db.set(ROLLING_RING_SYNC_KEY, sync)
+    else:
+        db.unset(ROLLING_RING_SYNC_KEY)
+
+    db.flush()
+
+
+def start_rolling_ring_sync(peers_only=False, token=None):
+    """Sync peers in batches of ring-sync-batch-size units.
+
+    Each batch is asked to stop its proxy service, is told that rings are
+    available once all of it has acked, and the next batch is only stopped
+    once all of it has synced and restarted (see advance_rolling_ring_sync()).
+    Both requests name the units of the batch, and the rest of the peers
+    ignore them and keep serving meanwhile. Once the last batch has synced,
+    rings are announced to every peer again, for peers that join later. A
+    sync already in progress is restarted from the first batch.
+
+    NOTE: this action must only be performed by the cluster leader.
+
+    :param peers_only: If True, storage units are not notified.
+    :type peers_only: bool
+    :param token: optional sync token. If not provided, a new one is
+                  generated.
+    :type token: Optional[str]
+    """
+    units = sorted(peer_units(), key=lambda u: int(u.split('/')[1]))
+    sync = {'token': token or str(uuid.uuid4()),
+            'peers-only': bool(peers_only),
+            'storage-notified': bool(peers_only),
+            'batch-size': ring_sync_batch_size(len(units)),
+            'batch': [],
+            'pending': units}
+    log("Starting rolling ring sync of {} peer(s), {} at a time"
+        .format(len(units), sync['batch-size']), level=INFO)
+    _next_rolling_ring_sync_batch(sync)
+
+
+def _next_rolling_ring_sync_batch(sync):
+    """Ask the next batch of a rolling ring sync to stop its proxy service."""
+    if not sync['pending']:
+        log("Rolling ring sync complete (token={})".format(sync['token']),
+            level=INFO)
+        _set_rolling_ring_sync(None)
+        # Lift the batch restriction so that peers joining later can sync.
+        # Every current peer already has these rings and skips the download.
+        broadcast_rings_available(broker_token=sync['token'], storage=False)
+        return
+
+    size = sync['batch-size']
+    sync['batch'] = sync['pending'][:size]
+    sync['pending'] = sync['pending'][size:]
+    sync['stopped'] = False
+    _set_rolling_ring_sync(sync)
+    log("Sending stop proxy service request to {}"
+        .format(', '.join(sync['batch'])), level=INFO)
+    rq = SwiftProxyClusterRPC().stop_proxy_request(sync['peers-only'],
+                                                   token=sync['token'],
+                                                   units=sync['batch'])
+    for rid in relation_ids('cluster'):
+        relation_set(relation_id=rid, relation_settings=rq)
+
+
+def advance_rolling_ring_sync():
+    """Move the rolling ring sync in progress on, if its batch is ready.
+
+    Once every unit of the current batch has acked the stop request, it is
+    told that rings are available. Once every unit of it has acked the sync
+    (after restarting its proxy service), the next batch is stopped. Units
+    that have left the cluster are dropped from the batch.
+
+    NOTE: this action must only be performed by the cluster leader.
+
+    :returns: True if a rolling ring sync is in progress
+    :rtype: bool
+    """
+    sync = get_rolling_ring_sync()
+    if not sync:
+        return False
+
+    responses = {}
+    for rid in relation_ids('cluster'):
+        for unit in related_units(rid):
+            responses[unit] = relation_get(rid=rid, unit=unit) or {}
+
+    batch = [u for u in sync['batch'] if u in responses]
+    sync['pending'] = [u for u in sync['pending'] if u in responses]
+    token = sync['token']
+    if not sync['stopped']:
+        key = SwiftProxyClusterRPC.KEY_STOP_PROXY_SVC_ACK
+        waiting = [u for u in batch if responses[u].get(key) != token]
+        if waiting:
+            log("Waiting for {} to stop their proxy service"
+                .format(', '.join(waiting)), level=DEBUG)
+            return True
+
+        log("Syncing rings and builders to {}".format(', '.join(batch)),
+            level=INFO)
+        sync['stopped'] = True
+        storage = not sync['storage-notified']
+        sync['storage-notified'] = True
+        _set_rolling_ring_sync(sync)
+        broadcast_rings_available(broker_token=token, storage=storage,
+                                  units=batch)
+        return True
+
+    key = SwiftProxyClusterRPC.KEY_RING_SYNC_ACK
+    waiting = [u for u in batch if responses[u].get(key) != token]
+    if waiting:
+        log("Waiting for {} to sync rings".format(', '.join(waiting)),
+            level=DEBUG)
+        return True
+
+    _next_rolling_ring_sync_batch(sync)
+    return True
+
+
 def notify_storage_and_consumers_rings_available(broker_timestamp):
     """Notify peer swift-storage relations that they should synchronise ring
     and builder files.
@@ -1289,10 +3127,10 @@ def notify_storage_and_consumers_rings_available(broker_timestamp):
             "non-leader - skipping", level=INFO)
         return
 
-    hostname = get_hostaddr()
-    hostname = format_ipv6_addr(hostname) or hostname
-    path = os.path.basename(get_www_dir())
-    rings_url = 'http://{}/{}'.format(hostname, path)
+    rings_url = get_rings_url()
+    # Peers only become mirrors once they have synced these rings; see
+    # update_rings_mirrors().
+    rings_mirrors = json.dumps(get_rings_mirrors())
 
     # TODO(hopem): consider getting rid of this trigger since the timestamp
     #              should do the job.
@@ -1303,15 +3141,115 @@ def notify_storage_and_consumers_rings_available(broker_timestamp):
         level=INFO)
     for relid in relation_ids('swift-storage'):
         relation_set(relation_id=relid, swift_hash=get_swift_hash(),
-                     rings_url=rings_url, broker_timestamp=broker_timestamp,
-                     trigger=trigger)
+                     rings_url=rings_url, rings_mirrors=rings_mirrors,
+                     broker_timestamp=broker_timestamp, trigger=trigger)
     # Notify consumer proxy nodes that there is a new ring to fetch.
     log("Notifying consumer proxy nodes (if any) that new rings are ready for "
         "sync.", level=INFO)
     for relid in relation_ids('rings-distributor'):
         relation_set(relation_id=relid, swift_hash=get_swift_hash(),
-                     rings_url=rings_url, broker_timestamp=broker_timestamp,
-                     trigger=trigger)
+                     rings_url=rings_url, rings_mirrors=rings_mirrors,
+                     broker_timestamp=broker_timestamp, trigger=trigger)
+
+
+def get_rings_url():
+    """Return the URL this unit serves rings and builders from.
+
+    :returns: the URL of the www dir
+    :rtype: str
+    """
+    hostname = get_hostaddr()
+    hostname = format_ipv6_addr(hostname) or hostname
+    path = os.path.basename(get_www_dir())
+    return 'http://{}/{}'.format(hostname, path)
+
+
+def get_rings_mirrors():
+    """Return the URLs the current rings can be fetched from.
+
+    These are the leader's followed by those of the peers that have synced
+    and published the same rings (see publish_synced_rings()), as told by the
+    rings checksum in their ring sync ack.
+
+    NOTE: this action must only be performed by the cluster leader.
+
+    :returns: URLs of www dirs
+    :rtype: List[str]
+    """
+    mirrors = [get_rings_url()]
+    checksum = get_rings_checksum()
+    for rid in relation_ids('cluster'):
+        for unit in sorted(related_units(rid)):
+            settings = relation_get(rid=rid, unit=unit) or {}
+            url = settings.get(SwiftProxyClusterRPC.KEY_RINGS_URL)
+            if (url and settings.get(
+                    SwiftProxyClusterRPC.KEY_RINGS_CHECKSUM) == checksum):
+                mirrors.append(url)
+
+    return mirrors
+
+
+def update_rings_mirrors():
+    """Update the mirrors told to storage and consumer units, e.g. once a peer
+    has synced the current rings.
+
+    Only relations that have already been told rings are available are
+    updated.
+
+    NOTE: this action must only be performed by the cluster leader.
+    """
+    rings_mirrors = None
+    for relid in (relation_ids('swift-storage') +
+                  relation_ids('rings-distributor')):
+        settings = relation_get(rid=relid, unit=local_unit()) or {}
+        if not settings.get('rings_url'):
+            continue
+
+        if rings_mirrors is None:
+            rings_mirrors = json.dumps(get_rings_mirrors())
+
+        if settings.get('rings_mirrors') != rings_mirrors:
+            log("Ring mirrors for {}: {}".format(relid, rings_mirrors),
+                level=DEBUG)
+            relation_set(relation_id=relid, rings_mirrors=rings_mirrors)
+
+
+def order_rings_mirrors(mirrors, unit=None):
+    """Order ring mirrors for a unit to try in turn.
+
+    Each unit starts with a different mirror, picked by hashing its name, so
+    that units spread their fetches across the mirrors rather than all
+    fetching from the leader.
+
+    :param mirrors: URLs of the mirrors, as published by the leader
+    :type mirrors: List[str]
+    :param unit: the unit name, this unit by default
+    :type unit: str
+    :returns: the mirrors, starting with this unit's
+    :rtype: List[str]
+    """
+    if not mirrors:
+        return []
+
+    start = zlib.crc32((unit or local_unit()).encode()) % len(mirrors)
+    return mirrors[start:] + mirrors[:start]
+
+
+def publish_synced_rings():
+    """Publish the rings and builders synced from the leader in this unit's
+    www dir, if they aren't already, so that this unit can serve them as a
+    mirror.
+    """
+    www_dir = get_www_dir()
+    manifest = _read_ring_manifest(os.path.join(www_dir, RING_MANIFEST))
+    checksums = get_ring_file_checksums()
+    published = {name: f.get('sha256')
+                 for name, f in manifest.get('files', {}).items()
+                 if name in checksums and
+                 os.path.exists(os.path.join(www_dir, name))}
+    if published != checksums:
+        log("Publishing synced rings for mirroring", level=DEBUG)
+        update_www_rings()
 
 
 def clear_storage_rings_available():
@@ -1407,37 +3345,164 @@ JSON_ENCODE_OPTIONS = dict(
 )
 
 
+MANAGER_SCRIPT = os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                              '..',
+                                              'swift_manager',
+                                              'manager.py'))
+
+# The manager worker for the current hook; see get_manager_worker().
+_MANAGER_WORKER = None
+
+
+def _manager_python():
+    """Determine the python interpreter that can import the installed swift.
+
+    :returns: the interpreter name
+    :rtype: str
+    """
+    cmp_openstack = CompareOpenStackReleases(os_release('swift'))
+    if cmp_openstack >= 'train':
+        return 'python3'
+    return 'python2'
+
+
+def _manager_in_process():
+    """Determine whether manager calls can be made within this interpreter.
+
+    This is the case when the installed release needs python3, which the charm
+    is running under, and swift can be imported by it.  Otherwise calls go to
+    a manager.py worker; see get_manager_worker().
+
+    :returns: True if manager calls can be made in process
+    :rtype: bool
+    """
+    if sys.version_info[0] < 3 or _manager_python() != 'python3':
+        return False
+    return importlib.util.find_spec('swift') is not None
+
+
+def _call_manager_in_process(serialized):
+    """Make a json encoded call to manager.py within this interpreter.
+
+    The call and its result go through the same json encoding as calls to the
+    worker, so that both return exactly the same structures.
+
+    :param serialized: the json encoded call
+    :type serialized: str
+    :returns: the decoded result structure
+    :rtype: dict
+    """
+    result = swift_manager._dispatch(json.loads(serialized))
+    return json.loads(json.dumps(result, **JSON_ENCODE_OPTIONS))
+
+
+class ManagerWorker(object):
+    """A long-lived manager.py process that serves calls over a pipe.
+
+    The worker is started with the '--worker' argument and is sent one json
+    encoded call per line on its STDIN, replying with one json encoded result
+    per line on its STDOUT.  Its STDERR is inherited so that any tracebacks end
+    up in the hook log.
+    """
+
+    def __init__(self, python):
+        self.python = python
+        self._process = None
+
+    @property
+    def running(self):
+        return self._process is not None and self._process.poll() is None
+
+    def start(self):
+        if self.running:
+            return
+        self._process = subprocess.Popen(
+            [self.python, MANAGER_SCRIPT, '--worker'],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            env=os.environ,
+            universal_newlines=True)
+
+    def stop(self):
+        if self._process is None:
+            return
+        process, self._process = self._process, None
+        try:
+            process.stdin.close()
+            process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+        finally:
+            process.stdout.close()
+
+    def call(self, serialized):
+        """Send a json encoded call to the worker and return the decoded reply.
+
+        :param serialized: the json encoded call
+        :type serialized: str
+        :returns: the decoded result structure
+        :rtype: dict
+        :raises: SwiftProxyCharmException if the worker has gone away
+        """
+        self.start()
+        try:
+            self._process.stdin.write(serialized + '\n')
+            self._process.stdin.flush()
+            line = self._process.stdout.readline()
+        except (IOError, OSError) as e:
+            self.stop()
+            raise SwiftProxyCharmException(
+                "manager.py worker pipe failed: {}".format(str(e)))
+        if not line:
+            returncode = self._process.poll()
+            self.stop()
+            raise SwiftProxyCharmException(
+                "manager.py worker exited unexpectedly (returncode={})"
+                .format(returncode))
+        return json.loads(line)
+
+
+def get_manager_worker():
+    """Return the manager worker for this hook, starting it if necessary.
+
+    A new worker is started if the interpreter required by the installed
+    release has changed since the worker was started (e.g. following an
+    upgrade).
+
+    :returns: the worker
+    :rtype: ManagerWorker
+    """
+    global _MANAGER_WORKER
+    python = _manager_python()
+    if _MANAGER_WORKER is not None and _MANAGER_WORKER.python != python:
+        stop_manager_worker()
+    if _MANAGER_WORKER is None:
+        _MANAGER_WORKER = ManagerWorker(python)
+    return _MANAGER_WORKER
+
+
+def stop_manager_worker():
+    """Stop the manager worker, if any, for this hook."""
+    global _MANAGER_WORKER
+    if _MANAGER_WORKER is not None:
+        _MANAGER_WORKER.stop()
+        _MANAGER_WORKER = None
+
+
+atexit.register(stop_manager_worker)
+
+
 def _proxy_manager_call(path, args, kwargs):
     package = dict(path=path,
                    args=args,
                    kwargs=kwargs)
     serialized = json.dumps(package, **JSON_ENCODE_OPTIONS)
-    cmp_openstack = CompareOpenStackReleases(os_release('swift'))
-    if cmp_openstack >= 'train':
-        python = 'python3'
-    else:
-        python = 'python2'
-    script = os.path.abspath(os.path.join(os.path.dirname(__file__),
-                                          '..',
-                                          'swift_manager',
-                                          'manager.py'))
-    env = os.environ
     try:
-        if sys.version_info < (3, 5):
-            # remove this after trusty support is removed.  No subprocess.run
-            # in Python 3.4
-            process = subprocess.Popen([python, script, serialized],
-                                       stdout=subprocess.PIPE,
-                                       stderr=subprocess.PIPE,
-                                       env=env)
-            out, err = process.communicate()
-            result = json.loads(out.decode('UTF-8'))
+        if _manager_in_process():
+            result = _call_manager_in_process(serialized)
         else:
-            completed = subprocess.run([python, script, serialized],
-                                       stdout=subprocess.PIPE,
-                                       stderr=subprocess.PIPE,
-                                       env=env)
-            result = json.loads(completed.stdout.decode('UTF-8'))
+            result = get_manager_worker().call(serialized)
         if 'error' in result:
             s = ("The call within manager.py failed with the error: '{}'. "
                  "The call was: path={}, args={}, kwargs={}"
@@ -1445,18 +3510,13 @@ def _proxy_manager_call(path, args, kwargs):
             log(s, level=ERROR)
             raise RuntimeError(s)
         return result['result']
-    except subprocess.CalledProcessError as e:
+    except SwiftProxyCharmException as e:
         s = ("manger.py failed when called with path={}, args={}, kwargs={},"
              " with the error: {}".format(path, args, kwargs, str(e)))
         log(s, level=ERROR)
-        if sys.version_info < (3, 5):
-            # remove this after trusty support is removed.
-            log("stderr was:\n{}\n".format(err.decode('UTF-8')),
-                level=ERROR)
-        else:
-            log("stderr was:\n{}\n".format(completed.stderr.decode('UTF-8')),
-                level=ERROR)
         raise RuntimeError(s)
+    except RuntimeError:
+        raise
     except Exception as e:
         s = ("Decoding the result from the call to manager.py resulted in "
              "error '{}' (command: path={}, args={}, kwargs={}"
@@ -1502,21 +3562,41 @@ def customer_check_assess_status(configs):
                             'Did not get IPv6 address from '
                             'storage relation (got={})'.format(addr))
 
+    if is_leader():
+        status = get_ring_convergence_status()
+        if status and status['synced'] < status['units']:
+            return ('active', 'Unit is ready (ring generation {}: {}/{} units '
+                    'synced)'.format(status['generation'], status['synced'],
+                                     status['units']))
+
     return 'active', 'Unit is ready'
 
 
 def has_minimum_zones(rings):
     """Determine if enough zones exist to satisfy minimum replicas
 
-    Uses manager.py as it accesses the ring_builder object in swift
+    Answered from the ring indexes (see get_ring_index()) so that the builders
+    don't need to be loaded.
 
     :param rings: the list of ring_paths to check
     :returns: Boolean
     """
-    result = get_manager().has_minimum_zones(rings)
-    if 'log' in result:
-        log(result['log'], level=result['level'])
-    return result['result']
+    for ring in rings:
+        if not os.path.isfile(ring):
+            return False
+        index = get_ring_index(ring)
+        if not index['devs']:
+            return False
+        replicas = index['replicas']
+        num_zones = len(index['zones'])
+        num_zones_in_regions = len(index['regions']) * num_zones
+        if num_zones_in_regions < replicas:
+            log("Not enough zones ({}) defined to satisfy minimum "
+                "replicas (need >= {})".format(num_zones, int(replicas)),
+                level=INFO)
+            return False
+
+    return True
 
 
 def assess_status(configs, check_services=None):
@@ -1593,21 +3673,16 @@ def fetch_swift_rings_and_builders(rings_url):
 
     :param rings_url: URL to the rings store
     :type rings_url: str
+    :raises: RingFetchError if a file can't be fetched
     """
     log('Fetching swift rings from proxy @ {}.'.format(rings_url), level=INFO)
     target = SWIFT_CONF_DIR
-    tmpdir = tempfile.mkdtemp(prefix='swiftrings')
+    synced = ['{}.{}'.format(server, ext)
+              for server in ['account', 'object', 'container']
+              for ext in [SWIFT_RING_EXT, 'builder']]
+    tmpdir = tempfile.mkdtemp(prefix='.swiftrings', dir=target)
     try:
-        synced = []
-        for server in ['account', 'object', 'container']:
-            for ext in [SWIFT_RING_EXT, 'builder']:
-                url = '{}/{}.{}'.format(rings_url, server, ext)
-                log('Fetching {}.'.format(url), level=DEBUG)
-                ring = '{}.{}'.format(server, ext)
-                cmd = ['wget', url, '--retry-connrefused', '-t', '10', '-O',
-                       os.path.join(tmpdir, ring)]
-                subprocess.check_call(cmd)
-                synced.append(ring)
+        synced = fetch_changed_ring_files(rings_url, synced, tmpdir)
 
         # Once all have been successfully downloaded, move them to actual
         # location.
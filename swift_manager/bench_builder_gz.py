@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+#
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compare publishing a builder raw and gzip compressed.
+
+Needs swift installed.  Either pass an existing builder with --builder or one
+is created from the other options.  Reports the size of both, the time taken
+to compress and decompress the builder as update_www_rings() and
+fetch_files() do, and the transfer time at a few link speeds:
+
+    python3 swift_manager/bench_builder_gz.py --part-power 20 --devices 600
+"""
+
+from __future__ import print_function
+
+import argparse
+import gzip
+import os
+import shutil
+import tempfile
+import time
+import zlib
+
+from bench_load_builder import create_builder
+
+CHUNK_SIZE = 64 * 1024
+# link speeds in Mbit/s
+LINKS = [100, 1000, 10000]
+
+
+def compress(path):
+    with open(path, 'rb') as src, \
+            gzip.GzipFile(path + '.gz', 'wb', compresslevel=6,
+                          mtime=0) as dst:
+        shutil.copyfileobj(src, dst, CHUNK_SIZE)
+
+
+def decompress(path, target):
+    gunzip = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    with open(path, 'rb') as src, open(target, 'wb') as dst:
+        for chunk in iter(lambda: src.read(CHUNK_SIZE), b''):
+            dst.write(gunzip.decompress(chunk))
+        dst.write(gunzip.flush())
+
+
+def timed(func, *args):
+    start = time.time()
+    func(*args)
+    return time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--part-power', type=int, default=18)
+    parser.add_argument('--replicas', type=int, default=3)
+    parser.add_argument('--devices', type=int, default=300)
+    parser.add_argument('--builder', help='existing builder to compress')
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpdir, 'object.builder')
+        if args.builder:
+            shutil.copy(args.builder, path)
+        else:
+            create_builder(path, args.part_power, args.replicas, args.devices)
+
+        compress_time = timed(compress, path)
+        decompress_time = timed(decompress, path + '.gz', path + '.out')
+        raw = os.path.getsize(path)
+        gz = os.path.getsize(path + '.gz')
+        mb = 1024.0 * 1024
+        print('builder: {:.1f} MB, compressed {:.1f} MB ({:.1f}x)'.format(
+            raw / mb, gz / mb, float(raw) / gz))
+        print('compress {:.2f}s, decompress {:.2f}s'.format(
+            compress_time, decompress_time))
+        for link in LINKS:
+            print('{:>6} Mbit/s: raw {:6.2f}s, compressed {:6.2f}s'.format(
+                link, raw * 8.0 / (link * 1e6),
+                gz * 8.0 / (link * 1e6) + decompress_time))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
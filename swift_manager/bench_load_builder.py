@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+#
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compare the peak RSS of loading a builder fully and read-only.
+
+Needs swift installed.  Either pass an existing builder with --builder or one
+is created from the other options.  Each load runs in a fresh interpreter so
+that the peaks don't mask each other:
+
+    python3 swift_manager/bench_load_builder.py --part-power 20 --devices 600
+"""
+
+from __future__ import print_function
+
+import argparse
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def create_builder(path, part_power, replicas, devices):
+    from swift.common.ring import RingBuilder
+    builder = RingBuilder(part_power, replicas, 1)
+    for i in range(devices):
+        builder.add_dev({'region': 1, 'zone': i % 3 + 1,
+                         'ip': '10.0.{}.{}'.format(i // 250, i % 250 + 1),
+                         'port': 6002, 'device': 'sdb', 'weight': 100,
+                         'meta': ''})
+    builder.rebalance()
+    builder.save(path)
+
+
+def peak_rss():
+    # ru_maxrss survives fork and exec, so it may be the parent's peak
+    with open('/proc/self/status') as status:
+        for line in status:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1]) // 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024
+
+
+def measure(path, read_only):
+    sys.path.insert(0, HERE)
+    import manager
+    start = time.time()
+    builder = manager._load_builder(path, read_only=read_only)
+    devs = len([d for d in builder.to_dict()['devs'] if d])
+    elapsed = time.time() - start
+    print('{} {:.2f} {}'.format(peak_rss(), elapsed, devs))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--part-power', type=int, default=18)
+    parser.add_argument('--replicas', type=int, default=3)
+    parser.add_argument('--devices', type=int, default=300)
+    parser.add_argument('--measure', choices=['full', 'read-only'],
+                        help=argparse.SUPPRESS)
+    parser.add_argument('--builder', help='existing builder to load')
+    args = parser.parse_args()
+
+    if args.measure:
+        measure(args.builder, args.measure == 'read-only')
+        return
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = args.builder
+        if not path:
+            path = os.path.join(tmpdir, 'object.builder')
+            create_builder(path, args.part_power, args.replicas, args.devices)
+        print('builder: {} MB'.format(os.path.getsize(path) // (1024 * 1024)))
+        for mode in ('full', 'read-only'):
+            out = subprocess.check_output(
+                [sys.executable, __file__, '--measure', mode,
+                 '--builder', path], universal_newlines=True)
+            peak, elapsed, devs = out.split()
+            print('{:>10}: peak RSS {:>5} MB, {}s, {} devices'.format(
+                mode, peak, elapsed, devs))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -18,9 +18,13 @@ try:
     import cPickle as pickle
 except ModuleNotFoundError:
     import _pickle as pickle
+import functools
 import json
+import multiprocessing
 import os
+import random
 import sys
+import time
 
 
 _usage = """This file is called from the swift_utils.py file to implement
@@ -46,8 +50,16 @@ The format of the output has the same keys as, but in a compressed form:
 
 This system is currently needed to decouple the majority of the charm from the
 underlying package being used for keystone.
+
+Alternatively, the file can be called with the single parameter '--worker'.  In
+that mode it stays resident and reads one json encoded call (in the format
+above) per line from STDIN, writing one json encoded result per line to STDOUT,
+until STDIN is closed.  This avoids paying the interpreter start-up and swift
+import cost on every call made during a hook.
 """
 
+WORKER_ARG = '--worker'
+
 JSON_ENCODE_OPTIONS = dict(
     sort_keys=True,
     allow_nan=False,
@@ -74,18 +86,21 @@ def exists_in_ring(ring_path, node):
         device)
     :returns: boolean
     """
-    ring = _load_builder(ring_path).to_dict()
+    ring = _load_builder(ring_path, read_only=True).to_dict()
+    return not find_missing_devices(ring['devs'], [node])['missing']
 
-    for dev in ring['devs']:
-        # Devices in the ring can be None if there are holes from previously
-        # removed devices so skip any that are None.
-        if not dev:
-            continue
-        d = [(i, dev[i]) for i in dev if i in node and i != 'zone']
-        n = [(i, node[i]) for i in node if i in dev and i != 'zone']
-        if sorted(d) == sorted(n):
-            return True
-    return False
+
+def missing_devices(ring_path, nodes):
+    """Determine which nodes are missing from, or need updating in, a ring.
+
+    See find_missing_devices() for the details.
+
+    :param ring_path: the file representing the ring
+    :param nodes: list of node dictionaries
+    :returns: {'missing': [<node index>, ...], 'update': [<node index>, ...]}
+    """
+    builder = _load_builder(ring_path, read_only=True)
+    return find_missing_devices(builder.devs, nodes)
 
 
 def add_dev(ring_path, dev):
@@ -119,7 +134,7 @@ def get_min_part_hours(ring_path):
     :param ring_path: The path for the ring
     :returns: integer that is the min_part_hours
     """
-    builder = _load_builder(ring_path)
+    builder = _load_builder(ring_path, read_only=True)
     return builder.min_part_hours
 
 
@@ -131,8 +146,8 @@ def get_current_replicas(ring_path):
     :returns: replicas
     :rtype: int
     """
-    builder = _load_builder(ring_path)
-    return builder.min_part_hours
+    builder = _load_builder(ring_path, read_only=True)
+    return builder.replicas
 
 
 def get_zone(ring_path):
@@ -154,29 +169,61 @@ def get_zone(ring_path):
     :param ring_path: The path to the ring to get the zone for.
     :returns: <integer> zone id
     """
-    builder = _load_builder(ring_path)
-    replicas = builder.replicas
-    zones = [d['zone'] for d in builder.devs]
-    if not zones:
-        return 1
+    builder = _load_builder(ring_path, read_only=True)
+    return next_zone(builder.replicas,
+                     [d['zone'] for d in builder.devs if d])
 
-    # zones is a per-device list, so we may have one
-    # node with 3 devices in zone 1.  For balancing
-    # we need to track the unique zones being used
-    # not necessarily the number of devices
-    unique_zones = list(set(zones))
-    if len(unique_zones) < replicas:
-        return sorted(unique_zones).pop() + 1
 
-    zone_distrib = {}
-    for z in zones:
-        zone_distrib[z] = zone_distrib.get(z, 0) + 1
+def ring_index(ring_path):
+    """Return a summary of the ring that is cheap to store and query.
 
-    if len(set(zone_distrib.values())) == 1:
-        # all zones are equal, start assigning to zone 1 again.
-        return 1
+    The index is stored alongside the builder by swift_utils.py so that
+    read-only queries don't need to load the builder at all.  It contains:
 
-    return sorted(zone_distrib, key=zone_distrib.get).pop(0)
+    {
+        'devs': <list of the devices, without partition counts>,
+        'members': <sorted list of unique [ip, port, device] entries>,
+        'regions': <sorted list of the unique regions>,
+        'zones': <sorted list of the unique zones>,
+        'zone': <the zone that get_zone() would return>,
+        'replicas': <replicas>,
+        'min_part_hours': <min_part_hours>,
+        'part_power': <part_power>,
+    }
+
+    :param ring_path: The path to the ring to index.
+    :returns: the index structure
+    """
+    builder = _load_builder(ring_path, read_only=True)
+    devs = [dict((k, dev[k]) for k in INDEX_DEV_KEYS if k in dev)
+            for dev in builder.devs if dev]
+    members = set((d.get('ip'), d.get('port'), d.get('device'))
+                  for d in devs)
+    zones = [d['zone'] for d in devs]
+    return {
+        'devs': devs,
+        'members': sorted(list(m) for m in members),
+        'regions': sorted(set(d['region'] for d in devs if 'region' in d)),
+        'zones': sorted(set(zones)),
+        'zone': next_zone(builder.replicas, zones),
+        'replicas': builder.replicas,
+        'min_part_hours': builder.min_part_hours,
+        'part_power': builder.part_power,
+    }
+
+
+def search_devices(ring_path, search_value):
+    """Find the devices in a ring matching a swift-ring-builder search value.
+
+    :param ring_path: The path to the ring
+    :param search_value: the search value, e.g. 'd1' or 'z1-10.0.0.1/sdb'
+    :returns: list of the matching devices, with the ring_index() keys
+    :raises: ManagerException if no devices match
+    """
+    devs = _search_devs(_load_builder(ring_path, read_only=True),
+                        search_value)
+    return [dict((k, dev[k]) for k in INDEX_DEV_KEYS if k in dev)
+            for dev in devs]
 
 
 def has_minimum_zones(rings):
@@ -198,7 +245,7 @@ def has_minimum_zones(rings):
             return {
                 "result": False
             }
-        builder = _load_builder(ring).to_dict()
+        builder = _load_builder(ring, read_only=True).to_dict()
         if not builder['devs']:
             return {
                 "result": False
@@ -223,10 +270,519 @@ def has_minimum_zones(rings):
     }
 
 
+def apply_ring_operations(ring_path, operations):
+    """Apply a list of operations to a ring in a single transaction.
+
+    The builder is loaded once, all of the operations are applied to it in
+    order, and then (if anything changed) it is written back once.  If a
+    'write_ring' or 'rebalance' operation was requested, the ring file is
+    written once, after all of the operations have been applied.
+
+    Each operation is a dictionary with an 'op' key and the following
+    arguments:
+
+    {'op': 'add_dev', 'dev': <dev in the add_dev() format>}
+    {'op': 'set_info', 'search': {<dev key>: <value>, ...},
+     'changes': {<dev key>: <value>, ...}}
+    {'op': 'remove', 'search_value': <swift-ring-builder search value>}
+    {'op': 'set_weight', 'search_value': <search value>, 'weight': <weight>}
+    {'op': 'set_min_part_hours', 'min_part_hours': <hours>}
+    {'op': 'set_replicas', 'replicas': <replicas>}
+    {'op': 'write_ring'}
+    {'op': 'rebalance', 'seed': <optional seed>}
+
+    :param ring_path: the path to the builder file
+    :param operations: list of the operations to perform
+    :returns: list with the result of each operation, in order.  add_dev
+        returns the new device id, set_info, remove and set_weight return the
+        number of devices affected, set_min_part_hours and set_replicas return
+        whether the value was changed, write_ring returns whether the ring can
+        be written and rebalance returns {'parts': <partitions moved>,
+        'balance': <balance>}
+    :raises: ManagerException if an operation is invalid or a search matches
+        no devices
+    """
+    builder = _load_builder(ring_path)
+    results = []
+    changed = False
+    write = False
+    for operation in operations:
+        operation = dict(operation)
+        op = operation.pop('op', None)
+        try:
+            handler = _RING_OPERATIONS[op]
+        except KeyError:
+            raise ManagerException(
+                "Unknown ring operation '{}' on {}".format(op, ring_path))
+        result, op_changed, op_write = handler(builder, **operation)
+        results.append(result)
+        changed = changed or op_changed
+        write = write or op_write
+
+    if changed:
+        _write_ring(builder, ring_path)
+    if write:
+        _write_ring_file(builder, ring_path)
+    return results
+
+
+def best_rebalance_seed(ring_path, attempts, max_workers=None):
+    """Rebalance copies of a ring with several seeds and return the best.
+
+    Each attempt rebalances its own copy of the builder with a different seed
+    in a pool of worker processes.  The attempts are scored on dispersion,
+    then balance (both to 2 decimal places, as swift-ring-builder reports
+    them) and then the number of partitions moved, lowest first.  Nothing is
+    saved.
+
+    :param ring_path: the path to the builder file
+    :param attempts: the number of seeded rebalances to try
+    :param max_workers: the maximum number of worker processes, defaults to
+        the number of CPUs
+    :returns: {'seed': <seed>, 'parts': <partitions moved>,
+        'balance': <balance>, 'dispersion': <dispersion>} of the best attempt
+    :raises: ManagerException if the ring can't be rebalanced
+    """
+    attempts = max(int(attempts), 1)
+    workers = min(attempts, max_workers or multiprocessing.cpu_count())
+    rand = random.SystemRandom()
+    seeds = [rand.randint(0, 2 ** 32 - 1) for _ in range(attempts)]
+    attempt = functools.partial(_rebalance_attempt, ring_path)
+    if workers > 1:
+        pool = multiprocessing.Pool(processes=workers)
+        try:
+            scores = pool.map(attempt, seeds)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        scores = [attempt(seed) for seed in seeds]
+    return min(scores, key=_rebalance_score)
+
+
+def rebalance_best_of(ring_path, attempts, max_workers=None, seed=None):
+    """Rebalance a ring with several seeds and keep the best result.
+
+    The best seed (see best_rebalance_seed()) is used to rebalance the
+    builder, which is saved, along with the ring and backups of both,
+    following the same rules as 'swift-ring-builder <builder> rebalance'.
+
+    :param ring_path: the path to the builder file
+    :param attempts: the number of seeded rebalances to try
+    :param max_workers: the maximum number of worker processes, defaults to
+        the number of CPUs
+    :param seed: the seed to rebalance with, e.g. one already picked by
+        best_rebalance_seed() for a preview, rather than trying attempts
+    :returns: {'seed': <seed>, 'parts': <partitions moved>,
+        'balance': <balance>, 'dispersion': <dispersion>,
+        'attempts': <attempts>, 'written': <whether the builder was saved>,
+        'warning': <whether swift-ring-builder would exit with a warning>}
+    :raises: ManagerException if the ring can't be rebalanced
+    """
+    attempts = max(int(attempts), 1)
+    if seed is None:
+        seed = best_rebalance_seed(ring_path, attempts, max_workers)['seed']
+
+    from swift.common import exceptions
+    builder = _load_builder(ring_path)
+    devs_changed = builder.devs_changed
+    try:
+        last_balance = builder.get_balance()
+        last_dispersion = builder.dispersion
+        parts, balance, removed_devs = builder.rebalance(seed=seed)
+        builder.validate()
+    except exceptions.RingBuilderError as e:
+        raise ManagerException(
+            "Failed to rebalance {}: {}".format(ring_path, str(e)))
+
+    result = {'seed': seed, 'parts': parts, 'balance': balance,
+              'dispersion': builder.dispersion, 'attempts': attempts,
+              'written': False, 'warning': True}
+    if not (parts or removed_devs):
+        return result
+    # Don't save unless the rebalance changed at least 1%; see the
+    # swift-ring-builder rebalance command.
+    from swift.common.ring.builder import MAX_BALANCE
+    if not devs_changed:
+        balance_changed = (
+            abs(last_balance - balance) >= 1 or
+            (last_balance == MAX_BALANCE and balance == MAX_BALANCE))
+        dispersion_changed = last_dispersion is None or (
+            abs(last_dispersion - builder.dispersion) >= 1)
+        if not (balance_changed or dispersion_changed):
+            return result
+
+    backup_dir = os.path.join(os.path.dirname(ring_path), 'backups')
+    if not os.path.isdir(backup_dir):
+        os.mkdir(backup_dir)
+    prefix = '{}.'.format(int(time.time()))
+    builder.get_ring().save(os.path.join(
+        backup_dir, prefix + os.path.basename(_ring_file_path(ring_path))))
+    builder.save(os.path.join(backup_dir,
+                              prefix + os.path.basename(ring_path)))
+    _write_ring_file(builder, ring_path)
+    _write_ring(builder, ring_path)
+    result['written'] = True
+    result['warning'] = builder.dispersion > 0 or (
+        balance > 5 and balance / 100.0 > builder.overload)
+    return result
+
+
+def preview_rebalance(ring_path, partition_size=None, seed=None):
+    """Estimate what rebalancing a ring would move, without saving anything.
+
+    The builder is rebalanced in memory and its partition assignment compared
+    with the one before.  Each partition replica that is assigned to a
+    different device has to be replicated to it, unless the ring had never
+    been rebalanced, in which case there is no data to move yet.
+
+    :param ring_path: the path to the builder file
+    :param partition_size: the average size of a partition replica in bytes,
+        used to estimate the bytes moved
+    :param seed: the seed to rebalance with
+    :returns: {'parts': <partitions moved>,
+        'replicas_moved': <partition replicas moved>,
+        'bytes': <estimated bytes moved, or None without partition_size>,
+        'balance': <balance>, 'dispersion': <dispersion>,
+        'devices': [{'id', 'region', 'zone', 'ip', 'device', 'parts_in',
+                     'parts_out'}, ...],
+        'zones': [{'region', 'zone', 'parts_in', 'parts_out'}, ...]}
+        where devices and zones only include those with partitions moving
+    :raises: ManagerException if the ring can't be rebalanced
+    """
+    from swift.common import exceptions
+    builder = _load_builder(ring_path)
+    devs = dict((dev['id'], dev) for dev in builder.devs if dev)
+    before = [part2dev[:] for part2dev in builder._replica2part2dev or []]
+    try:
+        parts, balance = builder.rebalance(seed=seed)[:2]
+    except exceptions.RingBuilderError as e:
+        raise ManagerException(
+            "Failed to rebalance {}: {}".format(ring_path, str(e)))
+
+    parts_in = {}
+    parts_out = {}
+    for replica, part2dev in enumerate(builder._replica2part2dev or []):
+        old_part2dev = before[replica] if replica < len(before) else []
+        for part, dev_id in enumerate(part2dev):
+            old_dev_id = None
+            if part < len(old_part2dev):
+                old_dev_id = old_part2dev[part]
+            if dev_id == old_dev_id:
+                continue
+            parts_in[dev_id] = parts_in.get(dev_id, 0) + 1
+            if old_dev_id is not None:
+                parts_out[old_dev_id] = parts_out.get(old_dev_id, 0) + 1
+
+    replicas_moved = sum(parts_in.values()) if before else 0
+    devices = []
+    zones = {}
+    for dev_id in sorted(set(parts_in) | set(parts_out)):
+        dev = devs[dev_id]
+        moves = {'parts_in': parts_in.get(dev_id, 0),
+                 'parts_out': parts_out.get(dev_id, 0)}
+        devices.append(dict(moves, id=dev_id, region=dev['region'],
+                            zone=dev['zone'], ip=dev['ip'],
+                            device=dev['device']))
+        zone = zones.setdefault((dev['region'], dev['zone']),
+                                {'region': dev['region'], 'zone': dev['zone'],
+                                 'parts_in': 0, 'parts_out': 0})
+        zone['parts_in'] += moves['parts_in']
+        zone['parts_out'] += moves['parts_out']
+
+    return {'parts': parts,
+            'replicas_moved': replicas_moved,
+            'bytes': (replicas_moved * partition_size
+                      if partition_size else None),
+            'balance': balance,
+            'dispersion': builder.dispersion,
+            'devices': devices,
+            'zones': [zones[k] for k in sorted(zones)]}
+
+
+def _rebalance_attempt(ring_path, seed):
+    """Rebalance a copy of the builder with seed and return its score.
+
+    This runs in the worker processes of best_rebalance_seed().
+    """
+    builder = _load_builder(ring_path)
+    try:
+        parts, balance = builder.rebalance(seed=seed)[:2]
+    except Exception as e:
+        raise ManagerException(
+            "Failed to rebalance {}: {}".format(ring_path, str(e)))
+    return {'seed': seed, 'parts': parts, 'balance': balance,
+            'dispersion': builder.dispersion}
+
+
+def _rebalance_score(score):
+    return (round(score['dispersion'], 2), round(score['balance'], 2),
+            score['parts'])
+
+
+# These are the ring operations used by apply_ring_operations().  Each one
+# returns a tuple of (result, builder changed, ring file needs writing).
+
+def _op_add_dev(builder, dev):
+    return builder.add_dev(dev), True, False
+
+
+def _op_set_info(builder, search, changes):
+    devs = builder.search_devs(search)
+    if not devs:
+        raise ManagerException(
+            "No devices match {} to set {}".format(search, changes))
+    for dev in devs:
+        dev.update(changes)
+    return len(devs), True, False
+
+
+def _search_devs(builder, search_value):
+    from swift.common.ring import RingBuilder
+    from swift.common.ring.utils import parse_search_value
+    # RingBuilder.search_devs() only looks at the devices, so this works on
+    # read-only builders too
+    devs = RingBuilder.search_devs(builder, parse_search_value(search_value))
+    if not devs:
+        raise ManagerException(
+            "Search value '{}' matched 0 devices".format(search_value))
+    return devs
+
+
+def _op_remove(builder, search_value):
+    devs = _search_devs(builder, search_value)
+    for dev in devs:
+        builder.remove_dev(dev['id'])
+    return len(devs), True, False
+
+
+def _op_set_weight(builder, search_value, weight):
+    devs = _search_devs(builder, search_value)
+    for dev in devs:
+        builder.set_dev_weight(dev['id'], float(weight))
+    return len(devs), True, False
+
+
+def _op_set_min_part_hours(builder, min_part_hours):
+    if builder.min_part_hours == min_part_hours:
+        return False, False, False
+    builder.change_min_part_hours(min_part_hours)
+    return True, True, False
+
+
+def _op_set_replicas(builder, replicas):
+    if builder.replicas == replicas:
+        return False, False, False
+    builder.set_replicas(replicas)
+    return True, True, False
+
+
+def _op_write_ring(builder):
+    # swift-ring-builder refuses to write a ring with no devices in it, which
+    # is the case during install.
+    writeable = any(builder.devs)
+    return writeable, False, writeable
+
+
+def _op_rebalance(builder, seed=None):
+    parts, balance = builder.rebalance(seed=seed)[:2]
+    builder.validate()
+    return {'parts': parts, 'balance': balance}, True, True
+
+
+_RING_OPERATIONS = {
+    'add_dev': _op_add_dev,
+    'set_info': _op_set_info,
+    'remove': _op_remove,
+    'set_weight': _op_set_weight,
+    'set_min_part_hours': _op_set_min_part_hours,
+    'set_replicas': _op_set_replicas,
+    'write_ring': _op_write_ring,
+    'rebalance': _op_rebalance,
+}
+
+
+# These functions only work on plain data, so as well as being used by the
+# 'API' functions above they are imported directly by swift_utils.py to answer
+# queries from the ring index.
+
+def next_zone(replicas, zones):
+    """Implements the zone selection for get_zone().
+
+    :param replicas: the number of replicas of the ring
+    :param zones: the zone of each device in the ring
+    :returns: <integer> zone id
+    """
+    if not zones:
+        return 1
+
+    # zones is a per-device list, so we may have one
+    # node with 3 devices in zone 1.  For balancing
+    # we need to track the unique zones being used
+    # not necessarily the number of devices
+    unique_zones = list(set(zones))
+    if len(unique_zones) < replicas:
+        return sorted(unique_zones).pop() + 1
+
+    zone_distrib = {}
+    for z in zones:
+        zone_distrib[z] = zone_distrib.get(z, 0) + 1
+
+    if len(set(zone_distrib.values())) == 1:
+        # all zones are equal, start assigning to zone 1 again.
+        return 1
+
+    return sorted(zone_distrib, key=zone_distrib.get).pop(0)
+
+
+def dev_matches_node(dev, node):
+    """Match a ring device against a node, ignoring the zone.
+
+    Only the keys that are present in both the device and the node are
+    compared.
+
+    :param dev: the ring device
+    :param node: the node
+    :returns: boolean
+    """
+    for key in node:
+        if key != 'zone' and key in dev and dev[key] != node[key]:
+            return False
+    return True
+
+
+def find_missing_devices(devs, nodes):
+    """Determine which nodes are missing from, or need updating in, devs.
+
+    A node is missing if no device matches it (see dev_matches_node()), which
+    is the same test as exists_in_ring().  A node needs updating if it has
+    replication data ('ip_rep' and 'port_rep') and there is a device with the
+    same ip, replication_ip and device name whose port or replication_port
+    differs from the node.
+
+    The devices are indexed once so that the cost is linear in the number of
+    devices plus the number of nodes.
+
+    :param devs: the ring devices; None entries (holes) are ignored
+    :param nodes: list of node dictionaries, with 'port' set for the ring
+    :returns: {'missing': [<node index>, ...], 'update': [<node index>, ...]}
+    """
+    by_member = {}
+    by_replication = {}
+    for dev in devs:
+        if not dev:
+            continue
+        member = (dev.get('ip'), dev.get('port'), dev.get('device'))
+        by_member.setdefault(member, []).append(dev)
+        replication = (dev.get('ip'), dev.get('replication_ip'),
+                       dev.get('device'))
+        by_replication.setdefault(replication, []).append(dev)
+
+    missing = []
+    update = []
+    for i, node in enumerate(nodes):
+        member = (node.get('ip'), node.get('port'), node.get('device'))
+        if None in member:
+            candidates = [dev for dev in devs if dev]
+        else:
+            candidates = by_member.get(member, [])
+        if not any(dev_matches_node(dev, node) for dev in candidates):
+            missing.append(i)
+
+        if node.get('ip_rep') is None or node.get('port_rep') is None:
+            continue
+        replication = (node.get('ip'), node['ip_rep'], node.get('device'))
+        for dev in by_replication.get(replication, []):
+            if (dev.get('port') != node.get('port') or
+                    dev.get('replication_port') != node['port_rep']):
+                update.append(i)
+                break
+
+    return {'missing': missing, 'update': update}
+
+
 # These are utility functions that are for the 'API' functions above (i.e. they
 # are not called from the main function)
 
-def _load_builder(path):
+# The device keys kept in the ring_index() device table.
+INDEX_DEV_KEYS = ('id', 'region', 'zone', 'ip', 'port', 'replication_ip',
+                  'replication_port', 'device', 'weight', 'meta')
+
+
+def _discard_array(*args):
+    """Stands in for array.array when loading a builder read-only.
+
+    In protocol 2 pickles the items of each array are pickled as a list,
+    which the unpickler keeps hold of in its memo until loading finishes, so
+    empty the list to release the memory straight away.
+    """
+    for arg in args:
+        if isinstance(arg, list):
+            del arg[:]
+    return None
+
+
+try:
+    class _ReadOnlyUnpickler(pickle.Unpickler):
+
+        def find_class(self, module, name):
+            if module == 'array':
+                return _discard_array
+            return super(_ReadOnlyUnpickler, self).find_class(module, name)
+except TypeError:
+    # python2's cPickle.Unpickler can't be subclassed, but find_global can be
+    # set on an instance instead; see _read_only_unpickler().
+    _ReadOnlyUnpickler = None
+
+
+def _read_only_unpickler(fd):
+    if _ReadOnlyUnpickler is not None:
+        return _ReadOnlyUnpickler(fd)
+
+    def find_global(module, name):
+        if module == 'array':
+            return _discard_array
+        __import__(module)
+        return getattr(sys.modules[module], name)
+
+    unpickler = pickle.Unpickler(fd)
+    unpickler.find_global = find_global
+    return unpickler
+
+
+class _ReadOnlyBuilder(object):
+    """The scalar fields and devices of a builder.
+
+    This is what _load_builder() returns when read_only=True.  The partition
+    assignment arrays are not loaded, so it can only be queried, not modified
+    or written back.
+    """
+
+    def __init__(self, builder_dict):
+        self._builder_dict = builder_dict
+
+    def __getattr__(self, attr):
+        try:
+            return self.__dict__['_builder_dict'][attr]
+        except KeyError:
+            raise AttributeError(attr)
+
+    def to_dict(self):
+        return self._builder_dict
+
+
+def _load_builder(path, read_only=False):
+    if read_only:
+        with open(path, 'rb') as fd:
+            builder = _read_only_unpickler(fd).load()
+        if not isinstance(builder, dict):
+            # Happens with really old builder pickles
+            builder = dict(vars(builder))
+        for dev in builder['devs']:
+            if dev and 'meta' not in dev:
+                dev['meta'] = ''
+        return _ReadOnlyBuilder(builder)
+
     # lifted straight from /usr/bin/swift-ring-builder
     from swift.common.ring import RingBuilder
     try:
@@ -246,8 +802,24 @@ def _load_builder(path):
 
 
 def _write_ring(ring, ring_path):
-    with open(ring_path, "wb") as fd:
+    # Write to a temporary file and rename it into place so that readers
+    # never see a partially written builder.
+    tmp_path = "{}.tmp".format(ring_path)
+    with open(tmp_path, "wb") as fd:
         pickle.dump(ring.to_dict(), fd, protocol=2)
+    os.rename(tmp_path, ring_path)
+
+
+def _ring_file_path(ring_path):
+    """Return the path of the ring file that belongs to a builder file."""
+    base = ring_path
+    if base.endswith('.builder'):
+        base = base[:-len('.builder')]
+    return "{}.ring.gz".format(base)
+
+
+def _write_ring_file(builder, ring_path):
+    builder.get_ring().save(_ring_file_path(ring_path))
 
 
 # The following code is just the glue to link the manager.py and swift_utils.py
@@ -258,22 +830,73 @@ class ManagerException(Exception):
     pass
 
 
+def _dispatch(spec):
+    """Perform the call described by spec and return the result structure.
+
+    :param spec: the decoded call, with 'path', 'args' and 'kwargs' keys.
+    :returns: {'result': <result>} or {'error': <error text>}
+    """
+    try:
+        _callable = sys.modules[__name__]
+        for attr in spec['path']:
+            _callable = getattr(_callable, attr)
+        # now make the call and return the arguments
+        return {'result': _callable(*spec['args'], **spec['kwargs'])}
+    except ManagerException as e:
+        # deal with sending an error back.
+        print(str(e), file=sys.stderr)
+        import traceback
+        print(traceback.format_exc(), file=sys.stderr)
+        return {'error': str(e)}
+    except Exception as e:
+        print("{}: something went wrong: {}".format(__file__, str(e)),
+              file=sys.stderr)
+        import traceback
+        print(traceback.format_exc(), file=sys.stderr)
+        return {'error': str(e)}
+
+
+def serve(infile, outfile):
+    """Serve json encoded calls, one per line, until infile is closed.
+
+    Anything the called functions print to STDOUT is diverted to STDERR so
+    that it can't corrupt the result stream.
+
+    :param infile: file object to read the json encoded calls from
+    :param outfile: file object to write the json encoded results to
+    """
+    stdout = sys.stdout
+    sys.stdout = sys.stderr
+    try:
+        for line in iter(infile.readline, ''):
+            if not line.strip():
+                continue
+            try:
+                result = _dispatch(json.loads(line))
+            except ValueError as e:
+                result = {'error': "Invalid call: {}".format(str(e))}
+            outfile.write(json.dumps(result, **JSON_ENCODE_OPTIONS))
+            outfile.write('\n')
+            outfile.flush()
+    finally:
+        sys.stdout = stdout
+
+
 if __name__ == '__main__':
     # This script needs 1 argument which is the input json.  See file header
     # for details on how it is called.  It returns a JSON encoded result, in
     # the same file, which is overwritten
+    if sys.argv[1:] == [WORKER_ARG]:
+        serve(sys.stdin, sys.stdout)
+        sys.exit(0)
+
     result = None
     try:
         if len(sys.argv) != 2:
             raise ManagerException(
                 "{} called without 2 arguments: must pass the filename"
                 .format(__file__))
-        spec = json.loads(sys.argv[1])
-        _callable = sys.modules[__name__]
-        for attr in spec['path']:
-            _callable = getattr(_callable, attr)
-        # now make the call and return the arguments
-        result = {'result': _callable(*spec['args'], **spec['kwargs'])}
+        result = _dispatch(json.loads(sys.argv[1]))
     except ManagerException as e:
         # deal with sending an error back.
         print(str(e), file=sys.stderr)
@@ -1,3 +1,11 @@
+import array
+import io
+import json
+import os
+import pickle
+import shutil
+import sys
+import tempfile
 from unittest import mock
 import unittest
 
@@ -15,7 +23,7 @@ def create_mock_load_builder_fn(mock_rings):
 
     :param mock_rings: a dict containing the dict form of the rings
     """
-    def mock_load_builder_fn(path):
+    def mock_load_builder_fn(path, read_only=False):
         class mock_ring(object):
             def __init__(self, path):
                 self.path = path
@@ -30,6 +38,26 @@ def create_mock_load_builder_fn(mock_rings):
     return mock_load_builder_fn
 
 
+def mock_swift_modules(test):
+    """Make the swift modules imported by manager.py functions importable.
+
+    :param test: the test case, which stops the patch on cleanup
+    """
+    swift = mock.MagicMock()
+    swift.common.ring.builder.MAX_BALANCE = 999.99
+    swift.common.exceptions.RingBuilderError = type(
+        'RingBuilderError', (Exception,), {})
+    modules = {'swift': swift, 'swift.common': swift.common,
+               'swift.common.exceptions': swift.common.exceptions,
+               'swift.common.ring': swift.common.ring,
+               'swift.common.ring.builder': swift.common.ring.builder,
+               'swift.common.ring.utils': swift.common.ring.utils}
+    patcher = mock.patch.dict(sys.modules, modules)
+    patcher.start()
+    test.addCleanup(patcher.stop)
+    return swift
+
+
 MOCK_SWIFT_RINGS = {
     'account': 'account.builder',
     'container': 'container.builder',
@@ -121,3 +149,335 @@ class TestSwiftManager(unittest.TestCase):
         manager.add_dev(ring, new_dev)
         mock_write_ring.assert_called_once()
         self.assertTrue('id' not in mock_rings[ring]['devs'][0])
+
+    @mock.patch.object(manager, 'get_min_part_hours')
+    def test_serve(self, mock_get_min_part_hours):
+        mock_get_min_part_hours.side_effect = [1, Exception('boom')]
+        calls = [
+            {'path': ['get_min_part_hours'], 'args': ['account'],
+             'kwargs': {}},
+            {'path': ['get_min_part_hours'], 'args': ['account'],
+             'kwargs': {}},
+            {'path': ['no_such_function'], 'args': [], 'kwargs': {}},
+        ]
+        infile = io.StringIO(
+            ''.join(json.dumps(c) + '\n' for c in calls) + 'not json\n')
+        outfile = io.StringIO()
+        with mock.patch('sys.stderr', new=io.StringIO()):
+            manager.serve(infile, outfile)
+        results = [json.loads(line)
+                   for line in outfile.getvalue().splitlines()]
+        self.assertEqual(len(results), 4)
+        self.assertEqual(results[0], {'result': 1})
+        self.assertEqual(results[1], {'error': 'boom'})
+        self.assertIn('error', results[2])
+        self.assertIn('error', results[3])
+
+    @mock.patch.object(manager, '_write_ring_file')
+    @mock.patch.object(manager, '_write_ring')
+    @mock.patch.object(manager, '_load_builder')
+    def test_apply_ring_operations(self, mock_load_builder, mock_write_ring,
+                                   mock_write_ring_file):
+        builder = mock.MagicMock()
+        builder.min_part_hours = 1
+        builder.replicas = 3
+        builder.devs = [{'id': 0, 'ip': '1.2.3.4', 'device': 'sdb'}]
+        builder.add_dev.return_value = 1
+        builder.search_devs.return_value = [builder.devs[0]]
+        mock_load_builder.return_value = builder
+
+        results = manager.apply_ring_operations('account.builder', [
+            {'op': 'set_min_part_hours', 'min_part_hours': 1},
+            {'op': 'set_replicas', 'replicas': 3},
+            {'op': 'write_ring'},
+        ])
+        self.assertEqual(results, [False, False, True])
+        mock_load_builder.assert_called_once_with('account.builder')
+        mock_write_ring.assert_not_called()
+        mock_write_ring_file.assert_called_once_with(builder,
+                                                     'account.builder')
+
+        mock_load_builder.reset_mock()
+        mock_write_ring_file.reset_mock()
+        results = manager.apply_ring_operations('account.builder', [
+            {'op': 'add_dev', 'dev': {'ip': '1.2.3.5', 'device': 'sdc'}},
+            {'op': 'set_info', 'search': {'ip': '1.2.3.4', 'device': 'sdb'},
+             'changes': {'port': 6010}},
+            {'op': 'set_min_part_hours', 'min_part_hours': 2},
+        ])
+        self.assertEqual(results, [1, 1, True])
+        self.assertEqual(builder.devs[0]['port'], 6010)
+        builder.change_min_part_hours.assert_called_once_with(2)
+        mock_load_builder.assert_called_once_with('account.builder')
+        mock_write_ring.assert_called_once_with(builder, 'account.builder')
+        mock_write_ring_file.assert_not_called()
+
+        builder.search_devs.return_value = []
+        self.assertRaises(manager.ManagerException,
+                          manager.apply_ring_operations, 'account.builder',
+                          [{'op': 'set_info', 'search': {'ip': '1.2.3.9'},
+                            'changes': {'port': 1}}])
+        self.assertRaises(manager.ManagerException,
+                          manager.apply_ring_operations, 'account.builder',
+                          [{'op': 'no_such_op'}])
+
+    @mock.patch.object(manager, '_write_ring_file')
+    @mock.patch.object(manager, '_write_ring')
+    @mock.patch.object(manager, '_load_builder')
+    @mock.patch.object(manager, '_rebalance_attempt')
+    def test_rebalance_best_of(self, mock_rebalance_attempt,
+                               mock_load_builder, mock_write_ring,
+                               mock_write_ring_file):
+        mock_swift_modules(self)
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        ring_path = os.path.join(tmpdir, 'object.builder')
+
+        scores = iter([
+            {'parts': 10, 'balance': 0.5, 'dispersion': 1.0},
+            {'parts': 20, 'balance': 0.3, 'dispersion': 0.0},
+            {'parts': 10, 'balance': 0.301, 'dispersion': 0.0},
+        ])
+
+        def fake_attempt(path, seed):
+            return dict(next(scores), seed=seed)
+
+        mock_rebalance_attempt.side_effect = fake_attempt
+        builder = mock.MagicMock()
+        builder.devs_changed = True
+        builder.dispersion = 0.0
+        builder.rebalance.return_value = (10, 0.301, 0)
+        mock_load_builder.return_value = builder
+
+        result = manager.rebalance_best_of(ring_path, 3, max_workers=1)
+        seeds = [c[0][1] for c in mock_rebalance_attempt.call_args_list]
+        # the same balance to 2 decimal places, but fewer parts moved
+        builder.rebalance.assert_called_once_with(seed=seeds[2])
+        self.assertEqual(result, {'seed': seeds[2], 'parts': 10,
+                                  'balance': 0.301, 'dispersion': 0.0,
+                                  'attempts': 3, 'written': True,
+                                  'warning': False})
+        mock_write_ring.assert_called_once_with(builder, ring_path)
+        mock_write_ring_file.assert_called_once_with(builder, ring_path)
+        backup = builder.save.call_args[0][0]
+        self.assertEqual(os.path.dirname(backup),
+                         os.path.join(tmpdir, 'backups'))
+        self.assertTrue(backup.endswith('.object.builder'))
+
+        # nothing moved, so nothing is saved
+        mock_write_ring.reset_mock()
+        mock_rebalance_attempt.side_effect = None
+        mock_rebalance_attempt.return_value = {
+            'seed': 1, 'parts': 0, 'balance': 0.3, 'dispersion': 0.0}
+        builder.rebalance.return_value = (0, 0.3, 0)
+        result = manager.rebalance_best_of(ring_path, 2, max_workers=1)
+        self.assertFalse(result['written'])
+        mock_write_ring.assert_not_called()
+
+    @mock.patch.object(manager, '_write_ring_file')
+    @mock.patch.object(manager, '_write_ring')
+    @mock.patch.object(manager, '_load_builder')
+    @mock.patch.object(manager, '_rebalance_attempt')
+    def test_rebalance_best_of_seed(self, mock_rebalance_attempt,
+                                    mock_load_builder, mock_write_ring,
+                                    mock_write_ring_file):
+        mock_swift_modules(self)
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        ring_path = os.path.join(tmpdir, 'object.builder')
+
+        def load_builder(path):
+            # a fresh copy of the builder, whose rebalance depends on the seed
+            builder = mock.MagicMock()
+            builder.devs = [{'id': i, 'region': 1, 'zone': i + 1,
+                             'ip': '10.0.0.{}'.format(i + 1),
+                             'device': 'sdb'} for i in range(2)]
+            builder._replica2part2dev = [array.array('H', [0] * 8)]
+            builder.devs_changed = True
+            builder.dispersion = 0.0
+
+            def rebalance(seed=None):
+                moved = seed % 8
+                for part in range(moved):
+                    builder._replica2part2dev[0][part] = 1
+                return moved, 0.5, 0
+
+            builder.rebalance.side_effect = rebalance
+            return builder
+
+        mock_load_builder.side_effect = load_builder
+        preview = manager.preview_rebalance(ring_path, seed=5)
+        result = manager.rebalance_best_of(ring_path, 3, max_workers=1,
+                                           seed=5)
+        # what the preview showed is what gets committed
+        self.assertEqual(result['seed'], 5)
+        self.assertEqual(result['parts'], preview['parts'])
+        self.assertEqual(preview['replicas_moved'], 5)
+        # and no other seeds are tried
+        mock_rebalance_attempt.assert_not_called()
+
+        mock_rebalance_attempt.side_effect = \
+            lambda path, seed: {'seed': seed, 'parts': seed % 8,
+                                'balance': 0.5, 'dispersion': 0.0}
+        best = manager.best_rebalance_seed(ring_path, 4, max_workers=1)
+        self.assertEqual(mock_rebalance_attempt.call_count, 4)
+        self.assertEqual(
+            best['seed'],
+            min((c[0][1] for c in mock_rebalance_attempt.call_args_list),
+                key=lambda seed: seed % 8))
+
+    @mock.patch.object(manager, '_load_builder')
+    def test_preview_rebalance(self, mock_load_builder):
+        swift = mock_swift_modules(self)
+        builder = mock.MagicMock()
+        builder.devs = [
+            {'id': 0, 'region': 1, 'zone': 1, 'ip': '10.0.0.1',
+             'device': 'sdb'},
+            {'id': 1, 'region': 1, 'zone': 2, 'ip': '10.0.0.2',
+             'device': 'sdb'},
+            {'id': 2, 'region': 1, 'zone': 2, 'ip': '10.0.0.3',
+             'device': 'sdb'},
+        ]
+        builder._replica2part2dev = [array.array('H', [0, 1, 0, 1]),
+                                     array.array('H', [1, 0, 1, 0])]
+        builder.dispersion = 0.0
+
+        def fake_rebalance(seed=None):
+            builder._replica2part2dev[0][1] = 2
+            builder._replica2part2dev[1][2] = 2
+            builder._replica2part2dev.append(array.array('H', [2, 2]))
+            return 2, 1.5, 0
+
+        builder.rebalance.side_effect = fake_rebalance
+        mock_load_builder.return_value = builder
+        preview = manager.preview_rebalance('object.builder', 100, seed=1)
+        builder.rebalance.assert_called_once_with(seed=1)
+        self.assertEqual(preview['parts'], 2)
+        # two replicas moved and two added for the extra partial replica
+        self.assertEqual(preview['replicas_moved'], 4)
+        self.assertEqual(preview['bytes'], 400)
+        self.assertEqual(preview['balance'], 1.5)
+        self.assertEqual(
+            [(d['id'], d['parts_in'], d['parts_out'])
+             for d in preview['devices']],
+            [(1, 0, 2), (2, 4, 0)])
+        self.assertEqual(preview['zones'],
+                         [{'region': 1, 'zone': 2, 'parts_in': 4,
+                           'parts_out': 2}])
+
+        # a ring that was never rebalanced has no data to move
+        builder._replica2part2dev = None
+        builder.rebalance.side_effect = None
+        builder.rebalance.return_value = (0, 0.0, 0)
+        preview = manager.preview_rebalance('object.builder')
+        self.assertEqual(preview['replicas_moved'], 0)
+        self.assertIsNone(preview['bytes'])
+
+        builder.rebalance.side_effect = (
+            swift.common.exceptions.RingBuilderError('no devices'))
+        self.assertRaises(manager.ManagerException,
+                          manager.preview_rebalance, 'object.builder')
+
+    @mock.patch.object(manager, '_load_builder')
+    def test_ring_index(self, mock_load_builder):
+        builder = mock.MagicMock()
+        builder.replicas = 3
+        builder.min_part_hours = 1
+        builder.part_power = 10
+        builder.devs = [
+            {'id': 0, 'region': 1, 'zone': 1, 'ip': '1.2.3.4', 'port': 6000,
+             'device': 'sdb', 'weight': 100.0, 'meta': '', 'parts': 10},
+            None,
+            {'id': 2, 'region': 1, 'zone': 2, 'ip': '1.2.3.5', 'port': 6000,
+             'device': 'sdb', 'weight': 100.0, 'meta': '', 'parts': 10},
+        ]
+        mock_load_builder.return_value = builder
+        index = manager.ring_index('account.builder')
+        self.assertEqual(len(index['devs']), 2)
+        self.assertNotIn('parts', index['devs'][0])
+        self.assertEqual(index['members'],
+                         [['1.2.3.4', 6000, 'sdb'], ['1.2.3.5', 6000, 'sdb']])
+        self.assertEqual(index['regions'], [1])
+        self.assertEqual(index['zones'], [1, 2])
+        self.assertEqual(index['zone'], 3)
+        self.assertEqual(index['replicas'], 3)
+        self.assertEqual(index['min_part_hours'], 1)
+        self.assertEqual(index['part_power'], 10)
+        self.assertEqual(manager.get_zone('account.builder'), 3)
+
+    def test_find_missing_devices(self):
+        devs = [
+            {'id': 0, 'region': 1, 'zone': 1, 'ip': '1.2.3.4', 'port': 6000,
+             'replication_ip': '2.3.4.5', 'replication_port': 6010,
+             'device': 'sdb'},
+            None,
+            {'id': 2, 'region': 1, 'zone': 1, 'ip': '1.2.3.4', 'port': 6000,
+             'replication_ip': '2.3.4.5', 'replication_port': 6010,
+             'device': 'sdc'},
+        ]
+        nodes = [
+            # present, zone is ignored
+            {'ip': '1.2.3.4', 'port': 6000, 'device': 'sdb', 'zone': 2,
+             'region': 1},
+            # different region
+            {'ip': '1.2.3.4', 'port': 6000, 'device': 'sdb', 'region': 2},
+            # unknown device
+            {'ip': '1.2.3.4', 'port': 6000, 'device': 'sdd'},
+            # present, but with a new replication port
+            {'ip': '1.2.3.4', 'port': 6000, 'device': 'sdc',
+             'ip_rep': '2.3.4.5', 'port_rep': 6020},
+            # present with matching replication data
+            {'ip': '1.2.3.4', 'port': 6000, 'device': 'sdb',
+             'ip_rep': '2.3.4.5', 'port_rep': 6010},
+            # new port, so missing, and the existing device needs updating
+            {'ip': '1.2.3.4', 'port': 6001, 'device': 'sdb',
+             'ip_rep': '2.3.4.5', 'port_rep': 6010},
+        ]
+        self.assertEqual(manager.find_missing_devices(devs, nodes),
+                         {'missing': [1, 2, 5], 'update': [3, 5]})
+
+    @mock.patch.object(manager, '_load_builder')
+    def test_search_devices(self, mock_load_builder):
+        swift = mock_swift_modules(self)
+        builder = mock_load_builder.return_value
+        search_devs = swift.common.ring.RingBuilder.search_devs
+        search_devs.return_value = [
+            {'id': 1, 'zone': 2, 'ip': '10.0.0.2', 'device': 'sdb',
+             'weight': 100.0, 'parts': 768}]
+        self.assertEqual(manager.search_devices('object.builder', 'z2'), [
+            {'id': 1, 'zone': 2, 'ip': '10.0.0.2', 'device': 'sdb',
+             'weight': 100.0}])
+        # a query, so the partition tables aren't loaded
+        mock_load_builder.assert_called_once_with('object.builder',
+                                                  read_only=True)
+        search_devs.assert_called_once_with(
+            builder,
+            swift.common.ring.utils.parse_search_value.return_value)
+
+        search_devs.return_value = []
+        self.assertRaises(manager.ManagerException, manager.search_devices,
+                          'object.builder', 'z9')
+
+    def test_load_builder_read_only(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'account.builder')
+        devs = [{'id': 0, 'region': 1, 'zone': 1, 'ip': '10.0.0.1',
+                 'port': 6002, 'device': 'sdb', 'weight': 100},
+                None]
+        with open(path, 'wb') as fd:
+            pickle.dump({'part_power': 8, 'replicas': 3,
+                         'min_part_hours': 1, 'devs': devs,
+                         '_replica2part2dev': [array.array('H', [0] * 256)],
+                         '_last_part_moves': array.array('B', [0] * 256)},
+                        fd, protocol=2)
+
+        builder = manager._load_builder(path, read_only=True)
+        self.assertEqual(builder.replicas, 3)
+        self.assertEqual(builder.min_part_hours, 1)
+        self.assertIsNone(builder._last_part_moves)
+        self.assertEqual(builder._replica2part2dev, [None])
+        self.assertEqual(builder.devs[0]['meta'], '')
+        self.assertIsNone(builder.devs[1])
+        self.assertRaises(AttributeError, getattr, builder, 'version')
+        self.assertEqual(builder.to_dict()['part_power'], 8)
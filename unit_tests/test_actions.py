@@ -329,10 +329,18 @@ class RemoveDevicesTestCase(CharmTestCase):
         super(RemoveDevicesTestCase, self).setUp(
             actions.actions, ["action_fail",
                               "action_get",
+                              "action_set",
+                              "config",
                               "remove_from_ring",
+                              "ramp_weight_in_ring",
                               "balance_rings",
+                              "ring_changes_deferred",
+                              "queue_ring_change",
+                              "flush_ring_changes",
                               "is_elected_leader"])
         self.is_elected_leader.return_value = True
+        self.config.return_value = 0
+        self.ring_changes_deferred.return_value = False
 
     def test_not_leader(self):
         self.is_elected_leader.return_value = False
@@ -346,6 +354,38 @@ class RemoveDevicesTestCase(CharmTestCase):
             '/etc/swift/account.builder', 'd1')
         self.balance_rings.assert_called_once()
 
+    def test_ring_valid_ramp(self):
+        self.config.return_value = 25
+        self.action_get.side_effect = ['account', False, 'd1']
+        actions.actions.remove_devices([])
+        self.ramp_weight_in_ring.assert_called_once_with(
+            '/etc/swift/account.builder', 'd1', 0, remove=True)
+        self.remove_from_ring.assert_not_called()
+        self.balance_rings.assert_called_once()
+
+    def test_ring_valid_ramp_immediate(self):
+        self.config.return_value = 25
+        self.action_get.side_effect = ['account', True, 'd1']
+        actions.actions.remove_devices([])
+        self.remove_from_ring.assert_called_once_with(
+            '/etc/swift/account.builder', 'd1')
+        self.ramp_weight_in_ring.assert_not_called()
+
+    def test_ring_queued(self):
+        self.ring_changes_deferred.return_value = True
+        self.flush_ring_changes.return_value = False
+        self.action_get.side_effect = ['all', 'd1', 'd1', 'd1']
+        actions.actions.remove_devices([])
+        self.queue_ring_change.assert_has_calls([
+            call({'type': 'remove', 'ring': ring, 'search_value': 'd1',
+                  'ramp': False})
+            for ring in ['account', 'container', 'object']])
+        self.flush_ring_changes.assert_called_once_with(
+            actions.actions.storage_nodes)
+        self.remove_from_ring.assert_not_called()
+        self.balance_rings.assert_not_called()
+        self.action_set.assert_called_once()
+
     def test_ring_invalid(self):
         self.action_get.side_effect = ['other', 'd1']
         actions.actions.remove_devices([])
@@ -360,10 +400,18 @@ class SetWeightTestCase(CharmTestCase):
         super(SetWeightTestCase, self).setUp(
             actions.actions, ["action_fail",
                               "action_get",
+                              "action_set",
+                              "config",
                               "set_weight_in_ring",
+                              "ramp_weight_in_ring",
                               "balance_rings",
+                              "ring_changes_deferred",
+                              "queue_ring_change",
+                              "flush_ring_changes",
                               "is_elected_leader"])
         self.is_elected_leader.return_value = True
+        self.config.return_value = 0
+        self.ring_changes_deferred.return_value = False
 
     def test_not_leader(self):
         self.is_elected_leader.return_value = False
@@ -377,6 +425,28 @@ class SetWeightTestCase(CharmTestCase):
             '/etc/swift/account.builder', 'd1', '0.0')
         self.balance_rings.assert_called_once()
 
+    def test_ring_valid_ramp(self):
+        self.config.return_value = 25
+        self.action_get.side_effect = ['account', False, 'd1', 50]
+        actions.actions.set_weight([])
+        self.ramp_weight_in_ring.assert_called_once_with(
+            '/etc/swift/account.builder', 'd1', 50.0)
+        self.set_weight_in_ring.assert_not_called()
+        self.balance_rings.assert_called_once()
+
+    def test_ring_queued(self):
+        self.ring_changes_deferred.return_value = True
+        self.flush_ring_changes.return_value = True
+        self.action_get.side_effect = ['object', 'd1', '0.0']
+        actions.actions.set_weight([])
+        self.queue_ring_change.assert_called_once_with(
+            {'type': 'set-weight', 'ring': 'object', 'search_value': 'd1',
+             'weight': 0.0, 'ramp': False})
+        self.set_weight_in_ring.assert_not_called()
+        self.balance_rings.assert_not_called()
+        self.action_set.assert_called_once_with(
+            {'output': 'Ring changes applied'})
+
     def test_ring_invalid(self):
         self.action_get.side_effect = ['other', 'd1', '0.0']
         actions.actions.set_weight([])
@@ -385,6 +455,154 @@ class SetWeightTestCase(CharmTestCase):
         self.balance_rings.assert_not_called()
 
 
+class RebalancePreviewTestCase(CharmTestCase):
+
+    PREVIEW = {'parts': 10, 'replicas_moved': 12, 'bytes': None,
+               'balance': 1.5, 'dispersion': 0.0,
+               'devices': [{'id': 0, 'region': 1, 'zone': 1,
+                            'ip': '10.0.0.1', 'device': 'sdb',
+                            'parts_in': 12, 'parts_out': 0}],
+               'zones': [{'region': 1, 'zone': 1, 'parts_in': 12,
+                          'parts_out': 0}]}
+
+    def setUp(self):
+        super(RebalancePreviewTestCase, self).setUp(
+            actions.actions, ["action_fail",
+                              "action_get",
+                              "action_set",
+                              "config",
+                              "preview_rebalance",
+                              "is_elected_leader"])
+        self.is_elected_leader.return_value = True
+        self.config.return_value = 0
+        self.preview_rebalance.return_value = self.PREVIEW
+
+    def test_not_leader(self):
+        self.is_elected_leader.return_value = False
+        actions.actions.rebalance_preview([])
+        self.action_fail.assert_called()
+        self.preview_rebalance.assert_not_called()
+
+    def test_ring_valid(self):
+        self.action_get.side_effect = ['account', 1024]
+        actions.actions.rebalance_preview([])
+        self.preview_rebalance.assert_called_once_with(
+            '/etc/swift/account.builder', 1024)
+        self.action_set.assert_called_once_with({
+            'account.parts-moved': 10,
+            'account.replicas-moved': 12,
+            'account.bytes-moved': 'unknown',
+            'account.balance': '1.50',
+            'account.dispersion': '0.00',
+            'account.devices': 'd0 r1z1-10.0.0.1/sdb in=12 out=0',
+            'account.zones': 'r1z1 in=12 out=0'})
+
+    def test_all_rings(self):
+        self.action_get.side_effect = ['all', None]
+        self.config.return_value = 2048
+        actions.actions.rebalance_preview([])
+        self.preview_rebalance.assert_has_calls([
+            call('/etc/swift/{}.builder'.format(ring), 2048)
+            for ring in ['account', 'container', 'object']])
+        self.assertIn('object.parts-moved', self.action_set.call_args[0][0])
+
+    def test_ring_invalid(self):
+        self.action_get.side_effect = ['other', None]
+        actions.actions.rebalance_preview([])
+        self.action_fail.assert_called()
+        self.preview_rebalance.assert_not_called()
+
+
+class WeightRampStatusTestCase(CharmTestCase):
+
+    def setUp(self):
+        super(WeightRampStatusTestCase, self).setUp(
+            actions.actions, ["action_fail",
+                              "action_set",
+                              "config",
+                              "get_weight_ramp_status",
+                              "is_elected_leader"])
+        self.is_elected_leader.return_value = True
+        self.config.return_value = 25
+
+    def test_not_leader(self):
+        self.is_elected_leader.return_value = False
+        actions.actions.weight_ramp_status([])
+        self.action_fail.assert_called()
+
+    def test_no_ramps(self):
+        self.get_weight_ramp_status.return_value = {}
+        actions.actions.weight_ramp_status([])
+        self.action_set.assert_called_once_with({'step': 25,
+                                                 'ramps': 'none'})
+
+    def test_ramps(self):
+        self.get_weight_ramp_status.return_value = {
+            'object': {
+                'next-step': 0,
+                'devices': [
+                    {'id': 1, 'ip': '1.2.3.4', 'device': 'sdb',
+                     'weight': 50.0, 'target': 100.0, 'remove': False},
+                    {'id': 2, 'ip': '1.2.3.5', 'device': 'sdb',
+                     'weight': 25.0, 'target': 0.0, 'remove': True}]}}
+        actions.actions.weight_ramp_status([])
+        results = self.action_set.call_args[0][0]
+        self.assertEqual(results['object.devices'],
+                         'd1 1.2.3.4/sdb weight=50.0 target=100.0\n'
+                         'd2 1.2.3.5/sdb weight=25.0 target=0.0 '
+                         '(then remove)')
+        self.assertIn('object.next-step', results)
+
+
+class RingSyncStatusTestCase(CharmTestCase):
+
+    def setUp(self):
+        super(RingSyncStatusTestCase, self).setUp(
+            actions.actions, ["action_fail",
+                              "action_set",
+                              "get_ring_convergence_history",
+                              "get_ring_convergence_status",
+                              "is_elected_leader",
+                              "update_ring_convergence"])
+        self.is_elected_leader.return_value = True
+        self.get_ring_convergence_history.return_value = []
+
+    def test_not_leader(self):
+        self.is_elected_leader.return_value = False
+        actions.actions.ring_sync_status([])
+        self.action_fail.assert_called()
+        self.update_ring_convergence.assert_not_called()
+
+    def test_no_ring_change(self):
+        self.get_ring_convergence_status.return_value = None
+        actions.actions.ring_sync_status([])
+        self.action_set.assert_called_once_with({'generation': 'none'})
+
+    def test_status(self):
+        self.get_ring_convergence_status.return_value = {
+            'generation': 5, 'started': 0, 'units': 3, 'synced': 2,
+            'untracked': 1,
+            'lag': {'swift-storage/0': 1.0, 'swift-storage/1': 12.5},
+            'stragglers': {'swift-proxy/2': 30.0},
+            'converged-50': 1.0, 'converged-90': None,
+            'converged-100': None}
+        self.get_ring_convergence_history.return_value = [
+            {'generation': 4, 'converged-50': 1.0, 'converged-90': 2.0,
+             'converged-100': 3.0}]
+        actions.actions.ring_sync_status([])
+        self.update_ring_convergence.assert_called_once_with()
+        results = self.action_set.call_args[0][0]
+        self.assertEqual(results['synced'], '2/3')
+        self.assertEqual(results['lag'],
+                         'swift-storage/1 12.5s\nswift-storage/0 1.0s')
+        self.assertEqual(results['stragglers'],
+                         'swift-proxy/2 waiting 30.0s')
+        self.assertEqual(results['converged-50'], '1.0s')
+        self.assertEqual(results['converged-100'], 'pending')
+        self.assertEqual(results['history'],
+                         'generation 4: 50% 1.0s, 90% 2.0s, 100% 3.0s')
+
+
 class DispersionPopulateTestCase(CharmTestCase):
 
     TEST_OUTPUT = (
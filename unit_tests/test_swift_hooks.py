@@ -13,8 +13,11 @@
 # limitations under the License.
 
 import importlib
-import subprocess
+import json
+import os
+import shutil
 import sys
+import tempfile
 import uuid
 
 import unittest
@@ -73,6 +76,156 @@ class SwiftHooksTestCase(unittest.TestCase):
                      {'stop-proxy-service-ack': token1}]
         self.assertFalse(swift_hooks.is_all_peers_stopped(responses))
 
+    @patch.object(swift_hooks, 'get_rings_url')
+    @patch.object(swift_hooks, 'get_rings_checksum')
+    @patch.object(swift_hooks, 'publish_synced_rings')
+    @patch.object(swift_hooks, 'CONFIGS')
+    @patch.object(swift_hooks, 'set_synced_ring_generation')
+    @patch.object(swift_hooks, 'get_synced_ring_generation')
+    @patch.object(swift_hooks, 'relation_set')
+    @patch.object(swift_hooks, 'log')
+    @patch.object(swift_hooks, 'service_start')
+    @patch.object(swift_hooks, 'service_stop')
+    @patch.object(swift_hooks, 'fully_synced')
+    @patch.object(swift_hooks, 'sync_proxy_rings')
+    @patch.object(swift_hooks, 'is_most_recent_timestamp')
+    @patch.object(swift_hooks, 'get_www_dir')
+    @patch.object(swift_hooks, 'ring_sync_stops_proxy')
+    @patch.object(swift_hooks, 'local_unit')
+    @patch.object(swift_hooks, 'remote_unit')
+    @patch.object(swift_hooks, 'relation_get')
+    @patch.object(swift_hooks.openstack, 'is_unit_paused_set')
+    def test_cluster_non_leader_actions_atomic(self, is_unit_paused_set,
+                                               relation_get, remote_unit,
+                                               local_unit,
+                                               ring_sync_stops_proxy,
+                                               get_www_dir,
+                                               is_most_recent_timestamp,
+                                               sync_proxy_rings,
+                                               fully_synced, service_stop,
+                                               service_start, log,
+                                               relation_set,
+                                               get_synced_ring_generation,
+                                               set_synced_ring_generation,
+                                               CONFIGS, publish_synced_rings,
+                                               get_rings_checksum,
+                                               get_rings_url):
+        get_rings_checksum.return_value = 'rings-sha'
+        get_rings_url.return_value = 'http://1.2.3.5/swift-rings'
+        is_unit_paused_set.return_value = False
+        ring_sync_stops_proxy.return_value = False
+        get_www_dir.return_value = '/var/www/html/swift-rings'
+        is_most_recent_timestamp.return_value = True
+        fully_synced.return_value = True
+        local_unit.return_value = 'swift-proxy/1'
+        settings = {
+            'rx': {'builder-broker': '1.2.3.4', 'broker-token': 'token2',
+                   'broker-timestamp': '1.0',
+                   'ring-checksums': '{"object.ring.gz": "abc"}'},
+            # an ack left over from an earlier stop-proxy handshake doesn't
+            # block the sync
+            'tx': {'stop-proxy-service-ack': 'token1'}}
+        relation_get.side_effect = \
+            lambda unit=None: settings['tx' if unit else 'rx']
+        swift_hooks.cluster_non_leader_actions()
+        sync_proxy_rings.assert_called_once_with(
+            'http://1.2.3.4/swift-rings', rings=True,
+            checksums={'object.ring.gz': 'abc'})
+        service_start.assert_called_once_with('swift-proxy')
+        service_stop.assert_not_called()
+        # the synced rings are published for this unit to mirror
+        publish_synced_rings.assert_called_once_with()
+        relation_set.assert_called_once_with(
+            relation_settings={'ring-sync-ack': 'token2',
+                               'rings-checksum': 'rings-sha',
+                               'rings-url': 'http://1.2.3.5/swift-rings'})
+
+        # a generation that is already synced isn't downloaded again, but
+        # the proxy is still (re)started
+        settings['rx']['ring-generation'] = '3'
+        get_synced_ring_generation.return_value = 3
+        sync_proxy_rings.reset_mock()
+        service_start.reset_mock()
+        swift_hooks.cluster_non_leader_actions()
+        sync_proxy_rings.assert_not_called()
+        set_synced_ring_generation.assert_not_called()
+        service_start.assert_called_once_with('swift-proxy')
+
+        get_synced_ring_generation.return_value = 2
+        swift_hooks.cluster_non_leader_actions()
+        sync_proxy_rings.assert_called_once_with(
+            'http://1.2.3.4/swift-rings', rings=True,
+            checksums={'object.ring.gz': 'abc'})
+        set_synced_ring_generation.assert_called_once_with('3')
+
+        # a bad download leaves the current rings in place
+        sync_proxy_rings.side_effect = \
+            lib.swift_utils.SwiftProxyCharmException('mismatch')
+        service_start.reset_mock()
+        swift_hooks.cluster_non_leader_actions()
+        service_start.assert_not_called()
+        service_stop.assert_not_called()
+
+        # and so does a leader change
+        settings['rx'] = {'leader-changed-notification': 'token2'}
+        swift_hooks.cluster_non_leader_actions()
+        service_stop.assert_not_called()
+        ring_sync_stops_proxy.return_value = True
+        swift_hooks.cluster_non_leader_actions()
+        service_stop.assert_called_once_with('swift-proxy')
+
+    @patch.object(swift_hooks, 'relation_set')
+    @patch.object(swift_hooks, 'log')
+    @patch.object(swift_hooks, 'service_stop')
+    @patch.object(swift_hooks, 'ring_sync_stops_proxy')
+    @patch.object(swift_hooks, 'local_unit')
+    @patch.object(swift_hooks, 'remote_unit')
+    @patch.object(swift_hooks, 'relation_get')
+    def test_cluster_non_leader_actions_rolling(self, relation_get,
+                                                remote_unit, local_unit,
+                                                ring_sync_stops_proxy,
+                                                service_stop, log,
+                                                relation_set):
+        ring_sync_stops_proxy.return_value = True
+        local_unit.return_value = 'swift-proxy/1'
+        rx = {'stop-proxy-service': 'token1', 'peers-only': None,
+              'stop-proxy-units': 'swift-proxy/2 swift-proxy/3'}
+        relation_get.side_effect = lambda unit=None: {} if unit else rx
+        swift_hooks.cluster_non_leader_actions()
+        service_stop.assert_not_called()
+        relation_set.assert_not_called()
+
+        rx['stop-proxy-units'] = 'swift-proxy/1 swift-proxy/2'
+        swift_hooks.cluster_non_leader_actions()
+        service_stop.assert_called_once_with('swift-proxy')
+        rq = relation_set.call_args[1]['relation_settings']
+        self.assertEqual(rq['stop-proxy-service-ack'], 'token1')
+
+    @patch.object(swift_hooks, 'service_start')
+    @patch.object(swift_hooks, 'sync_proxy_rings')
+    @patch.object(swift_hooks, 'log')
+    @patch.object(swift_hooks, 'ring_sync_stops_proxy')
+    @patch.object(swift_hooks, 'local_unit')
+    @patch.object(swift_hooks, 'remote_unit')
+    @patch.object(swift_hooks, 'relation_get')
+    def test_cluster_non_leader_actions_rolling_other_batch(
+            self, relation_get, remote_unit, local_unit,
+            ring_sync_stops_proxy, log, sync_proxy_rings, service_start):
+        ring_sync_stops_proxy.return_value = True
+        local_unit.return_value = 'swift-proxy/4'
+        rx = {'builder-broker': '10.0.0.1', 'broker-token': 'token1',
+              'broker-timestamp': '1.000000',
+              'ring-sync-units': 'swift-proxy/2 swift-proxy/3'}
+        tx = {}
+        relation_get.side_effect = lambda unit=None: tx if unit else rx
+        # neither a peer that has never acked nor one that acked an older
+        # sync syncs, or stops, while batch 1 does
+        for ack in (None, 'token0'):
+            tx['stop-proxy-service-ack'] = ack
+            swift_hooks.cluster_non_leader_actions()
+            sync_proxy_rings.assert_not_called()
+            service_start.assert_not_called()
+
     @patch.object(swift_hooks, 'config')
     @patch('charmhelpers.contrib.openstack.ip.config')
     @patch.object(swift_hooks, 'CONFIGS')
@@ -246,18 +399,25 @@ class SwiftHooksTestCase(unittest.TestCase):
     @patch.object(swift_hooks, 'is_elected_leader')
     @patch.object(swift_hooks, 'get_relation_ip')
     @patch.object(swift_hooks, 'try_initialize_swauth')
-    @patch.object(swift_hooks, 'mark_www_rings_deleted')
     @patch.object(swift_hooks, 'service_stop')
     @patch.object(swift_hooks, 'relation_set')
     def test_swift_storage_joined(self, relation_set, service_stop,
-                                  mark_www_rings_deleted,
                                   try_initialize_swauth,
                                   get_relation_ip,
                                   is_elected_leader,
                                   mock_clear_storage_rings_available):
         is_elected_leader.return_value = False
         get_relation_ip.return_value = '10.10.20.243'
-        swift_hooks.storage_joined(rid='swift-storage:23')
+        # a peer the leader lists as a mirror
+        www_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, www_dir)
+        ring = os.path.join(www_dir, 'object.ring.gz')
+        with open(ring, 'w') as fd:
+            fd.write('ring')
+        with patch('lib.swift_utils.get_www_dir', lambda: www_dir):
+            swift_hooks.storage_joined(rid='swift-storage:23')
+        # it keeps serving its rings to the storage units mirroring from it
+        self.assertTrue(os.path.exists(ring))
         get_relation_ip.assert_called_with('swift-storage')
         relation_set.assert_called_with(
             relation_id='swift-storage:23',
@@ -265,23 +425,38 @@ class SwiftHooksTestCase(unittest.TestCase):
         )
         try_initialize_swauth.assert_called_once()
         mock_clear_storage_rings_available.assert_called_once()
+        # non-leaders keep serving with their current rings
+        service_stop.assert_not_called()
 
+    @patch.object(swift_hooks, 'update_ring_convergence', MagicMock())
+    @patch.object(swift_hooks, 'ring_changes_deferred', lambda: False)
     @patch.object(swift_hooks, 'log')
     @patch.object(swift_hooks, 'service_restart')
     @patch.object(swift_hooks.openstack, 'is_unit_paused_set')
     @patch.object(swift_hooks, 'update_rings')
     @patch.object(swift_hooks, 'config')
-    @patch.object(swift_hooks, 'get_zone')
+    @patch.object(swift_hooks, 'ZoneAssigner')
     @patch.object(swift_hooks, 'update_rsync_acls')
     @patch.object(swift_hooks, 'get_host_ip')
     @patch.object(swift_hooks, 'is_elected_leader')
+    @patch.object(swift_hooks, 'related_units')
+    @patch.object(swift_hooks, 'relation_ids')
     @patch.object(swift_hooks, 'relation_get')
-    def test_swift_storage_changed(self, relation_get, is_elected_leader,
-                                   get_host_ip, update_rsync_acls, get_zone,
-                                   config, update_rings, is_unit_paused_set,
-                                   service_restart, log):
+    def test_swift_storage_changed(self, relation_get, relation_ids,
+                                   related_units, is_elected_leader,
+                                   get_host_ip, update_rsync_acls,
+                                   zone_assigner, config, update_rings,
+                                   is_unit_paused_set, service_restart, log):
         is_elected_leader.return_value = True
-        get_host_ip.return_value = '10.0.0.10'
+        is_unit_paused_set.return_value = False
+        relation_ids.return_value = ['swift-storage:1']
+        related_units.return_value = ['swift-storage/0', 'swift-storage/1',
+                                      'swift-storage/2', 'swift-storage/3']
+        host_ips = {'swift-storage/0': '10.0.0.10',
+                    'swift-storage/1': '10.0.0.11',
+                    'swift-storage/2': '10.0.0.12',
+                    'swift-storage/3': None}
+        get_host_ip.side_effect = lambda rid, unit: host_ips[unit]
         rel_data = {
             'account_port': '6002',
             'container_port': '6001',
@@ -291,15 +466,43 @@ class SwiftHooksTestCase(unittest.TestCase):
             'object_port': '6000',
             'private-address': '10.5.0.37',
             'zone': '1'}
-        relation_get.side_effect = lambda x: rel_data.get(x)
+        units = {'swift-storage/0': rel_data,
+                 'swift-storage/1': dict(rel_data, device='vdc:vdd'),
+                 # not ready yet
+                 'swift-storage/2': dict(rel_data, object_port=None),
+                 'swift-storage/3': rel_data}
+        relation_get.side_effect = lambda rid, unit: units[unit]
+        zone_assigner.return_value.zone.side_effect = \
+            lambda ip, devices, rid, unit: {'10.0.0.10': '1',
+                                            '10.0.0.11': 2}[ip]
         swift_hooks.storage_changed()
-        update_rings.assert_called_once_with([{
-            'ip': '10.0.0.10',
-            'zone': 1,
-            'account_port': 6002,
-            'object_port': 6000,
-            'container_port': 6001,
-            'device': 'vdc'}])
+
+        # all the units are reconciled by a single update
+        update_rsync_acls.assert_called_once_with()
+        node = {'account_port': 6002, 'object_port': 6000,
+                'container_port': 6001}
+        update_rings.assert_called_once_with([
+            dict(node, ip='10.0.0.10', zone=1, device='vdc'),
+            dict(node, ip='10.0.0.11', zone=2, device='vdc'),
+            dict(node, ip='10.0.0.11', zone=2, device='vdd')])
+        zone_assigner.return_value.zone.assert_has_calls([
+            call('10.0.0.10', 1, rid='swift-storage:1',
+                 unit='swift-storage/0'),
+            call('10.0.0.11', 2, rid='swift-storage:1',
+                 unit='swift-storage/1')])
+        service_restart.assert_called_once_with('swift-proxy')
+
+    @patch.object(swift_hooks, 'ring_changes_deferred', lambda: True)
+    @patch.object(swift_hooks, 'update_rings')
+    @patch.object(swift_hooks, 'flush_ring_changes')
+    @patch.object(swift_hooks, 'queue_ring_change')
+    def test_reconcile_storage_rings_deferred(self, queue_ring_change,
+                                              flush_ring_changes,
+                                              update_rings):
+        swift_hooks.reconcile_storage_rings()
+        queue_ring_change.assert_called_once_with({'type': 'storage'})
+        flush_ring_changes.assert_called_once_with(swift_hooks.storage_nodes)
+        update_rings.assert_not_called()
 
     @patch.object(swift_hooks, 'status_set')
     @patch.object(swift_hooks, 'is_leader')
@@ -328,10 +531,17 @@ class SwiftHooksTestCase(unittest.TestCase):
             ('Swift Proxy cannot act as both rings distributor and rings '
              'consumer'))
 
+    @patch.object(swift_hooks, 'update_ring_convergence')
+    @patch.object(swift_hooks, 'is_elected_leader')
     @patch.object(swift_hooks, 'broadcast_rings_available')
-    def test_rings_distributor_changed(self, broadcast_rings_available):
+    def test_rings_distributor_changed(self, broadcast_rings_available,
+                                       is_elected_leader,
+                                       update_ring_convergence):
+        is_elected_leader.return_value = True
         swift_hooks.rings_distributor_changed()
         broadcast_rings_available.assert_called_once_with()
+        # consumers echo the rings they installed
+        update_ring_convergence.assert_called_once_with()
 
     @patch.object(swift_hooks, 'is_leader')
     @patch.object(lib.swift_utils, 'leader_set')
@@ -383,6 +593,8 @@ class SwiftHooksTestCase(unittest.TestCase):
             'blocked',
             'Swift Proxy already acting as rings consumer')
 
+    @patch.object(swift_hooks, 'get_rings_checksum')
+    @patch.object(swift_hooks, 'relation_set')
     @patch.object(swift_hooks, 'get_swift_hash')
     @patch.object(swift_hooks, 'broadcast_rings_available')
     @patch.object(swift_hooks, 'fetch_swift_rings_and_builders')
@@ -390,7 +602,9 @@ class SwiftHooksTestCase(unittest.TestCase):
     def test_rings_consumer_changed(self, relation_get,
                                     fetch_swift_rings_and_builders,
                                     broadcast_rings_available,
-                                    get_swift_hash):
+                                    get_swift_hash, relation_set,
+                                    get_rings_checksum):
+        get_rings_checksum.return_value = 'rings-sha'
         rel_data = {
             'rings_url': 'http://some-url:999',
             'swift_hash': 'swhash'}
@@ -400,6 +614,41 @@ class SwiftHooksTestCase(unittest.TestCase):
         fetch_swift_rings_and_builders.assert_called_once_with(
             'http://some-url:999')
         broadcast_rings_available.assert_called_once_with()
+        relation_set.assert_called_once_with(rings_checksum='rings-sha')
+
+    @patch.object(swift_hooks, 'get_rings_checksum', MagicMock())
+    @patch.object(swift_hooks, 'relation_set', MagicMock())
+    @patch.object(swift_hooks, 'log')
+    @patch.object(lib.swift_utils, 'local_unit')
+    @patch.object(swift_hooks, 'get_swift_hash')
+    @patch.object(swift_hooks, 'broadcast_rings_available')
+    @patch.object(swift_hooks, 'fetch_swift_rings_and_builders')
+    @patch.object(swift_hooks, 'relation_get')
+    def test_rings_consumer_changed_mirrors(self, relation_get,
+                                            fetch_swift_rings_and_builders,
+                                            broadcast_rings_available,
+                                            get_swift_hash, local_unit, log):
+        mirrors = ['http://10.0.0.{}/swift-rings'.format(i)
+                   for i in range(1, 4)]
+        rel_data = {
+            'rings_url': mirrors[0],
+            'rings_mirrors': json.dumps(mirrors),
+            'swift_hash': 'swhash'}
+        relation_get.side_effect = lambda x: rel_data.get(x)
+        get_swift_hash.return_value = 'swhash'
+        local_unit.return_value = 'swift-proxy-region2/0'
+        first = lib.swift_utils.order_rings_mirrors(mirrors)[0]
+
+        def _fetch(url):
+            if url == first:
+                raise lib.swift_utils.RingFetchError('HTTP 503')
+        fetch_swift_rings_and_builders.side_effect = _fetch
+        swift_hooks.rings_consumer_changed()
+        # the next mirror is tried if the unit's own one fails
+        self.assertEqual(fetch_swift_rings_and_builders.call_count, 2)
+        self.assertEqual(fetch_swift_rings_and_builders.call_args_list[0],
+                         call(first))
+        broadcast_rings_available.assert_called_once_with()
 
     @patch.object(swift_hooks, 'log')
     @patch.object(swift_hooks, 'get_swift_hash')
@@ -479,7 +728,7 @@ class SwiftHooksTestCase(unittest.TestCase):
         get_swift_hash.return_value = 'swhash'
 
         def _fetch(url):
-            raise subprocess.CalledProcessError('cmd', 1)
+            raise lib.swift_utils.RingFetchError('HTTP 503')
         fetch_swift_rings_and_builders.side_effect = _fetch
         swift_hooks.rings_consumer_changed()
         fetch_swift_rings_and_builders.assert_called_once_with(
@@ -0,0 +1,137 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import json
+import os
+import unittest
+from unittest import mock
+
+from charmhelpers.core import hookenv
+
+with mock.patch('charmhelpers.core.hookenv.config'):
+    import lib.swift_relations as swift_relations
+    import lib.swift_context as swift_context
+    import lib.swift_utils as swift_utils
+
+STORAGE_UNITS = 200
+CONFIG = {'prefer-ipv6': True, 'replicas': 3, 'vip': None}
+
+
+class FakeJuju(object):
+    """Answers the hook tools charmhelpers runs, counting the calls."""
+
+    def __init__(self, units):
+        self.units = units
+        self.calls = collections.Counter()
+
+    def __call__(self, cmd, **kwargs):
+        self.calls[cmd[0]] += 1
+        if cmd[0] == 'relation-ids':
+            rids = {'swift-storage': ['swift-storage:1']}
+            return json.dumps(rids.get(cmd[-1], [])).encode('UTF-8')
+        if cmd[0] in ('related-units', 'relation-list'):
+            units = self.units if cmd[-1] == 'swift-storage:1' else []
+            return json.dumps(units).encode('UTF-8')
+        if cmd[0] == 'relation-get':
+            unit = cmd[-1]
+            attribute = cmd[-2]
+            settings = {'private-address': 'fd00::{}'.format(
+                unit.split('/')[1]), 'rings_checksum': 'abc'}
+            if attribute != '-':
+                settings = settings.get(attribute)
+            return json.dumps(settings).encode('UTF-8')
+        raise AssertionError('unexpected hook tool {}'.format(cmd))
+
+
+class RelationSnapshotTestCase(unittest.TestCase):
+
+    def setUp(self):
+        units = ['swift-storage/{}'.format(i) for i in range(STORAGE_UNITS)]
+        self.juju = FakeJuju(units)
+        for patcher in (
+                mock.patch.object(hookenv.subprocess, 'check_output',
+                                  side_effect=self.juju),
+                mock.patch.dict(os.environ,
+                                {'JUJU_UNIT_NAME': 'swift-proxy/0'}),
+                mock.patch.object(swift_context, 'config', CONFIG.get),
+                mock.patch.object(swift_context, 'get_ipv6_addr',
+                                  return_value=['fd00::ff']),
+                mock.patch.object(swift_utils, 'config', CONFIG.get),
+                mock.patch.object(swift_utils, 'has_minimum_zones',
+                                  return_value=True),
+                mock.patch.object(swift_utils, 'is_leader',
+                                  return_value=False)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addCleanup(hookenv.cache.clear)
+        self.addCleanup(swift_relations._SNAPSHOT.clear)
+        hookenv.cache.clear()
+        swift_relations._SNAPSHOT.clear()
+
+    def storage_changed(self):
+        # the lookups a leader's swift-storage-relation-changed hook makes
+        self.assertEqual(
+            swift_utils.customer_check_assess_status(None),
+            ('active', 'Unit is ready'))
+        receivers = list(swift_utils._ring_receivers())
+        self.assertEqual(len(receivers), STORAGE_UNITS)
+
+    def test_relation_get_per_unit(self):
+        self.storage_changed()
+        self.assertEqual(self.juju.calls['relation-get'], STORAGE_UNITS)
+
+    def test_relation_get_without_snapshot(self):
+        with mock.patch.object(swift_context, 'relation_get',
+                               hookenv.relation_get), \
+                mock.patch.object(swift_utils, 'relation_get',
+                                  hookenv.relation_get):
+            self.storage_changed()
+        # positional, keyword and whole-unit lookups are all separate calls
+        self.assertEqual(self.juju.calls['relation-get'], 3 * STORAGE_UNITS)
+
+    def test_relation_get_attribute(self):
+        self.assertEqual(
+            swift_relations.relation_get('private-address',
+                                         'swift-storage/7',
+                                         'swift-storage:1'),
+            'fd00::7')
+        self.assertEqual(
+            swift_relations.relation_get(attribute='rings_checksum',
+                                         unit='swift-storage/7',
+                                         rid='swift-storage:1'),
+            'abc')
+        self.assertIsNone(
+            swift_relations.relation_get('missing', 'swift-storage/7',
+                                         'swift-storage:1'))
+        self.assertEqual(self.juju.calls['relation-get'], 1)
+
+    def test_relation_get_copy(self):
+        settings = swift_relations.relation_get(unit='swift-storage/7',
+                                                rid='swift-storage:1')
+        settings['private-address'] = '10.0.0.1'
+        self.assertEqual(
+            swift_relations.relation_get('private-address',
+                                         'swift-storage/7',
+                                         'swift-storage:1'),
+            'fd00::7')
+
+    def test_relation_get_local_unit(self):
+        # the local unit's settings change with relation_set()
+        for _ in range(2):
+            swift_relations.relation_get('private-address', 'swift-proxy/0',
+                                         'swift-storage:1')
+            hookenv.cache.clear()
+        self.assertEqual(self.juju.calls['relation-get'], 2)
+        self.assertEqual(swift_relations._SNAPSHOT, {})
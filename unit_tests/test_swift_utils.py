@@ -12,14 +12,23 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import collections
 import copy
+import gzip
+import hashlib
+import http.server
+import json
 from unittest import mock
 import os
+import pickle
 import shutil
 import tempfile
+import threading
+import time
 import uuid
 import unittest
 import subprocess
+import sys
 
 with mock.patch('charmhelpers.core.hookenv.config'):
     import lib.swift_utils as swift_utils
@@ -71,13 +80,13 @@ class SwiftUtilsTestCase(unittest.TestCase):
     @mock.patch('lib.swift_utils.os.path.exists')
     @mock.patch('lib.swift_utils.is_elected_leader')
     @mock.patch('lib.swift_utils.get_min_part_hours')
-    @mock.patch('lib.swift_utils.set_min_part_hours')
-    @mock.patch('lib.swift_utils.write_rings')
+    @mock.patch('lib.swift_utils.apply_ring_operations')
     @mock.patch('lib.swift_utils.nodes_have_rep_data')
     def test_update_rings(self,
                           mock_nodes_have_rep_data,
-                          mock_write_rings, mock_set_min_hours,
-                          mock_get_min_hours, mock_is_elected_leader,
+                          mock_apply_ring_operations,
+                          mock_get_min_part_hours,
+                          mock_is_elected_leader,
                           mock_path_exists, mock_log, mock_balance_rings,
                           mock_get_rings_checksum, mock_get_builders_checksum,
                           mock_update_www_rings, mock_previously_synced):
@@ -96,46 +105,60 @@ class SwiftUtilsTestCase(unittest.TestCase):
         # Test blocker 2
         mock_path_exists.return_value = False
         mock_is_elected_leader.return_value = True
-        swift_utils.update_rings()
-        self.assertFalse(mock_get_min_hours.called)
+        swift_utils.update_rings(min_part_hours=10)
+        self.assertFalse(mock_apply_ring_operations.called)
         self.assertFalse(mock_balance_rings.called)
 
         # Test blocker 3
         mock_path_exists.return_value = True
         mock_is_elected_leader.return_value = True
-        mock_get_min_hours.return_value = 10
+        mock_get_min_part_hours.return_value = 10
         swift_utils.update_rings(min_part_hours=10)
-        self.assertTrue(mock_get_min_hours.called)
-        self.assertFalse(mock_set_min_hours.called)
+        self.assertFalse(mock_apply_ring_operations.called)
         self.assertFalse(mock_balance_rings.called)
 
-        mock_get_min_hours.reset_mock()
-
         # Test go through
-        mock_path_exists.return_value = True
-        mock_is_elected_leader.return_value = True
-        mock_get_min_hours.return_value = 0
+        mock_get_min_part_hours.return_value = 1
+        mock_apply_ring_operations.return_value = [True]
         swift_utils.update_rings(min_part_hours=10)
-        self.assertTrue(mock_get_min_hours.called)
-        self.assertTrue(mock_set_min_hours.called)
+        mock_apply_ring_operations.assert_has_calls([
+            mock.call(path, [{'op': 'set_min_part_hours',
+                              'min_part_hours': 10}])
+            for path in swift_utils.SWIFT_RINGS.values()])
+        self.assertEqual(mock_apply_ring_operations.call_count, 3)
         self.assertTrue(mock_balance_rings.called)
-        mock_write_rings.assert_not_called()
 
+        # Failing to set min_part_hours is only logged, and the other
+        # changes are still applied
+        mock_apply_ring_operations.reset_mock()
+        mock_balance_rings.reset_mock()
+
+        def apply_ring_operations(path, operations):
+            if operations[0]['op'] == 'set_min_part_hours':
+                raise swift_utils.SwiftProxyCharmException('locked')
+            return [1] * len(operations)
+
+        mock_apply_ring_operations.side_effect = apply_ring_operations
+        path = swift_utils.SWIFT_RINGS['object']
+        remove = {'op': 'remove', 'search_value': 'd1'}
+        self.assertTrue(swift_utils.update_rings(
+            min_part_hours=10, operations={path: [remove]}))
+        mock_apply_ring_operations.assert_any_call(path, [remove])
+        mock_log.assert_any_call('locked', level=swift_utils.WARNING)
+        self.assertTrue(mock_balance_rings.called)
+
+    @mock.patch('lib.swift_utils.config', lambda key: None)
     @mock.patch('lib.swift_utils.previously_synced')
     @mock.patch('lib.swift_utils.balance_rings')
-    @mock.patch('lib.swift_utils.add_to_ring')
-    @mock.patch('lib.swift_utils.exists_in_ring')
+    @mock.patch('lib.swift_utils.apply_ring_operations')
+    @mock.patch('lib.swift_utils.get_ring_index')
     @mock.patch('lib.swift_utils.is_elected_leader')
-    @mock.patch('lib.swift_utils.update_ring_node_ports')
-    @mock.patch('lib.swift_utils.write_rings')
     @mock.patch('lib.swift_utils.nodes_have_rep_data')
     def test_update_rings_multiple_devs(self,
                                         mock_nodes_have_rep_data,
-                                        mock_write_rings,
-                                        mock_update_ring_node_ports,
                                         mock_is_leader_elected,
-                                        mock_exists_in_ring,
-                                        mock_add_to_ring,
+                                        mock_get_ring_index,
+                                        mock_apply_ring_operations,
                                         mock_balance_rings,
                                         mock_previously_synced):
         # note that this test does not (and neither did its predecessor) test
@@ -157,76 +180,140 @@ class SwiftUtilsTestCase(unittest.TestCase):
 
         mock_is_leader_elected.return_value = True
         mock_previously_synced.return_value = True
-        mock_exists_in_ring.side_effect = lambda *args: False
-        mock_nodes_have_rep_data.return_value = True
+        mock_get_ring_index.return_value = {'devs': []}
+        mock_nodes_have_rep_data.return_value = False
+        mock_apply_ring_operations.side_effect = \
+            lambda path, ops: [None] * len(ops)
 
         swift_utils.update_rings(nodes)
-        calls = [mock.call(os.path.join(swift_utils.SWIFT_CONF_DIR,
-                                        'account.builder'),
-                           {
-                               'zone': 1,
-                               'object_port': 6000,
-                               'ip': '1.2.3.4',
-                               'container_port': 6001,
-                               'device': 'sdb',
-                               'account_port': 6002}),
-                 mock.call(os.path.join(swift_utils.SWIFT_CONF_DIR,
-                                        'container.builder'),
-                           {
-                               'zone': 1,
-                               'object_port': 6000,
-                               'ip': '1.2.3.4',
-                               'container_port': 6001,
-                               'device': 'sdb',
-                               'account_port': 6002}),
-                 mock.call(os.path.join(swift_utils.SWIFT_CONF_DIR,
-                                        'object.builder'),
-                           {
-                               'zone': 1,
-                               'object_port': 6000,
-                               'ip': '1.2.3.4',
-                               'container_port': 6001,
-                               'device': 'sdb',
-                               'account_port': 6002}),
-                 mock.call(os.path.join(swift_utils.SWIFT_CONF_DIR,
-                                        'account.builder'),
-                           {
-                               'zone': 1,
-                               'object_port': 6000,
-                               'ip': '1.2.3.4',
-                               'container_port': 6001,
-                               'device': 'sdc',
-                               'account_port': 6002}),
-                 mock.call(os.path.join(swift_utils.SWIFT_CONF_DIR,
-                                        'container.builder'),
-                           {
-                               'zone': 1,
-                               'object_port': 6000,
-                               'ip': '1.2.3.4',
-                               'container_port': 6001,
-                               'device': 'sdc',
-                               'account_port': 6002}),
-                 mock.call(os.path.join(swift_utils.SWIFT_CONF_DIR,
-                                        'object.builder'),
-                           {
-                               'zone': 1,
-                               'object_port': 6000,
-                               'ip': '1.2.3.4',
-                               'container_port': 6001,
-                               'device': 'sdc',
-                               'account_port': 6002})]
-        mock_exists_in_ring.assert_has_calls(calls)
+        mock_get_ring_index.assert_has_calls([
+            mock.call(os.path.join(swift_utils.SWIFT_CONF_DIR,
+                                   '{}.builder'.format(ring)))
+            for ring in ['account', 'container', 'object']])
         mock_balance_rings.assert_called_once_with()
-        mock_add_to_ring.assert_called()
-        mock_update_ring_node_ports.assert_called()
-        mock_write_rings.assert_called()
 
-        # try re-adding, assert add_to_ring was not called
-        mock_add_to_ring.reset_mock()
-        mock_exists_in_ring.side_effect = lambda *args: True
+        # one transaction per ring, adding both devices
+        self.assertEqual(mock_apply_ring_operations.call_count, 3)
+        path, ops = mock_apply_ring_operations.call_args_list[0][0]
+        self.assertEqual(path, os.path.join(swift_utils.SWIFT_CONF_DIR,
+                                            'account.builder'))
+        self.assertEqual(
+            ops,
+            [{'op': 'add_dev',
+              'dev': {'zone': 1, 'ip': '1.2.3.4', 'port': 6002,
+                      'device': dev, 'weight': 100, 'meta': ''}}
+             for dev in devices])
+        # the nodes passed in are not modified
+        self.assertNotIn('port', nodes[0])
+
+        # try re-adding, assert no devices were added
+        mock_apply_ring_operations.reset_mock()
+        mock_balance_rings.reset_mock()
+        mock_get_ring_index.side_effect = lambda path: {'devs': [
+            {'id': i, 'zone': 2, 'ip': '1.2.3.4', 'device': dev,
+             'port': swift_utils._ring_port(path, node_settings)}
+            for i, dev in enumerate(devices)]}
         swift_utils.update_rings(nodes)
-        mock_add_to_ring.assert_not_called()
+        mock_apply_ring_operations.assert_not_called()
+        mock_balance_rings.assert_not_called()
 
+    @mock.patch('lib.swift_utils.config')
+    @mock.patch('lib.swift_utils.schedule_weight_ramps')
+    @mock.patch('lib.swift_utils.previously_synced')
+    @mock.patch('lib.swift_utils.balance_rings')
+    @mock.patch('lib.swift_utils.apply_ring_operations')
+    @mock.patch('lib.swift_utils.get_ring_index')
+    @mock.patch('lib.swift_utils.is_elected_leader')
+    def test_update_rings_weight_ramp(self,
+                                      mock_is_leader_elected,
+                                      mock_get_ring_index,
+                                      mock_apply_ring_operations,
+                                      mock_balance_rings,
+                                      mock_previously_synced,
+                                      mock_schedule_weight_ramps,
+                                      mock_config):
+        node = {'object_port': 6000, 'container_port': 6001,
+                'account_port': 6002, 'zone': 1, 'ip': '1.2.3.4',
+                'device': 'sdb'}
+        mock_config.side_effect = lambda key: {'weight-ramp-step': 25}[key]
+        mock_is_leader_elected.return_value = True
+        mock_previously_synced.return_value = True
+        mock_get_ring_index.return_value = {'devs': []}
+        mock_apply_ring_operations.return_value = [7]
+
+        swift_utils.update_rings([node])
+        ops = mock_apply_ring_operations.call_args_list[0][0][1]
+        self.assertEqual(ops[0]['dev']['weight'], 25)
+        mock_schedule_weight_ramps.assert_has_calls([
+            mock.call(path, [dict(ring_dev, id=7)], 100, first_step=False)
+            for path, ring_dev in
+            [(c[0][0], c[0][1][0]['dev'])
+             for c in mock_apply_ring_operations.call_args_list]])
+        self.assertEqual(mock_schedule_weight_ramps.call_count, 3)
+        mock_balance_rings.assert_called_once_with()
+
+    @mock.patch('lib.swift_utils.previously_synced')
+    @mock.patch('lib.swift_utils.balance_rings')
+    @mock.patch('lib.swift_utils.apply_ring_operations')
+    @mock.patch('lib.swift_utils.get_ring_index')
+    @mock.patch('lib.swift_utils.is_elected_leader')
+    def test_update_rings_rep_data(self,
+                                   mock_is_leader_elected,
+                                   mock_get_ring_index,
+                                   mock_apply_ring_operations,
+                                   mock_balance_rings,
+                                   mock_previously_synced):
+        node = {
+            'ip': '1.2.3.4',
+            'ip_rep': '2.3.4.5',
+            'region': 1,
+            'zone': 1,
+            'device': 'sdb',
+            'account_port': 6002,
+            'account_port_rep': 6012,
+            'container_port': 6001,
+            'container_port_rep': 6011,
+            'object_port': 6000,
+            'object_port_rep': 6010,
+        }
+        mock_is_leader_elected.return_value = True
+        mock_previously_synced.return_value = True
+
+        def _ring_index(path):
+            port = swift_utils._ring_port(path, node)
+            port_rep = swift_utils._ring_port_rep(path, node)
+            if 'object' in path:
+                # the object ring has the old replication port
+                port_rep -= 100
+            return {'devs': [{'id': 0, 'region': 1, 'zone': 1,
+                              'ip': '1.2.3.4', 'port': port,
+                              'replication_ip': '2.3.4.5',
+                              'replication_port': port_rep,
+                              'device': 'sdb'}]}
+
+        mock_get_ring_index.side_effect = _ring_index
+        mock_apply_ring_operations.side_effect = \
+            lambda path, ops: [None] * len(ops)
+
+        swift_utils.update_rings([node])
+        mock_apply_ring_operations.assert_has_calls([
+            mock.call(
+                os.path.join(swift_utils.SWIFT_CONF_DIR, 'account.builder'),
+                [{'op': 'write_ring'}]),
+            mock.call(
+                os.path.join(swift_utils.SWIFT_CONF_DIR, 'container.builder'),
+                [{'op': 'write_ring'}]),
+            mock.call(
+                os.path.join(swift_utils.SWIFT_CONF_DIR, 'object.builder'),
+                [{'op': 'set_info',
+                  'search': {'ip': '1.2.3.4', 'replication_ip': '2.3.4.5',
+                             'device': 'sdb'},
+                  'changes': {'port': 6000, 'replication_port': 6010}},
+                 {'op': 'write_ring'}])])
+        mock_balance_rings.assert_not_called()
+
+    @mock.patch('lib.swift_utils.kv')
+    @mock.patch('lib.swift_utils.publish_ring_generation')
     @mock.patch('lib.swift_utils.balance_rings')
     @mock.patch('lib.swift_utils.log')
     @mock.patch('lib.swift_utils.is_elected_leader')
@@ -238,7 +325,12 @@ class SwiftUtilsTestCase(unittest.TestCase):
                                                 mock_config,
                                                 mock_is_elected_leader,
                                                 mock_log,
-                                                mock_balance_rings):
+                                                mock_balance_rings,
+                                                mock_publish_ring_generation,
+                                                mock_kv):
+        store = {}
+        mock_kv.return_value.get.side_effect = store.get
+        mock_kv.return_value.set.side_effect = store.__setitem__
 
         _SWIFT_CONF_DIR = copy.deepcopy(swift_utils.SWIFT_CONF_DIR)
         _SWIFT_RINGS = copy.deepcopy(swift_utils.SWIFT_RINGS)
@@ -265,9 +357,708 @@ class SwiftUtilsTestCase(unittest.TestCase):
 
         self.assertTrue(mock_update_www_rings.called)
         self.assertTrue(mock_cluster_sync_rings.called)
+        mock_publish_ring_generation.assert_called_once_with()
         swift_utils.SWIFT_CONF_DIR = _SWIFT_CONF_DIR
         swift_utils.SWIFT_RINGS = _SWIFT_RINGS
 
+    @mock.patch('lib.swift_utils.get_hostaddr')
+    @mock.patch('lib.swift_utils.notify_storage_and_consumers_rings_available')
+    @mock.patch('lib.swift_utils.get_ring_generation')
+    @mock.patch('lib.swift_utils.relation_set')
+    @mock.patch('lib.swift_utils.relation_ids')
+    @mock.patch('lib.swift_utils.peer_units')
+    @mock.patch('lib.swift_utils.previously_synced')
+    @mock.patch('lib.swift_utils.publish_ring_generation')
+    @mock.patch('lib.swift_utils.update_www_rings')
+    @mock.patch('lib.swift_utils.is_elected_leader')
+    @mock.patch('lib.swift_utils.config')
+    @mock.patch('lib.swift_utils.log')
+    @mock.patch('lib.swift_utils.kv')
+    @mock.patch('lib.swift_utils.file_checksum',
+                wraps=swift_utils.file_checksum)
+    def test_ring_transaction(self, mock_file_checksum, mock_kv, mock_log,
+                              mock_config, mock_is_elected_leader,
+                              mock_update_www_rings,
+                              mock_publish_ring_generation,
+                              mock_previously_synced, mock_peer_units,
+                              mock_relation_ids, mock_relation_set,
+                              mock_get_ring_generation, mock_notify_storage,
+                              mock_get_hostaddr):
+        mock_get_hostaddr.return_value = '10.0.0.1'
+        store = {}
+        mock_kv.return_value.get.side_effect = store.get
+        mock_kv.return_value.set.side_effect = store.__setitem__
+        mock_config.side_effect = lambda key: {
+            'ring-sync-mode': 'atomic'}.get(key)
+        mock_is_elected_leader.return_value = True
+        mock_previously_synced.return_value = True
+        mock_peer_units.return_value = ['swift-proxy/1']
+        mock_relation_ids.return_value = ['cluster:1']
+        mock_get_ring_generation.return_value = 1
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        rings = {r: os.path.join(tmpdir, '{}.builder'.format(r))
+                 for r in ['account', 'container', 'object']}
+
+        def write(name):
+            path = os.path.join(tmpdir, name)
+            with open(path + '.tmp', 'w') as fd:
+                fd.write(str(uuid.uuid4()))
+            os.rename(path + '.tmp', path)
+
+        @swift_utils.sync_builders_and_rings_if_changed
+        def balance(ring):
+            write('{}.builder'.format(ring))
+            write('{}.ring.gz'.format(ring))
+
+        @swift_utils.sync_builders_and_rings_if_changed
+        def update():
+            # like update_rings(), which may balance the rings itself
+            for ring in rings:
+                balance(ring)
+
+        def hook():
+            # like config_changed(), which updates and then balances
+            update()
+            balance('object')
+
+        with mock.patch.object(swift_utils, 'SWIFT_CONF_DIR', tmpdir), \
+                mock.patch.object(swift_utils, 'SWIFT_RINGS', rings):
+            # without a transaction each top level operation syncs
+            hook()
+            self.assertEqual(mock_update_www_rings.call_count, 2)
+            self.assertEqual(mock_relation_set.call_count, 2)
+
+            mock_update_www_rings.reset_mock()
+            mock_relation_set.reset_mock()
+            mock_notify_storage.reset_mock()
+            mock_file_checksum.reset_mock()
+            with swift_utils.ring_transaction():
+                hook()
+
+            # one snapshot and one sync for the whole hook
+            mock_update_www_rings.assert_called_once_with(rings=True)
+            mock_publish_ring_generation.assert_called_with()
+            self.assertEqual(mock_relation_set.call_count, 1)
+            self.assertEqual(mock_notify_storage.call_count, 1)
+            # every file is read once, after it changed, and the sync request
+            # reuses those checksums
+            self.assertEqual(mock_file_checksum.call_count, 6)
+
+            # nothing is published if no ring operation ran
+            mock_update_www_rings.reset_mock()
+            mock_relation_set.reset_mock()
+            with swift_utils.ring_transaction():
+                write('object.ring.gz')
+            self.assertFalse(mock_update_www_rings.called)
+            self.assertFalse(mock_relation_set.called)
+
+            # nor on non-leaders
+            mock_is_elected_leader.return_value = False
+            with swift_utils.ring_transaction():
+                hook()
+            self.assertFalse(mock_update_www_rings.called)
+            self.assertFalse(mock_relation_set.called)
+
+            # a hook failure is not masked by a failure to publish
+            mock_is_elected_leader.return_value = True
+            mock_update_www_rings.side_effect = \
+                swift_utils.SwiftProxyCharmException('www dir unavailable')
+            mock_log.reset_mock()
+            with self.assertRaises(ValueError):
+                with swift_utils.ring_transaction():
+                    hook()
+                    raise ValueError('hook failed')
+            mock_log.assert_any_call(
+                "Failed to publish ring changes after the hook failed: "
+                "www dir unavailable", level=swift_utils.ERROR)
+            self.assertIsNone(swift_utils._RING_TRANSACTION)
+
+            # without a hook failure the publish failure is raised
+            with self.assertRaises(swift_utils.SwiftProxyCharmException):
+                with swift_utils.ring_transaction():
+                    hook()
+            self.assertIsNone(swift_utils._RING_TRANSACTION)
+
+    @mock.patch('lib.swift_utils.file_checksum',
+                wraps=swift_utils.file_checksum)
+    @mock.patch('lib.swift_utils.kv')
+    def test_cached_file_checksums(self, mock_kv, mock_file_checksum):
+        store = {}
+        mock_kv.return_value.get.side_effect = store.get
+        mock_kv.return_value.set.side_effect = store.__setitem__
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        rings = {r: os.path.join(tmpdir, '{}.builder'.format(r))
+                 for r in ['account', 'container', 'object']}
+
+        def write(name, content):
+            path = os.path.join(tmpdir, name)
+            with open(path + '.tmp', 'w') as fd:
+                fd.write(content)
+            os.rename(path + '.tmp', path)
+
+        for r in rings:
+            write('{}.builder'.format(r), '{} builder'.format(r))
+            write('{}.ring.gz'.format(r), '{} ring'.format(r))
+
+        with mock.patch.object(swift_utils, 'SWIFT_CONF_DIR', tmpdir), \
+                mock.patch.object(swift_utils, 'SWIFT_RINGS', rings):
+            rings_checksum = swift_utils.get_rings_checksum()
+            builders_checksum = swift_utils.get_builders_checksum()
+            self.assertEqual(mock_file_checksum.call_count, 6)
+            self.assertEqual(
+                swift_utils.get_ring_file_checksums()['object.ring.gz'],
+                hashlib.sha256(b'object ring').hexdigest())
+
+            # unchanged files are not read again
+            mock_file_checksum.reset_mock()
+            self.assertEqual(swift_utils.get_rings_checksum(),
+                             rings_checksum)
+            self.assertEqual(swift_utils.get_builders_checksum(),
+                             builders_checksum)
+            self.assertFalse(mock_file_checksum.called)
+
+            # a replaced file is
+            write('object.ring.gz', 'new object ring')
+            self.assertNotEqual(swift_utils.get_rings_checksum(),
+                                rings_checksum)
+            mock_file_checksum.assert_called_once_with(
+                os.path.join(tmpdir, 'object.ring.gz'))
+            self.assertEqual(swift_utils.get_builders_checksum(),
+                             builders_checksum)
+            self.assertEqual(mock_file_checksum.call_count, 1)
+
+    @mock.patch('lib.swift_utils.config')
+    @mock.patch('lib.swift_utils.log')
+    @mock.patch('lib.swift_utils.should_balance')
+    @mock.patch('lib.swift_utils.is_elected_leader')
+    @mock.patch('lib.swift_utils.balance_ring')
+    def test_balance_rings(self, mock_balance_ring, mock_is_elected_leader,
+                           mock_should_balance, mock_log, mock_config):
+        settings = {'rebalance-attempts': 1, 'rebalance-move-budget': 0}
+        mock_config.side_effect = lambda key: settings[key]
+        mock_is_elected_leader.return_value = True
+        mock_should_balance.return_value = True
+        # every ring must be rebalancing at the same time to pass the barrier
+        barrier = threading.Barrier(len(swift_utils.SWIFT_RINGS), timeout=10)
+
+        def fake_balance_ring(path, seed=None):
+            barrier.wait()
+            return True
+
+        mock_balance_ring.side_effect = fake_balance_ring
+        # skip the sync decorator
+        balance_rings = swift_utils.balance_rings.__wrapped__
+        balance_rings()
+        mock_balance_ring.assert_has_calls(
+            [mock.call(path, None)
+             for path in swift_utils.SWIFT_RINGS.values()],
+            any_order=True)
+
+        def failing_balance_ring(path, seed=None):
+            if path == swift_utils.SWIFT_RINGS['container']:
+                raise swift_utils.SwiftProxyCharmException('failed')
+            return False
+
+        mock_balance_ring.reset_mock()
+        mock_balance_ring.side_effect = failing_balance_ring
+        self.assertRaises(swift_utils.SwiftProxyCharmException,
+                          balance_rings)
+        self.assertEqual(mock_balance_ring.call_count, 3)
+
+        # multi-seed rebalances are made one ring at a time
+        settings['rebalance-attempts'] = 3
+        mock_balance_ring.reset_mock()
+        mock_balance_ring.side_effect = None
+        balance_rings()
+        mock_balance_ring.assert_has_calls(
+            [mock.call(path, None)
+             for path in swift_utils.SWIFT_RINGS.values()])
+
+    @mock.patch('lib.swift_utils.get_manager')
+    @mock.patch('lib.swift_utils.config')
+    @mock.patch('lib.swift_utils.log')
+    @mock.patch('lib.swift_utils.should_balance')
+    @mock.patch('lib.swift_utils.is_elected_leader')
+    @mock.patch('lib.swift_utils.balance_ring')
+    def test_balance_rings_budget_seeds(self, mock_balance_ring,
+                                        mock_is_elected_leader,
+                                        mock_should_balance, mock_log,
+                                        mock_config, mock_get_manager):
+        settings = {'rebalance-attempts': 1, 'rebalance-max-workers': 0,
+                    'rebalance-move-budget': 1000,
+                    'rebalance-partition-size': 10}
+        mock_config.side_effect = lambda key: settings[key]
+        mock_is_elected_leader.return_value = True
+        mock_should_balance.return_value = True
+        manager = mock_get_manager.return_value
+        manager.preview_rebalance.return_value = {'replicas_moved': 1,
+                                                  'bytes': 10}
+        paths = list(swift_utils.SWIFT_RINGS.values())
+        balance_rings = swift_utils.balance_rings.__wrapped__
+
+        def previewed():
+            return {c[0][0]: c[1]['seed']
+                    for c in manager.preview_rebalance.call_args_list}
+
+        # each ring is rebalanced with the seed its preview was made with
+        balance_rings()
+        seeds = previewed()
+        self.assertEqual(sorted(seeds), sorted(paths))
+        mock_balance_ring.assert_has_calls(
+            [mock.call(path, seeds[path]) for path in paths],
+            any_order=True)
+
+        # with several attempts, the seed best-of-N picks
+        settings['rebalance-attempts'] = 3
+        manager.preview_rebalance.reset_mock()
+        mock_balance_ring.reset_mock()
+        manager.best_rebalance_seed.side_effect = \
+            lambda path, attempts, workers: {'seed': paths.index(path)}
+        balance_rings()
+        self.assertEqual(previewed(),
+                         {path: i for i, path in enumerate(paths)})
+        mock_balance_ring.assert_has_calls(
+            [mock.call(path, i) for i, path in enumerate(paths)])
+
+        # over budget, nothing is rebalanced
+        settings['rebalance-move-budget'] = 20
+        mock_balance_ring.reset_mock()
+        balance_rings()
+        mock_balance_ring.assert_not_called()
+
+    @mock.patch('lib.swift_utils.log')
+    @mock.patch('lib.swift_utils.preview_rebalance')
+    @mock.patch('lib.swift_utils.config')
+    def test_rebalance_within_budget(self, mock_config, mock_preview,
+                                     mock_log):
+        settings = {'rebalance-move-budget': 0,
+                    'rebalance-partition-size': 0}
+        mock_config.side_effect = lambda key: settings[key]
+        mock_preview.return_value = {'replicas_moved': 10, 'bytes': 1000}
+        self.assertTrue(swift_utils.rebalance_within_budget(['a', 'b']))
+        settings['rebalance-move-budget'] = 1500
+        self.assertTrue(swift_utils.rebalance_within_budget(['a', 'b']))
+        mock_preview.assert_not_called()
+        settings['rebalance-partition-size'] = 100
+        self.assertFalse(swift_utils.rebalance_within_budget(['a', 'b']))
+        mock_preview.assert_has_calls([mock.call('a', 100, seed=None),
+                                       mock.call('b', 100, seed=None)])
+        mock_preview.reset_mock()
+        self.assertFalse(swift_utils.rebalance_within_budget(
+            ['a', 'b'], {'a': 1, 'b': 2}))
+        mock_preview.assert_has_calls([mock.call('a', 100, seed=1),
+                                       mock.call('b', 100, seed=2)])
+        self.assertTrue(swift_utils.rebalance_within_budget(['a']))
+
+    @mock.patch('lib.swift_utils.log')
+    @mock.patch('lib.swift_utils.get_manager')
+    @mock.patch('lib.swift_utils.config')
+    def test_balance_ring_best_of(self, mock_config, mock_get_manager,
+                                  mock_log):
+        mock_config.side_effect = lambda key: {
+            'rebalance-attempts': 4, 'rebalance-max-workers': 0}[key]
+        rebalance = mock_get_manager.return_value.rebalance_best_of
+        rebalance.return_value = {'seed': 1, 'parts': 10, 'balance': 0.5,
+                                  'dispersion': 0.0, 'attempts': 4,
+                                  'written': True, 'warning': False}
+        self.assertTrue(swift_utils.balance_ring('account.builder'))
+        rebalance.assert_called_once_with('account.builder', 4, None,
+                                          seed=None)
+        rebalance.return_value['warning'] = True
+        self.assertFalse(swift_utils.balance_ring('account.builder'))
+        rebalance.return_value['written'] = False
+        self.assertFalse(swift_utils.balance_ring('account.builder'))
+        rebalance.side_effect = RuntimeError('failed')
+        self.assertRaises(swift_utils.SwiftProxyCharmException,
+                          swift_utils.balance_ring, 'account.builder')
+
+    @mock.patch('lib.swift_utils.config', lambda key: None)
+    @mock.patch('lib.swift_utils.subprocess.check_call')
+    def test_balance_ring(self, mock_check_call):
+        self.assertTrue(swift_utils.balance_ring('account.builder'))
+        mock_check_call.assert_called_once_with(
+            ['swift-ring-builder', 'account.builder', 'rebalance'])
+        mock_check_call.reset_mock()
+        self.assertTrue(swift_utils.balance_ring('account.builder', seed=7))
+        mock_check_call.assert_called_once_with(
+            ['swift-ring-builder', 'account.builder', 'rebalance',
+             '--seed', '7'])
+        mock_check_call.side_effect = subprocess.CalledProcessError(1, 'x')
+        self.assertFalse(swift_utils.balance_ring('account.builder'))
+        mock_check_call.side_effect = subprocess.CalledProcessError(2, 'x')
+        self.assertRaises(swift_utils.SwiftProxyCharmException,
+                          swift_utils.balance_ring, 'account.builder')
+
+    def test_next_ramp_weight(self):
+        self.assertEqual(swift_utils.next_ramp_weight(25, 100, 25), 50)
+        self.assertEqual(swift_utils.next_ramp_weight(90, 100, 25), 100)
+        self.assertEqual(swift_utils.next_ramp_weight(100, 0, 30), 70)
+        self.assertEqual(swift_utils.next_ramp_weight(10, 0, 30), 0)
+        self.assertEqual(swift_utils.next_ramp_weight(10, 100, 0), 100)
+
+    @mock.patch('lib.swift_utils.time.time')
+    @mock.patch('lib.swift_utils.log')
+    @mock.patch('lib.swift_utils.apply_ring_operations')
+    @mock.patch('lib.swift_utils.kv')
+    @mock.patch('lib.swift_utils.config')
+    def test_schedule_weight_ramps(self, mock_config, mock_kv,
+                                   mock_apply_ring_operations, mock_log,
+                                   mock_time):
+        store = {}
+        mock_kv.return_value.get.side_effect = store.get
+        mock_kv.return_value.set.side_effect = store.__setitem__
+        mock_config.side_effect = lambda key: {'weight-ramp-step': 30}[key]
+        mock_time.return_value = 1000
+        path = swift_utils.SWIFT_RINGS['object']
+        devs = [{'id': 1, 'ip': '1.2.3.4', 'device': 'sdb', 'weight': 100},
+                {'id': 2, 'ip': '1.2.3.5', 'device': 'sdb', 'weight': 0}]
+        swift_utils.schedule_weight_ramps(path, devs, 0, remove=True)
+        mock_apply_ring_operations.assert_called_once_with(
+            path, [{'op': 'set_weight', 'search_value': 'd1', 'weight': 70}])
+        self.assertEqual(store[swift_utils.WEIGHT_RAMPS_KEY], {
+            'object': {
+                'last-step': 1000,
+                'devices': {
+                    '1': {'ip': '1.2.3.4', 'device': 'sdb', 'target': 0.0,
+                          'remove': True},
+                    '2': {'ip': '1.2.3.5', 'device': 'sdb', 'target': 0.0,
+                          'remove': True}}}})
+        mock_kv.return_value.flush.assert_called_once_with()
+
+        # new devices are added with their first step already applied
+        mock_apply_ring_operations.reset_mock()
+        swift_utils.schedule_weight_ramps(
+            path, [{'id': 3, 'ip': '1.2.3.6', 'device': 'sdb',
+                    'weight': 30}], 100, first_step=False)
+        mock_apply_ring_operations.assert_not_called()
+        self.assertEqual(len(
+            store[swift_utils.WEIGHT_RAMPS_KEY]['object']['devices']), 3)
+
+    @mock.patch('lib.swift_utils.time.time')
+    @mock.patch('lib.swift_utils.log')
+    @mock.patch('lib.swift_utils.balance_rings')
+    @mock.patch('lib.swift_utils.apply_ring_operations')
+    @mock.patch('lib.swift_utils.get_min_part_hours')
+    @mock.patch('lib.swift_utils.get_ring_index')
+    @mock.patch('lib.swift_utils.is_elected_leader')
+    @mock.patch('lib.swift_utils.kv')
+    @mock.patch('lib.swift_utils.config')
+    def test_advance_weight_ramps(self, mock_config, mock_kv,
+                                  mock_is_elected_leader, mock_get_ring_index,
+                                  mock_get_min_part_hours,
+                                  mock_apply_ring_operations,
+                                  mock_balance_rings, mock_log, mock_time):
+        store = {swift_utils.WEIGHT_RAMPS_KEY: {
+            'object': {
+                'last-step': 0,
+                'devices': {
+                    '1': {'ip': '1.2.3.4', 'device': 'sdb', 'target': 100.0,
+                          'remove': False},
+                    '2': {'ip': '1.2.3.5', 'device': 'sdb', 'target': 0.0,
+                          'remove': True},
+                    '3': {'ip': '1.2.3.6', 'device': 'sdb', 'target': 0.0,
+                          'remove': False},
+                    '4': {'ip': '1.2.3.7', 'device': 'sdb', 'target': 0.0,
+                          'remove': False}}}}}
+        mock_kv.return_value.get.side_effect = store.get
+        mock_kv.return_value.set.side_effect = store.__setitem__
+        mock_config.side_effect = lambda key: {
+            'weight-ramp-step': 30, 'disable-ring-balance': False}[key]
+        mock_is_elected_leader.return_value = True
+        mock_get_min_part_hours.return_value = 1
+        mock_get_ring_index.return_value = {'devs': [
+            {'id': 1, 'ip': '1.2.3.4', 'device': 'sdb', 'weight': 30.0},
+            {'id': 2, 'ip': '1.2.3.5', 'device': 'sdb', 'weight': 0.0},
+            {'id': 3, 'ip': '1.2.3.6', 'device': 'sdb', 'weight': 0.0},
+            {'id': 4, 'ip': '1.2.3.9', 'device': 'sdb', 'weight': 10.0}]}
+
+        # min_part_hours haven't passed since the last step
+        mock_time.return_value = 3599
+        swift_utils.advance_weight_ramps()
+        mock_apply_ring_operations.assert_not_called()
+        mock_balance_rings.assert_not_called()
+
+        mock_time.return_value = 3600
+        swift_utils.advance_weight_ramps()
+        mock_apply_ring_operations.assert_called_once_with(
+            swift_utils.SWIFT_RINGS['object'],
+            [{'op': 'set_weight', 'search_value': 'd1', 'weight': 60.0},
+             {'op': 'remove', 'search_value': 'd2'}])
+        mock_balance_rings.assert_called_once_with()
+        # 2 was removed, 3 is done and 4 is a different device now
+        self.assertEqual(store[swift_utils.WEIGHT_RAMPS_KEY], {
+            'object': {
+                'last-step': 3600,
+                'devices': {
+                    '1': {'ip': '1.2.3.4', 'device': 'sdb', 'target': 100.0,
+                          'remove': False}}}})
+
+    @mock.patch('lib.swift_utils.get_min_part_hours')
+    @mock.patch('lib.swift_utils.get_ring_index')
+    @mock.patch('lib.swift_utils.get_weight_ramps')
+    def test_get_weight_ramp_status(self, mock_get_weight_ramps,
+                                    mock_get_ring_index,
+                                    mock_get_min_part_hours):
+        mock_get_weight_ramps.return_value = {
+            'account': {
+                'last-step': 100,
+                'devices': {
+                    '10': {'ip': '1.2.3.4', 'device': 'sdb', 'target': 100.0,
+                           'remove': False},
+                    '9': {'ip': '1.2.3.5', 'device': 'sdb', 'target': 0.0,
+                          'remove': True}}}}
+        mock_get_ring_index.return_value = {'devs': [
+            {'id': 10, 'ip': '1.2.3.4', 'device': 'sdb', 'weight': 50.0}]}
+        mock_get_min_part_hours.return_value = 2
+        self.assertEqual(swift_utils.get_weight_ramp_status(), {
+            'account': {
+                'next-step': 7300,
+                'devices': [
+                    {'id': 9, 'ip': '1.2.3.5', 'device': 'sdb',
+                     'target': 0.0, 'remove': True, 'weight': None},
+                    {'id': 10, 'ip': '1.2.3.4', 'device': 'sdb',
+                     'target': 100.0, 'remove': False, 'weight': 50.0}]}})
+
+    @mock.patch('lib.swift_utils.time.time')
+    @mock.patch('lib.swift_utils.log')
+    @mock.patch('lib.swift_utils.apply_ring_changes')
+    @mock.patch('lib.swift_utils.is_elected_leader')
+    @mock.patch('lib.swift_utils.kv')
+    @mock.patch('lib.swift_utils.config')
+    def test_flush_ring_changes(self, mock_config, mock_kv,
+                                mock_is_elected_leader,
+                                mock_apply_ring_changes, mock_log,
+                                mock_time):
+        store = {}
+        mock_kv.return_value.get.side_effect = store.get
+        mock_kv.return_value.set.side_effect = store.__setitem__
+        mock_kv.return_value.unset.side_effect = store.pop
+        mock_config.side_effect = lambda key: {
+            'ring-change-interval': 300, 'ring-change-threshold': 3}[key]
+        mock_is_elected_leader.return_value = True
+        storage_nodes = mock.MagicMock()
+        mock_time.return_value = 1000
+        swift_utils.queue_ring_change({'type': 'storage'})
+        swift_utils.queue_ring_change({'type': 'config', 'replicas': 3,
+                                       'min_part_hours': 1})
+        self.assertEqual(store[swift_utils.RING_CHANGES_KEY], {
+            'changes': [{'type': 'storage'},
+                        {'type': 'config', 'replicas': 3,
+                         'min_part_hours': 1}],
+            'last-change': 1000})
+
+        # not quiet for long enough yet
+        mock_time.return_value = 1299
+        self.assertFalse(swift_utils.flush_ring_changes(storage_nodes))
+        mock_apply_ring_changes.assert_not_called()
+
+        # non-leaders never apply them
+        mock_time.return_value = 1300
+        mock_is_elected_leader.return_value = False
+        self.assertFalse(swift_utils.flush_ring_changes(storage_nodes))
+        mock_apply_ring_changes.assert_not_called()
+
+        mock_is_elected_leader.return_value = True
+        self.assertTrue(swift_utils.flush_ring_changes(storage_nodes))
+        mock_apply_ring_changes.assert_called_once_with(
+            [{'type': 'storage'},
+             {'type': 'config', 'replicas': 3, 'min_part_hours': 1}],
+            storage_nodes)
+        self.assertNotIn(swift_utils.RING_CHANGES_KEY, store)
+        self.assertFalse(swift_utils.flush_ring_changes(storage_nodes))
+
+        # the threshold applies them before the interval has passed
+        mock_apply_ring_changes.reset_mock()
+        for _ in range(3):
+            swift_utils.queue_ring_change({'type': 'storage'})
+        self.assertTrue(swift_utils.flush_ring_changes(storage_nodes))
+        self.assertEqual(len(mock_apply_ring_changes.call_args[0][0]), 3)
+
+        # as does force
+        mock_apply_ring_changes.reset_mock()
+        swift_utils.queue_ring_change({'type': 'storage'})
+        self.assertFalse(swift_utils.flush_ring_changes(storage_nodes))
+        self.assertTrue(swift_utils.flush_ring_changes(storage_nodes,
+                                                       force=True))
+        mock_apply_ring_changes.assert_called_once_with(
+            [{'type': 'storage'}], storage_nodes)
+
+    @mock.patch('lib.swift_utils.time.time')
+    @mock.patch('lib.swift_utils.log')
+    @mock.patch('lib.swift_utils.update_rings')
+    @mock.patch('lib.swift_utils.is_elected_leader')
+    @mock.patch('lib.swift_utils.kv')
+    @mock.patch('lib.swift_utils.config')
+    def test_flush_ring_changes_failed(self, mock_config, mock_kv,
+                                       mock_is_elected_leader,
+                                       mock_update_rings, mock_log,
+                                       mock_time):
+        store = {}
+        mock_kv.return_value.get.side_effect = store.get
+        mock_kv.return_value.set.side_effect = store.__setitem__
+        mock_kv.return_value.unset.side_effect = store.pop
+        mock_config.side_effect = lambda key: {
+            'ring-change-interval': 300, 'ring-change-threshold': 0}[key]
+        mock_is_elected_leader.return_value = True
+        mock_time.return_value = 1000
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        rings = {r: os.path.join(tmpdir, '{}.builder'.format(r))
+                 for r in ['account', 'container', 'object']}
+        for path in rings.values():
+            with open(path, 'w') as fd:
+                fd.write('')
+        for patcher in (
+                mock.patch.object(swift_utils, 'SWIFT_CONF_DIR', tmpdir),
+                mock.patch.object(swift_utils, 'SWIFT_RINGS', rings)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        storage_nodes = mock.MagicMock()
+        changes = [{'type': 'storage'},
+                   {'type': 'config', 'replicas': 3, 'min_part_hours': 1}]
+        for change in changes:
+            swift_utils.queue_ring_change(change)
+
+        # nothing is lost if the rings can't be updated at all
+        mock_time.return_value = 2000
+        mock_update_rings.side_effect = swift_utils.SwiftProxyCharmException(
+            'builder locked')
+        with self.assertRaises(swift_utils.SwiftProxyCharmException):
+            swift_utils.flush_ring_changes(storage_nodes)
+        self.assertEqual(store[swift_utils.RING_CHANGES_KEY]['changes'],
+                         changes)
+
+        # a change that fails on its own is dropped, the rest applied, and
+        # changes queued meanwhile are kept
+        def update_rings(nodes=None, operations=None, **kwargs):
+            # the first ring is written before the second one fails, in
+            # place as swift does
+            with open(rings['account'], 'a') as fd:
+                fd.write('nodes ' if nodes else '')
+                fd.write('replicas ' if 'replicas' in kwargs else '')
+            if 'replicas' in kwargs:
+                swift_utils.queue_ring_change({'type': 'storage'})
+                raise swift_utils.SwiftProxyCharmException('bad replicas')
+
+        mock_update_rings.reset_mock()
+        mock_update_rings.side_effect = update_rings
+        self.assertTrue(swift_utils.flush_ring_changes(storage_nodes))
+        self.assertEqual(mock_update_rings.call_count, 3)
+        mock_update_rings.assert_any_call(storage_nodes.return_value,
+                                          operations={})
+        self.assertEqual(store[swift_utils.RING_CHANGES_KEY]['changes'],
+                         [{'type': 'storage'}] * 2)
+        # what failed was undone, so the storage change took effect once
+        with open(rings['account']) as fd:
+            self.assertEqual(fd.read(), 'nodes ')
+        self.assertEqual(sorted(os.listdir(tmpdir)), sorted(
+            os.path.basename(path) for path in rings.values()))
+
+    @mock.patch('lib.swift_utils.first_ramp_step')
+    @mock.patch('lib.swift_utils.schedule_weight_ramps')
+    @mock.patch('lib.swift_utils.find_ring_devices')
+    @mock.patch('lib.swift_utils.update_rings')
+    def test_apply_ring_changes(self, mock_update_rings,
+                                mock_find_ring_devices,
+                                mock_schedule_weight_ramps,
+                                mock_first_ramp_step):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        patcher = mock.patch.object(swift_utils, 'SWIFT_CONF_DIR', tmpdir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        storage_nodes = mock.MagicMock()
+        storage_nodes.return_value = [{'ip': '1.2.3.4'}]
+        mock_update_rings.return_value = True
+        devs = [{'id': 3, 'ip': '1.2.3.4', 'device': 'sdb', 'weight': 100}]
+        mock_find_ring_devices.return_value = devs
+        step = [{'op': 'set_weight', 'search_value': 'd3', 'weight': 75.0}]
+        mock_first_ramp_step.return_value = step
+        swift_utils.apply_ring_changes(
+            [{'type': 'storage'},
+             {'type': 'config', 'min_part_hours': 1, 'replicas': 3},
+             {'type': 'storage'},
+             {'type': 'set-weight', 'ring': 'object', 'search_value': 'd1',
+              'weight': 50, 'ramp': False},
+             {'type': 'remove', 'ring': 'object', 'search_value': 'd2',
+              'ramp': False},
+             {'type': 'remove', 'ring': 'account', 'search_value': 'd3',
+              'ramp': True}],
+            storage_nodes)
+        storage_nodes.assert_called_once_with()
+        # the ramp's first step is applied along with everything else
+        mock_update_rings.assert_called_once_with(
+            [{'ip': '1.2.3.4'}],
+            operations={
+                swift_utils.SWIFT_RINGS['object']: [
+                    {'op': 'set_weight', 'search_value': 'd1',
+                     'weight': 50.0},
+                    {'op': 'remove', 'search_value': 'd2'}],
+                swift_utils.SWIFT_RINGS['account']: step},
+            min_part_hours=1, replicas=3)
+        mock_find_ring_devices.assert_called_once_with(
+            swift_utils.SWIFT_RINGS['account'], 'd3')
+        mock_first_ramp_step.assert_called_once_with(
+            swift_utils.SWIFT_RINGS['account'], devs, 0)
+        mock_schedule_weight_ramps.assert_called_once_with(
+            swift_utils.SWIFT_RINGS['account'], devs, 0, remove=True,
+            first_step=False)
+
+        # ramps aren't tracked if the rings couldn't be updated
+        mock_schedule_weight_ramps.reset_mock()
+        mock_update_rings.side_effect = \
+            swift_utils.SwiftProxyCharmException('rebalance failed')
+        with self.assertRaises(swift_utils.SwiftProxyCharmException):
+            swift_utils.apply_ring_changes(
+                [{'type': 'remove', 'ring': 'account', 'search_value': 'd3',
+                  'ramp': True}], storage_nodes)
+        mock_schedule_weight_ramps.assert_not_called()
+
+        # devices that can't be found fail the changes before any of them
+        # take effect
+        mock_update_rings.reset_mock()
+        mock_find_ring_devices.side_effect = \
+            swift_utils.SwiftProxyCharmException('no devices')
+        with self.assertRaises(swift_utils.SwiftProxyCharmException):
+            swift_utils.apply_ring_changes(
+                [{'type': 'set-weight', 'ring': 'object',
+                  'search_value': 'd1', 'weight': 50, 'ramp': True},
+                 {'type': 'remove', 'ring': 'object', 'search_value': 'd9',
+                  'ramp': True}], storage_nodes)
+        mock_schedule_weight_ramps.assert_not_called()
+        mock_update_rings.assert_not_called()
+
+    @mock.patch('lib.swift_utils.relation_get')
+    @mock.patch('lib.swift_utils.get_ring_index')
+    def test_zone_assigner(self, mock_get_ring_index, mock_relation_get):
+        mock_get_ring_index.return_value = {
+            'replicas': 3,
+            'devs': [{'ip': '10.0.0.1', 'zone': 1, 'device': 'sdb'},
+                     {'ip': '10.0.0.1', 'zone': 1, 'device': 'sdc'},
+                     {'ip': '10.0.0.2', 'zone': 2, 'device': 'sdb'}]}
+        zones = swift_utils.ZoneAssigner('auto')
+        # units already in the rings keep their zone
+        self.assertEqual(zones.zone('10.0.0.2', 1), 2)
+        # new units fill the zones as if added one at a time
+        self.assertEqual(zones.zone('10.0.0.3', 1), 3)
+        self.assertEqual(zones.zone('10.0.0.4', 1), 2)
+        self.assertEqual(zones.zone('10.0.0.5', 2), 3)
+        self.assertEqual(zones.zone('10.0.0.6', 1), 1)
+        self.assertEqual(zones.zone('10.0.0.3', 1), 3)
+        self.assertEqual(mock_get_ring_index.call_count, 3)
+
+        mock_relation_get.return_value = '4'
+        zones = swift_utils.ZoneAssigner('manual')
+        self.assertEqual(zones.zone('10.0.0.7', 1, rid='swift-storage:1',
+                                    unit='swift-storage/0'), '4')
+        mock_relation_get.assert_called_once_with(
+            'zone', rid='swift-storage:1', unit='swift-storage/0')
+
+        self.assertRaises(swift_utils.SwiftProxyCharmException,
+                          swift_utils.ZoneAssigner, 'other')
+
     def test__ring_port_rep(self):
         node = {
             'region': 1,
@@ -282,19 +1073,168 @@ class SwiftUtilsTestCase(unittest.TestCase):
         actual = swift_utils._ring_port_rep('/etc/swift/account.builder', node)
         self.assertEqual(actual, expected)
 
-    @mock.patch.object(swift_utils, 'get_manager')
-    def test_get_current_replicas(self, mock_get_manager):
-        swift_utils.get_current_replicas('/etc/swift/account.builder')
-        mock_get_manager().get_current_replicas.assert_called_once_with(
+    @mock.patch.object(swift_utils, 'get_ring_index')
+    def test_get_current_replicas(self, mock_get_ring_index):
+        mock_get_ring_index.return_value = {'replicas': 3}
+        self.assertEqual(
+            swift_utils.get_current_replicas('/etc/swift/account.builder'), 3)
+        mock_get_ring_index.assert_called_once_with(
             '/etc/swift/account.builder')
 
-    @mock.patch.object(subprocess, 'check_call')
-    def test_update_replicas(self, check_call):
-        swift_utils.update_replicas('/etc/swift/account.builder', 3)
-        check_call.assert_called_once_with(['swift-ring-builder',
-                                            '/etc/swift/account.builder',
-                                            'set_replicas',
-                                            '3'])
+    @mock.patch.dict(swift_utils._RING_INDEXES, clear=True)
+    @mock.patch.object(swift_utils, 'get_manager')
+    def test_get_ring_index(self, mock_get_manager):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'account.builder')
+        with open(path, 'w') as fd:
+            fd.write('0')
+        mock_get_manager().ring_index.side_effect = lambda p: {
+            'devs': [], 'members': [], 'replicas': 3}
+
+        index = swift_utils.get_ring_index(path)
+        self.assertEqual(index['replicas'], 3)
+        self.assertEqual(mock_get_manager().ring_index.call_count, 1)
+        self.assertTrue(os.path.exists(path + '.index.json'))
+
+        # unchanged builder is answered from memory, then from the sidecar
+        swift_utils.get_ring_index(path)
+        swift_utils._RING_INDEXES.clear()
+        swift_utils.get_ring_index(path)
+        self.assertEqual(mock_get_manager().ring_index.call_count, 1)
+
+        # a changed builder regenerates the index
+        with open(path, 'w') as fd:
+            fd.write('01')
+        swift_utils.get_ring_index(path)
+        self.assertEqual(mock_get_manager().ring_index.call_count, 2)
+
+    @mock.patch.object(swift_utils, 'log')
+    @mock.patch.object(swift_utils, 'get_ring_index')
+    def test_exists_in_ring(self, mock_get_ring_index, mock_log):
+        devs = [{'id': 199, 'region': 1, 'zone': 1, 'ip': '172.16.0.2',
+                 'port': 6000, 'replication_ip': '172.16.0.2',
+                 'replication_port': 6000, 'device': 'bcache10',
+                 'weight': 100.0, 'meta': ''}]
+        mock_get_ring_index.return_value = {'devs': devs}
+        node = {'ip': '172.16.0.2', 'region': 1, 'zone': 2,
+                'account_port': 6000, 'device': 'bcache10'}
+        self.assertTrue(swift_utils.exists_in_ring('account.builder', node))
+        node['region'] = 2
+        self.assertFalse(swift_utils.exists_in_ring('account.builder', node))
+        node['region'] = 1
+        node['device'] = 'bcache11'
+        self.assertFalse(swift_utils.exists_in_ring('account.builder', node))
+
+    @mock.patch.object(swift_utils, 'log')
+    @mock.patch('os.path.isfile')
+    @mock.patch.object(swift_utils, 'get_ring_index')
+    def test_has_minimum_zones(self, mock_get_ring_index, mock_isfile,
+                               mock_log):
+        mock_isfile.return_value = True
+        index = {'devs': [{}], 'regions': [1], 'zones': [1, 2, 3],
+                 'replicas': 3}
+        mock_get_ring_index.return_value = index
+        self.assertTrue(swift_utils.has_minimum_zones(['a', 'b']))
+        index['replicas'] = 4
+        self.assertFalse(swift_utils.has_minimum_zones(['a', 'b']))
+        index['devs'] = []
+        self.assertFalse(swift_utils.has_minimum_zones(['a']))
+        mock_isfile.return_value = False
+        self.assertFalse(swift_utils.has_minimum_zones(['a']))
+
+    @mock.patch.object(swift_utils, 'log')
+    @mock.patch.object(swift_utils, '_manager_python')
+    def test_proxy_manager_call_worker(self, mock_manager_python, mock_log):
+        mock_manager_python.return_value = sys.executable
+        self.addCleanup(swift_utils.stop_manager_worker)
+        rings = ['/nonexistent/account.builder']
+        self.assertEqual(
+            swift_utils._proxy_manager_call(['has_minimum_zones'],
+                                            (rings,), {}),
+            {'result': False})
+        worker = swift_utils.get_manager_worker()
+        self.assertTrue(worker.running)
+        # subsequent calls are served by the same process
+        pid = worker._process.pid
+        swift_utils._proxy_manager_call(['has_minimum_zones'], (rings,), {})
+        self.assertEqual(swift_utils.get_manager_worker()._process.pid, pid)
+        # errors are raised as before and don't kill the worker
+        with self.assertRaises(RuntimeError):
+            swift_utils._proxy_manager_call(['no_such_function'], (), {})
+        self.assertTrue(worker.running)
+        self.assertEqual(worker._process.pid, pid)
+
+    @mock.patch.object(swift_utils, 'log')
+    @mock.patch.object(swift_utils, '_manager_python')
+    @mock.patch.object(swift_utils, '_manager_in_process')
+    def test_proxy_manager_call_paths(self, mock_manager_in_process,
+                                      mock_manager_python, mock_log):
+        mock_manager_python.return_value = sys.executable
+        self.addCleanup(swift_utils.stop_manager_worker)
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        ring = os.path.join(tmpdir, 'account.builder')
+        devs = [{'id': 0, 'region': 1, 'zone': 1, 'ip': '10.0.0.1',
+                 'port': 6002, 'replication_ip': '10.0.0.1',
+                 'replication_port': 6002, 'device': 'sdb', 'weight': 100},
+                {'id': 1, 'region': 1, 'zone': 2, 'ip': '10.0.0.2',
+                 'port': 6002, 'replication_ip': '10.0.0.2',
+                 'replication_port': 6002, 'device': 'sdb', 'weight': 100}]
+        with open(ring, 'wb') as fd:
+            pickle.dump({'part_power': 8, 'replicas': 3, 'min_part_hours': 1,
+                         'devs': devs}, fd, protocol=2)
+        node = {'ip': '10.0.0.3', 'port': 6002, 'device': 'sdb'}
+        calls = [
+            (['has_minimum_zones'], ([ring],), {}),
+            (['has_minimum_zones'], ([os.path.join(tmpdir, 'x')],), {}),
+            (['ring_index'], (ring,), {}),
+            (['get_zone'], (ring,), {}),
+            (['get_current_replicas'], (ring,), {}),
+            (['get_min_part_hours'], (ring,), {}),
+            (['exists_in_ring'], (ring, devs[0]), {}),
+            (['missing_devices'], (ring, [devs[1], node]), {}),
+        ]
+
+        def call_all():
+            results = [swift_utils._proxy_manager_call(*c) for c in calls]
+            with self.assertRaises(RuntimeError):
+                swift_utils._proxy_manager_call(['no_such_function'], (), {})
+            return results
+
+        mock_manager_in_process.return_value = False
+        worker_results = call_all()
+        self.assertTrue(swift_utils.get_manager_worker().running)
+        swift_utils.stop_manager_worker()
+        mock_manager_in_process.return_value = True
+        with mock.patch.object(swift_utils, 'get_manager_worker') as worker:
+            self.assertEqual(call_all(), worker_results)
+            worker.assert_not_called()
+        self.assertEqual(worker_results[2]['zones'], [1, 2])
+        self.assertEqual(worker_results[7], {'missing': [1], 'update': []})
+
+    @mock.patch.object(swift_utils, '_manager_python')
+    @mock.patch('importlib.util.find_spec')
+    def test_manager_in_process(self, mock_find_spec, mock_manager_python):
+        mock_manager_python.return_value = 'python3'
+        mock_find_spec.return_value = mock.sentinel.spec
+        self.assertTrue(swift_utils._manager_in_process())
+        mock_find_spec.assert_called_once_with('swift')
+        mock_find_spec.return_value = None
+        self.assertFalse(swift_utils._manager_in_process())
+        mock_find_spec.return_value = mock.sentinel.spec
+        mock_manager_python.return_value = 'python2'
+        self.assertFalse(swift_utils._manager_in_process())
+
+    @mock.patch.object(swift_utils, '_manager_python')
+    def test_get_manager_worker_release_change(self, mock_manager_python):
+        mock_manager_python.return_value = 'python2'
+        self.addCleanup(swift_utils.stop_manager_worker)
+        worker = swift_utils.get_manager_worker()
+        self.assertEqual(worker.python, 'python2')
+        self.assertIs(swift_utils.get_manager_worker(), worker)
+        mock_manager_python.return_value = 'python3'
+        self.assertEqual(swift_utils.get_manager_worker().python, 'python3')
 
     @mock.patch('lib.swift_utils.is_elected_leader', lambda arg: True)
     @mock.patch('lib.swift_utils.previously_synced')
@@ -373,8 +1313,12 @@ class SwiftUtilsTestCase(unittest.TestCase):
                           'peers-only': 1,
                           'leader-changed-notification': None,
                           'resync-request': None,
+                          'ring-checksums': None,
+                          'ring-generation': None,
+                          'ring-sync-units': None,
                           'stop-proxy-service': 'test-uuid',
                           'stop-proxy-service-ack': None,
+                          'stop-proxy-units': None,
                           'sync-only-builders': None}, rq)
 
         rq = rpc.stop_proxy_request()
@@ -385,13 +1329,21 @@ class SwiftUtilsTestCase(unittest.TestCase):
                           'peers-only': None,
                           'leader-changed-notification': None,
                           'resync-request': None,
+                          'ring-checksums': None,
+                          'ring-generation': None,
+                          'ring-sync-units': None,
                           'stop-proxy-service': 'test-uuid',
                           'stop-proxy-service-ack': None,
+                          'stop-proxy-units': None,
                           'sync-only-builders': None}, rq)
 
         template_keys = set(rpc.template())
         self.assertTrue(set(rq.keys()).issubset(template_keys))
 
+        rq = rpc.stop_proxy_request(units=['swift-proxy/2', 'swift-proxy/1'])
+        self.assertEqual(rq['stop-proxy-units'],
+                         'swift-proxy/1 swift-proxy/2')
+
     @mock.patch('lib.swift_utils.uuid')
     def test_cluster_rpc_stop_proxy_ack(self, mock_uuid):
         mock_uuid.uuid4.return_value = 'token2'
@@ -404,8 +1356,12 @@ class SwiftUtilsTestCase(unittest.TestCase):
                           'peers-only': '1',
                           'leader-changed-notification': None,
                           'resync-request': None,
+                          'ring-checksums': None,
+                          'ring-generation': None,
+                          'ring-sync-units': None,
                           'stop-proxy-service': None,
                           'stop-proxy-service-ack': 'token1',
+                          'stop-proxy-units': None,
                           'sync-only-builders': None}, rq)
 
         template_keys = set(rpc.template())
@@ -425,13 +1381,28 @@ class SwiftUtilsTestCase(unittest.TestCase):
                           'peers-only': None,
                           'leader-changed-notification': None,
                           'resync-request': None,
+                          'ring-checksums': None,
+                          'ring-generation': None,
+                          'ring-sync-units': None,
                           'stop-proxy-service': None,
                           'stop-proxy-service-ack': None,
+                          'stop-proxy-units': None,
                           'sync-only-builders': None}, rq)
 
         template_keys = set(rpc.template())
         self.assertTrue(set(rq.keys()).issubset(template_keys))
 
+        rq = rpc.sync_rings_request('token1', '1.234000',
+                                    checksums={'object.ring.gz': 'abc',
+                                               'account.ring.gz': 'def'},
+                                    generation=4,
+                                    units=['swift-proxy/3', 'swift-proxy/1'])
+        self.assertEqual(
+            rq['ring-checksums'],
+            '{"account.ring.gz": "def", "object.ring.gz": "abc"}')
+        self.assertEqual(rq['ring-generation'], 4)
+        self.assertEqual(rq['ring-sync-units'], 'swift-proxy/1 swift-proxy/3')
+
     @mock.patch('lib.swift_utils.is_elected_leader', lambda arg: True)
     @mock.patch('lib.swift_utils.uuid')
     def test_cluster_rpc_notify_leader_changed(self, mock_uuid):
@@ -446,7 +1417,11 @@ class SwiftUtilsTestCase(unittest.TestCase):
                           'leader-changed-notification': 'token1',
                           'stop-proxy-service': None,
                           'stop-proxy-service-ack': None,
+                          'stop-proxy-units': None,
                           'resync-request': None,
+                          'ring-checksums': None,
+                          'ring-generation': None,
+                          'ring-sync-units': None,
                           'sync-only-builders': None}, rq)
 
         template_keys = set(rpc.template().keys())
@@ -662,6 +1637,7 @@ class SwiftUtilsTestCase(unittest.TestCase):
                                        '-K',
                                        'Test'])
 
+    @mock.patch.object(swift_utils, 'get_rings_mirrors')
     @mock.patch.object(swift_utils.uuid, 'uuid4')
     @mock.patch.object(swift_utils, 'relation_set')
     @mock.patch.object(swift_utils, 'get_swift_hash')
@@ -681,7 +1657,9 @@ class SwiftUtilsTestCase(unittest.TestCase):
             mock_log,
             mock_get_swift_hash,
             mock_relation_set,
-            mock_uuid):
+            mock_uuid,
+            mock_get_rings_mirrors):
+        mock_get_rings_mirrors.return_value = ['http://10.0.0.1/dir']
 
         mock_is_leader.return_value = True
         mock_get_hostaddr.return_value = '10.0.0.1'
@@ -694,16 +1672,216 @@ class SwiftUtilsTestCase(unittest.TestCase):
         calls = [mock.call(broker_timestamp='1.234',
                            relation_id='storage:0',
                            rings_url='http://10.0.0.1/dir',
+                           rings_mirrors='["http://10.0.0.1/dir"]',
                            swift_hash='greathash',
                            trigger='uuid-1234'),
                  mock.call(broker_timestamp='1.234',
                            relation_id='rings-distributor:0',
                            rings_url='http://10.0.0.1/dir',
+                           rings_mirrors='["http://10.0.0.1/dir"]',
                            swift_hash='greathash',
                            trigger='uuid-1234')]
         swift_utils.notify_storage_and_consumers_rings_available('1.234')
         mock_relation_set.assert_has_calls(calls)
 
+    @mock.patch.object(swift_utils, 'log')
+    @mock.patch.object(swift_utils, 'relation_set')
+    @mock.patch.object(swift_utils, 'local_unit')
+    @mock.patch.object(swift_utils, 'related_units')
+    @mock.patch.object(swift_utils, 'relation_get')
+    @mock.patch.object(swift_utils, 'relation_ids')
+    @mock.patch.object(swift_utils, 'get_rings_checksum')
+    @mock.patch.object(swift_utils, 'get_rings_url')
+    def test_update_rings_mirrors(self, mock_get_rings_url,
+                                  mock_get_rings_checksum, mock_relation_ids,
+                                  mock_relation_get, mock_related_units,
+                                  mock_local_unit, mock_relation_set,
+                                  mock_log):
+        mock_get_rings_url.return_value = 'http://10.0.0.1/swift-rings'
+        mock_get_rings_checksum.return_value = 'current'
+        mock_local_unit.return_value = 'swift-proxy/0'
+        mock_relation_ids.side_effect = lambda name: {
+            'cluster': ['cluster:1'],
+            'swift-storage': ['swift-storage:2', 'swift-storage:3'],
+            'rings-distributor': []}[name]
+        mock_related_units.return_value = ['swift-proxy/2', 'swift-proxy/1',
+                                           'swift-proxy/3']
+        settings = {
+            'swift-proxy/1': {'rings-checksum': 'current',
+                              'rings-url': 'http://10.0.0.2/swift-rings'},
+            # still syncing the current rings
+            'swift-proxy/2': {'rings-checksum': 'previous',
+                              'rings-url': 'http://10.0.0.3/swift-rings'},
+            'swift-proxy/3': {'rings-checksum': 'current',
+                              'rings-url': 'http://10.0.0.4/swift-rings'},
+            ('swift-storage:2', 'swift-proxy/0'): {
+                'rings_url': 'http://10.0.0.1/swift-rings'},
+            # not told about rings yet
+            ('swift-storage:3', 'swift-proxy/0'): {}}
+        mock_relation_get.side_effect = \
+            lambda rid, unit: settings.get(unit) or settings[(rid, unit)]
+
+        mirrors = ['http://10.0.0.1/swift-rings',
+                   'http://10.0.0.2/swift-rings',
+                   'http://10.0.0.4/swift-rings']
+        self.assertEqual(swift_utils.get_rings_mirrors(), mirrors)
+        swift_utils.update_rings_mirrors()
+        mock_relation_set.assert_called_once_with(
+            relation_id='swift-storage:2', rings_mirrors=json.dumps(mirrors))
+
+        # nothing is set if the mirrors haven't changed
+        mock_relation_set.reset_mock()
+        settings[('swift-storage:2', 'swift-proxy/0')]['rings_mirrors'] = \
+            json.dumps(mirrors)
+        swift_utils.update_rings_mirrors()
+        self.assertFalse(mock_relation_set.called)
+
+    @mock.patch.object(swift_utils, 'log')
+    @mock.patch.object(swift_utils, 'time')
+    @mock.patch.object(swift_utils, 'related_units')
+    @mock.patch.object(swift_utils, 'relation_get')
+    @mock.patch.object(swift_utils, 'relation_ids')
+    @mock.patch.object(swift_utils, 'kv')
+    def test_ring_convergence(self, mock_kv, mock_relation_ids,
+                              mock_relation_get, mock_related_units,
+                              mock_time, mock_log):
+        store = {}
+        mock_kv.return_value.get.side_effect = store.get
+        mock_kv.return_value.set.side_effect = store.__setitem__
+        mock_relation_ids.side_effect = lambda name: {
+            'cluster': ['cluster:1'],
+            'swift-storage': ['swift-storage:2'],
+            'rings-distributor': []}[name]
+        mock_related_units.side_effect = lambda rid: {
+            'cluster:1': ['swift-proxy/1', 'swift-proxy/2'],
+            'swift-storage:2': ['swift-storage/{}'.format(i)
+                                for i in range(10)]}[rid]
+        echoed = {'swift-proxy/1': {'rings-checksum': 'old'},
+                  'swift-proxy/2': {'rings-checksum': 'old'}}
+        for i in range(8):
+            echoed['swift-storage/{}'.format(i)] = {'rings_checksum': 'old'}
+        mock_relation_get.side_effect = \
+            lambda rid, unit: echoed.get(unit, {})
+
+        self.assertIsNone(swift_utils.update_ring_convergence())
+        self.assertIsNone(swift_utils.get_ring_convergence_status())
+
+        mock_time.time.return_value = 100.0
+        swift_utils.start_ring_convergence(5, 'new')
+        swift_utils.update_ring_convergence()
+        status = swift_utils.get_ring_convergence_status()
+        self.assertEqual(status['units'], 10)
+        self.assertEqual(status['synced'], 0)
+        # the two storage units that don't echo their rings
+        self.assertEqual(status['untracked'], 2)
+
+        # units sync over time
+        for i, unit in enumerate(['swift-proxy/1', 'swift-storage/0',
+                                  'swift-storage/1', 'swift-storage/2',
+                                  'swift-storage/3', 'swift-storage/4',
+                                  'swift-storage/5', 'swift-storage/6',
+                                  'swift-storage/7']):
+            mock_time.time.return_value = 101.0 + i
+            key = 'rings-checksum' if 'proxy' in unit else 'rings_checksum'
+            echoed[unit][key] = 'new'
+            swift_utils.update_ring_convergence()
+
+        mock_time.time.return_value = 200.0
+        status = swift_utils.get_ring_convergence_status()
+        self.assertEqual(status['generation'], 5)
+        self.assertEqual(status['synced'], 9)
+        self.assertEqual(status['lag']['swift-proxy/1'], 1.0)
+        self.assertEqual(status['lag']['swift-storage/7'], 9.0)
+        self.assertEqual(status['stragglers'], {'swift-proxy/2': 100.0})
+        self.assertEqual(status['converged-50'], 5.0)
+        self.assertEqual(status['converged-90'], 9.0)
+        self.assertIsNone(status['converged-100'])
+
+        # the round is kept in the history once the next one starts
+        swift_utils.start_ring_convergence(6, 'newer')
+        history = swift_utils.get_ring_convergence_history()
+        self.assertEqual([h['generation'] for h in history], [5])
+        self.assertEqual(history[0]['converged-90'], 9.0)
+        self.assertEqual(swift_utils.get_ring_convergence_status()['synced'],
+                         0)
+
+    @mock.patch.object(swift_utils, 'get_ring_convergence_status')
+    @mock.patch.object(swift_utils, 'is_leader')
+    @mock.patch.object(swift_utils, 'has_minimum_zones')
+    @mock.patch.object(swift_utils, 'SwiftRingContext')
+    @mock.patch.object(swift_utils, 'relation_ids')
+    @mock.patch.object(swift_utils, 'config')
+    def test_customer_check_assess_status_convergence(
+            self, mock_config, mock_relation_ids, mock_ctxt,
+            mock_has_minimum_zones, mock_is_leader, mock_status):
+        mock_config.side_effect = lambda key: {'replicas': 3}.get(key)
+        mock_relation_ids.return_value = ['swift-storage:1']
+        mock_ctxt.return_value.return_value = {
+            'allowed_hosts': ['10.0.0.1', '10.0.0.2', '10.0.0.3']}
+        mock_has_minimum_zones.return_value = True
+        mock_is_leader.return_value = True
+        mock_status.return_value = {'generation': 5, 'synced': 7,
+                                    'units': 10}
+        self.assertEqual(
+            swift_utils.customer_check_assess_status(None),
+            ('active', 'Unit is ready (ring generation 5: 7/10 units '
+             'synced)'))
+
+        mock_status.return_value = {'generation': 5, 'synced': 10,
+                                    'units': 10}
+        self.assertEqual(swift_utils.customer_check_assess_status(None),
+                         ('active', 'Unit is ready'))
+
+    @mock.patch.object(swift_utils, 'update_www_rings')
+    @mock.patch.object(swift_utils, 'get_ring_file_checksums')
+    @mock.patch.object(swift_utils, 'get_www_dir')
+    @mock.patch.object(swift_utils, 'log')
+    def test_publish_synced_rings(self, mock_log, mock_get_www_dir,
+                                  mock_get_ring_file_checksums,
+                                  mock_update_www_rings):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        mock_get_www_dir.return_value = tmpdir
+        mock_get_ring_file_checksums.return_value = {'object.ring.gz': 'abc'}
+        swift_utils.publish_synced_rings()
+        mock_update_www_rings.assert_called_once_with()
+
+        # already published
+        mock_update_www_rings.reset_mock()
+        with open(os.path.join(tmpdir, 'manifest.json'), 'w') as fd:
+            json.dump({'files': {'object.ring.gz': {'sha256': 'abc'},
+                                 'object.builder.gz': {'sha256': 'def'}}},
+                      fd)
+        with open(os.path.join(tmpdir, 'object.ring.gz'), 'w') as fd:
+            fd.write('ring')
+        swift_utils.publish_synced_rings()
+        self.assertFalse(mock_update_www_rings.called)
+
+        # published but since removed from the www dir
+        os.rename(os.path.join(tmpdir, 'object.ring.gz'),
+                  os.path.join(tmpdir, 'object.ring.gz.deleted'))
+        swift_utils.publish_synced_rings()
+        mock_update_www_rings.assert_called_once_with()
+
+    @mock.patch.object(swift_utils, 'local_unit')
+    def test_order_rings_mirrors(self, mock_local_unit):
+        mirrors = ['http://10.0.0.{}/swift-rings'.format(i)
+                   for i in range(1, 4)]
+        self.assertEqual(swift_utils.order_rings_mirrors([]), [])
+        firsts = collections.Counter()
+        for i in range(300):
+            order = swift_utils.order_rings_mirrors(
+                mirrors, unit='swift-storage/{}'.format(i))
+            self.assertEqual(sorted(order), mirrors)
+            firsts[order[0]] += 1
+            # always the same order for a unit
+            mock_local_unit.return_value = 'swift-storage/{}'.format(i)
+            self.assertEqual(swift_utils.order_rings_mirrors(mirrors), order)
+
+        # units are spread across all of the mirrors
+        self.assertEqual(sorted(firsts), mirrors)
+        self.assertGreater(min(firsts.values()), 50)
+
     @mock.patch.object(swift_utils, 'relation_set')
     @mock.patch.object(swift_utils, 'relation_ids')
     def test_clear_notify_storage_and_consumers_rings_available(
@@ -834,25 +2012,650 @@ class SwiftUtilsTestCase(unittest.TestCase):
         replicas = swift_utils.determine_replicas('object')
         self.assertEqual(replicas, 3)
 
+    @mock.patch('lib.swift_utils.kv')
+    @mock.patch('lib.swift_utils.log')
+    @mock.patch('lib.swift_utils.fetch_ring_manifest')
+    @mock.patch('lib.swift_utils.fetch_files')
+    def test_sync_proxy_rings(self, mock_fetch_files,
+                              mock_fetch_ring_manifest, mock_log, mock_kv):
+        mock_kv.return_value.get.return_value = None
+
+        def _fetch(base_url, names, target_dir, checksums=None, **kwargs):
+            for name in names:
+                with open(os.path.join(target_dir, name), 'w') as fd:
+                    fd.write(name)
+                if hashlib.sha256(name.encode()).hexdigest() != \
+                        checksums[name]:
+                    raise swift_utils.RingFetchError(name)
+
+        mock_fetch_files.side_effect = _fetch
+        mock_fetch_ring_manifest.return_value = None
+        checksums = {}
+        for s in ['account', 'object', 'container']:
+            for ext in ['ring.gz', 'builder']:
+                name = '{}.{}'.format(s, ext)
+                checksums[name] = hashlib.sha256(name.encode()).hexdigest()
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            with mock.patch.object(swift_utils, 'SWIFT_CONF_DIR', tmpdir):
+                bad = dict(checksums, **{'object.ring.gz': 'stale'})
+                with self.assertRaises(
+                        swift_utils.SwiftProxyCharmException):
+                    swift_utils.sync_proxy_rings('http://1.2.3.4/rings',
+                                                 checksums=bad)
+                # nothing is swapped in, and the staging dir is gone
+                self.assertEqual(os.listdir(tmpdir), [])
+
+                swift_utils.sync_proxy_rings('http://1.2.3.4/rings',
+                                             checksums=checksums)
+                self.assertEqual(sorted(os.listdir(tmpdir)),
+                                 sorted(checksums))
+                # files are staged next to the rings so that renames are
+                # atomic
+                self.assertEqual(
+                    os.path.dirname(mock_fetch_files.call_args[0][2]),
+                    tmpdir)
+                self.assertEqual(
+                    swift_utils.get_ring_file_checksums(builders=False),
+                    {k: v for k, v in checksums.items()
+                     if k.endswith('.ring.gz')})
+        finally:
+            shutil.rmtree(tmpdir)
+
+    @mock.patch('lib.swift_utils.relation_set')
+    @mock.patch('lib.swift_utils.relation_ids')
+    @mock.patch('lib.swift_utils.broadcast_rings_available')
+    @mock.patch('lib.swift_utils.peer_units')
+    @mock.patch('lib.swift_utils.config')
+    @mock.patch('lib.swift_utils.is_elected_leader')
+    def test_cluster_sync_rings(self, mock_is_elected_leader, mock_config,
+                                mock_peer_units,
+                                mock_broadcast_rings_available,
+                                mock_relation_ids, mock_relation_set):
+        mock_is_elected_leader.return_value = True
+        mock_peer_units.return_value = ['swift-proxy/1']
+        mock_relation_ids.return_value = ['cluster:0']
+        mock_config.side_effect = lambda key: {
+            'ring-sync-mode': 'atomic'}[key]
+        swift_utils.cluster_sync_rings(token='token1')
+        mock_broadcast_rings_available.assert_called_once_with(
+            broker_token='token1', storage=True)
+        mock_relation_set.assert_not_called()
+
+        mock_broadcast_rings_available.reset_mock()
+        mock_config.side_effect = lambda key: {
+            'ring-sync-mode': 'stop-proxy'}[key]
+        with mock.patch.object(swift_utils, 'get_hostaddr',
+                               lambda *args: '1.2.3.4'):
+            swift_utils.cluster_sync_rings(token='token1')
+        mock_broadcast_rings_available.assert_not_called()
+        rq = mock_relation_set.call_args[1]['relation_settings']
+        self.assertEqual(rq['stop-proxy-service'], 'token1')
+
+    @mock.patch('lib.swift_utils.config')
+    def test_ring_sync_batch_size(self, mock_config):
+        for value, peers, size in [('1', 5, 1), ('2', 5, 2), ('9', 5, 5),
+                                   ('40%', 5, 2), ('10%', 5, 1),
+                                   ('100%', 5, 5), (None, 3, 1)]:
+            mock_config.return_value = value
+            self.assertEqual(swift_utils.ring_sync_batch_size(peers), size)
+
+        mock_config.return_value = 'half'
+        with self.assertRaises(swift_utils.SwiftProxyCharmException):
+            swift_utils.ring_sync_batch_size(4)
+
+    @mock.patch('lib.swift_utils.log')
+    @mock.patch('lib.swift_utils.relation_get')
+    @mock.patch('lib.swift_utils.related_units')
+    @mock.patch('lib.swift_utils.relation_set')
+    @mock.patch('lib.swift_utils.relation_ids')
+    @mock.patch('lib.swift_utils.broadcast_rings_available')
+    @mock.patch('lib.swift_utils.peer_units')
+    @mock.patch('lib.swift_utils.kv')
+    @mock.patch('lib.swift_utils.config')
+    @mock.patch('lib.swift_utils.is_elected_leader')
+    def test_rolling_ring_sync(self, mock_is_elected_leader, mock_config,
+                               mock_kv, mock_peer_units,
+                               mock_broadcast_rings_available,
+                               mock_relation_ids, mock_relation_set,
+                               mock_related_units, mock_relation_get,
+                               mock_log):
+        store = {}
+        mock_kv.return_value.get.side_effect = store.get
+        mock_kv.return_value.set.side_effect = store.__setitem__
+        mock_kv.return_value.unset.side_effect = store.pop
+        mock_is_elected_leader.return_value = True
+        mock_config.side_effect = lambda key: {
+            'ring-sync-mode': 'rolling', 'ring-sync-batch-size': '40%'}[key]
+        units = ['swift-proxy/{}'.format(i) for i in (10, 2, 3, 4, 5)]
+        mock_peer_units.return_value = units
+        mock_relation_ids.return_value = ['cluster:0']
+        mock_related_units.return_value = units
+        settings = {u: {} for u in units}
+        mock_relation_get.side_effect = \
+            lambda rid=None, unit=None: settings[unit]
+
+        def stop_units():
+            rq = mock_relation_set.call_args[1]['relation_settings']
+            self.assertEqual(rq['stop-proxy-service'], 'token1')
+            return rq['stop-proxy-units'].split()
+
+        def ack(units, key):
+            for u in units:
+                settings[u][key] = 'token1'
+            self.assertTrue(swift_utils.advance_rolling_ring_sync())
+
+        with mock.patch.object(swift_utils, 'get_hostaddr',
+                               lambda *args: '1.2.3.4'):
+            swift_utils.cluster_sync_rings(token='token1')
+            self.assertEqual(stop_units(), ['swift-proxy/2', 'swift-proxy/3'])
+
+            # nothing moves on until the whole batch has stopped
+            ack(['swift-proxy/2'], 'stop-proxy-service-ack')
+            mock_broadcast_rings_available.assert_not_called()
+            ack(['swift-proxy/3'], 'stop-proxy-service-ack')
+            mock_broadcast_rings_available.assert_called_once_with(
+                broker_token='token1', storage=True,
+                units=['swift-proxy/2', 'swift-proxy/3'])
+
+            # and synced
+            mock_relation_set.reset_mock()
+            ack(['swift-proxy/2', 'swift-proxy/3'], 'ring-sync-ack')
+            self.assertEqual(stop_units(), ['swift-proxy/4', 'swift-proxy/5'])
+            ack(['swift-proxy/4', 'swift-proxy/5'], 'stop-proxy-service-ack')
+            # storage units are only notified once
+            mock_broadcast_rings_available.assert_called_with(
+                broker_token='token1', storage=False,
+                units=['swift-proxy/4', 'swift-proxy/5'])
+
+            # units that leave are not waited for
+            del settings['swift-proxy/5']
+            mock_related_units.return_value = [u for u in units
+                                               if u != 'swift-proxy/5']
+            ack(['swift-proxy/4'], 'ring-sync-ack')
+            self.assertEqual(stop_units(), ['swift-proxy/10'])
+            ack(['swift-proxy/10'], 'stop-proxy-service-ack')
+            ack(['swift-proxy/10'], 'ring-sync-ack')
+            # peers joining later aren't left out
+            mock_broadcast_rings_available.assert_called_with(
+                broker_token='token1', storage=False)
+
+        self.assertIsNone(swift_utils.get_rolling_ring_sync())
+        self.assertFalse(swift_utils.advance_rolling_ring_sync())
+
+    @mock.patch('lib.swift_utils.log')
+    @mock.patch('lib.swift_utils.relation_set')
+    @mock.patch('lib.swift_utils.relation_ids')
+    @mock.patch('lib.swift_utils.config')
+    @mock.patch('lib.swift_utils.is_elected_leader')
+    @mock.patch('lib.swift_utils.kv')
+    @mock.patch('lib.swift_utils.leader_set')
+    @mock.patch('lib.swift_utils.leader_get')
+    def test_ring_generation(self, mock_leader_get, mock_leader_set,
+                             mock_kv, mock_is_elected_leader, mock_config,
+                             mock_relation_ids, mock_relation_set, mock_log):
+        leader = {}
+        mock_leader_get.side_effect = leader.get
+        mock_leader_set.side_effect = leader.update
+        store = {}
+        mock_kv.return_value.get.side_effect = store.get
+        mock_kv.return_value.set.side_effect = store.__setitem__
+        mock_config.side_effect = lambda key: {
+            'ring-sync-mode': 'atomic'}[key]
+        mock_relation_ids.return_value = ['cluster:1']
+        self.assertEqual(swift_utils.get_ring_generation(), 0)
+        self.assertEqual(swift_utils.publish_ring_generation(), 1)
+        self.assertEqual(swift_utils.publish_ring_generation(), 2)
+        self.assertEqual(swift_utils.get_ring_generation(), 2)
+
+        # the leader is never stale
+        mock_is_elected_leader.return_value = True
+        self.assertFalse(swift_utils.request_resync_if_stale())
+
+        mock_is_elected_leader.return_value = False
+        swift_utils.set_synced_ring_generation('2')
+        self.assertEqual(swift_utils.get_synced_ring_generation(), 2)
+        self.assertFalse(swift_utils.request_resync_if_stale())
+        mock_relation_set.assert_not_called()
+
+        swift_utils.publish_ring_generation()
+        self.assertTrue(swift_utils.request_resync_if_stale())
+        rq = mock_relation_set.call_args[1]['relation_settings']
+        self.assertEqual(rq['resync-request'], 'generation-3')
+
+        # only once per generation
+        mock_relation_set.reset_mock()
+        self.assertFalse(swift_utils.request_resync_if_stale())
+        mock_relation_set.assert_not_called()
+
+        # until the leader publishes a new one
+        swift_utils.publish_ring_generation()
+        self.assertTrue(swift_utils.request_resync_if_stale())
+        rq = mock_relation_set.call_args[1]['relation_settings']
+        self.assertEqual(rq['resync-request'], 'generation-4')
+
+        # a resync would get in the way of a stop-proxy handshake
+        mock_relation_set.reset_mock()
+        mock_config.side_effect = lambda key: {
+            'ring-sync-mode': 'stop-proxy'}[key]
+        self.assertFalse(swift_utils.request_resync_if_stale())
+        mock_relation_set.assert_not_called()
+
+    @mock.patch('lib.swift_utils.time.time')
+    @mock.patch('lib.swift_utils.ensure_www_dir_permissions')
+    @mock.patch('lib.swift_utils.get_ring_generation')
+    @mock.patch('lib.swift_utils.get_www_dir')
+    @mock.patch('lib.swift_utils.config')
+    def test_update_www_rings(self, mock_config, mock_get_www_dir,
+                              mock_get_ring_generation,
+                              mock_ensure_www_dir_permissions, mock_time):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        conf_dir = os.path.join(tmpdir, 'swift')
+        www_dir = os.path.join(tmpdir, 'www')
+        os.mkdir(conf_dir)
+        os.mkdir(www_dir)
+        mock_get_www_dir.return_value = www_dir
+        mock_config.side_effect = lambda key: {
+            'published-ring-generations': 2}[key]
+        rings = {r: os.path.join(conf_dir, '{}.builder'.format(r))
+                 for r in ['account', 'container', 'object']}
+
+        def write(name, content):
+            path = os.path.join(conf_dir, name)
+            with open(path + '.tmp', 'w') as fd:
+                fd.write(content)
+            # a new inode each time, as for rings
+            os.rename(path + '.tmp', path)
+
+        def read(name):
+            with open(os.path.join(www_dir, name)) as fd:
+                return fd.read()
+
+        # a www dir published with the old layout
+        with open(os.path.join(www_dir, 'object.ring.gz'), 'w') as fd:
+            fd.write('old')
+
+        with mock.patch.object(swift_utils, 'SWIFT_CONF_DIR', conf_dir), \
+                mock.patch.object(swift_utils, 'SWIFT_RINGS', rings):
+            for generation in (1, 2, 3):
+                mock_time.return_value = float(generation)
+                mock_get_ring_generation.return_value = generation
+                for r in rings:
+                    write('{}.builder'.format(r), 'builder')
+                    write('{}.ring.gz'.format(r), '{} {}'.format(r,
+                                                                 generation))
+
+                if generation == 2:
+                    swift_utils.mark_www_rings_deleted()
+
+                swift_utils.update_www_rings()
+                self.assertEqual(os.readlink(os.path.join(www_dir,
+                                                          'current')),
+                                 'gen-{:.6f}'.format(generation))
+                self.assertEqual(read('object.ring.gz'),
+                                 'object {}'.format(generation))
+
+            manifest = json.loads(read('manifest.json'))
+            self.assertEqual(manifest['path'], 'gen-3.000000')
+            self.assertEqual(manifest['generation'], 3)
+            # rings are hard linked rather than copied, builders copied
+            self.assertEqual(
+                os.stat(os.path.join(www_dir, 'object.ring.gz')).st_ino,
+                os.stat(os.path.join(conf_dir, 'object.ring.gz')).st_ino)
+            self.assertNotEqual(
+                os.stat(os.path.join(www_dir, 'object.builder')).st_ino,
+                os.stat(rings['object']).st_ino)
+            # swift rewrites builders in place, which mustn't change what
+            # was published
+            with open(rings['object'], 'w') as fd:
+                fd.write('rebalanced')
+            self.assertEqual(read('object.builder'), 'builder')
+            self.assertEqual(read('gen-3.000000/object.builder'), 'builder')
+            # older generations stay consistent
+            with open(os.path.join(www_dir, 'gen-2.000000',
+                                   'object.ring.gz')) as fd:
+                self.assertEqual(fd.read(), 'object 2')
+            # builders are published compressed too
+            with gzip.open(os.path.join(www_dir, 'object.builder.gz')) as fd:
+                self.assertEqual(fd.read(), b'builder')
+            self.assertIn('object.builder.gz', manifest['files'])
+            # an unchanged builder is not compressed again
+            self.assertEqual(
+                os.stat(os.path.join(www_dir, 'object.builder.gz')).st_ino,
+                os.stat(os.path.join(www_dir, 'gen-2.000000',
+                                     'object.builder.gz')).st_ino)
+
+        self.assertEqual(sorted(os.listdir(www_dir)), [
+            'account.builder', 'account.builder.gz', 'account.ring.gz',
+            'container.builder', 'container.builder.gz', 'container.ring.gz',
+            'current', 'gen-2.000000', 'gen-3.000000', 'manifest.json',
+            'object.builder', 'object.builder.gz', 'object.ring.gz'])
+
+
+class RingBrokerStub(object):
+    """A local stand-in for the ring broker's apache, serving files from
+    memory over HTTP/1.1, with Range support, and counting connections and
+    requests."""
+
+    def __init__(self, files, delay=0):
+        self.files = files
+        self.delay = delay
+        self.failures = collections.Counter()
+        # responses to cut short or corrupt, by file name
+        self.truncated = collections.Counter()
+        self.corrupted = collections.Counter()
+        self.ranges = []
+        self.connections = 0
+        self.requests = collections.Counter()
+        self.paths = []
+        stub = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def setup(self):
+                super(Handler, self).setup()
+                stub.connections += 1
+
+            def do_GET(self):
+                name = self.path.rsplit('/', 1)[-1]
+                stub.requests[name] += 1
+                stub.paths.append(self.path)
+                time.sleep(stub.delay)
+                if stub.failures[name]:
+                    stub.failures[name] -= 1
+                    self.send_error(503)
+                elif name not in stub.files:
+                    self.send_error(404)
+                else:
+                    body = stub.files[name]
+                    start = 0
+                    if self.headers['Range']:
+                        stub.ranges.append((name, self.headers['Range']))
+                        start = int(self.headers['Range'][6:].rstrip('-'))
+                        self.send_response(206)
+                        self.send_header('Content-Range', 'bytes {}-{}/{}'
+                                         .format(start, len(body) - 1,
+                                                 len(body)))
+                    else:
+                        self.send_response(200)
+                    body = body[start:]
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    if stub.corrupted[name]:
+                        stub.corrupted[name] -= 1
+                        body = bytes(b ^ 0xff for b in body)
+                    if stub.truncated[name]:
+                        stub.truncated[name] -= 1
+                        self.wfile.write(body[:len(body) // 2])
+                        self.close_connection = True
+                        return
+                    self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0),
+                                                      Handler)
+        self.server.daemon_threads = True
+        self.url = 'http://127.0.0.1:{}/swift-rings'.format(
+            self.server.server_address[1])
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       kwargs={'poll_interval': 0.01})
+        self.thread.start()
+
+    def stop(self):
+        if self.thread.is_alive():
+            self.server.shutdown()
+            self.server.server_close()
+            self.thread.join()
+
+
+@mock.patch('lib.swift_utils.log', mock.MagicMock())
+class FetchFilesTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.files = {
+            '{}.{}'.format(s, ext): os.urandom(size)
+            for s in ['account', 'object', 'container']
+            for ext, size in [('ring.gz', 1024), ('builder', 3 * 1024 * 1024)]}
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def broker(self, delay=0):
+        broker = RingBrokerStub(self.files, delay=delay)
+        self.addCleanup(broker.stop)
+        return broker
+
+    def assertFetched(self, names):
+        for name in names:
+            with open(os.path.join(self.tmpdir, name), 'rb') as fd:
+                self.assertEqual(fd.read(), self.files[name])
+
+    def test_fetch_files_concurrent(self):
+        broker = self.broker(delay=0.2)
+        start = time.time()
+        swift_utils.fetch_files(broker.url, sorted(self.files), self.tmpdir,
+                                max_workers=3)
+        elapsed = time.time() - start
+        self.assertFetched(self.files)
+        # six 0.2s requests, three at a time
+        self.assertLess(elapsed, 0.9)
+        self.assertLessEqual(broker.connections, 3)
+
+    def test_fetch_files_keepalive(self):
+        broker = self.broker()
+        swift_utils.fetch_files(broker.url, sorted(self.files), self.tmpdir,
+                                max_workers=1)
+        self.assertFetched(self.files)
+        self.assertEqual(broker.connections, 1)
+        self.assertEqual(sum(broker.requests.values()), len(self.files))
+
+    def test_fetch_files_retry(self):
+        broker = self.broker()
+        broker.failures['object.builder'] = 2
+        swift_utils.fetch_files(broker.url, sorted(self.files), self.tmpdir,
+                                retry_delay=0)
+        self.assertFetched(self.files)
+        # only the file that failed is fetched again
+        self.assertEqual(broker.requests['object.builder'], 3)
+        self.assertEqual(sum(broker.requests.values()), len(self.files) + 2)
+
+        broker.failures['object.builder'] = 3
+        with self.assertRaises(swift_utils.RingFetchError):
+            swift_utils.fetch_files(broker.url, ['object.builder'],
+                                    self.tmpdir, attempts=3, retry_delay=0)
+
+    def test_fetch_files_not_found(self):
+        broker = self.broker()
+        names = sorted(self.files) + ['missing.ring.gz']
+        with self.assertRaises(swift_utils.RingFetchError) as ctx:
+            swift_utils.fetch_files(broker.url, names, self.tmpdir,
+                                    retry_delay=0)
+        self.assertIn('missing.ring.gz', str(ctx.exception))
+        self.assertEqual(broker.requests['missing.ring.gz'], 1)
+        self.assertFetched(self.files)
+
+    def test_fetch_files_resume(self):
+        broker = self.broker()
+        broker.truncated['object.builder'] = 2
+        swift_utils.fetch_files(broker.url, sorted(self.files), self.tmpdir,
+                                retry_delay=0)
+        self.assertFetched(self.files)
+        # each retry only asks for what is still missing
+        size = len(self.files['object.builder'])
+        self.assertEqual(broker.ranges, [
+            ('object.builder', 'bytes={}-'.format(size // 2)),
+            ('object.builder', 'bytes={}-'.format(size // 2 + size // 4))])
+        self.assertEqual(broker.requests['object.builder'], 3)
+
+    def test_fetch_files_checksums(self):
+        broker = self.broker()
+        checksums = {name: hashlib.sha256(content).hexdigest()
+                     for name, content in self.files.items()}
+        broker.corrupted['object.builder'] = 1
+        swift_utils.fetch_files(broker.url, sorted(self.files), self.tmpdir,
+                                retry_delay=0, checksums=checksums)
+        self.assertFetched(self.files)
+        # the file that didn't match is fetched again, in full
+        self.assertEqual(broker.requests['object.builder'], 2)
+        self.assertEqual(sum(broker.requests.values()), len(self.files) + 1)
+        self.assertEqual(broker.ranges, [])
+
+        broker.corrupted['object.builder'] = 2
+        with self.assertRaises(swift_utils.RingFetchError) as ctx:
+            swift_utils.fetch_files(broker.url, ['object.builder'],
+                                    self.tmpdir, attempts=2, retry_delay=0,
+                                    checksums=checksums)
+        self.assertIn('checksum mismatch', str(ctx.exception))
+
+    def test_fetch_files_connection_refused(self):
+        broker = self.broker()
+        url = broker.url
+        broker.stop()
+        with self.assertRaises(swift_utils.RingFetchError):
+            swift_utils.fetch_files(url, ['object.ring.gz'], self.tmpdir,
+                                    attempts=2, retry_delay=0)
+
+    def publish(self, broker, generation=1, previous=None, location=None):
+        """Publish a manifest of the broker's files, as update_www_rings()
+        does."""
+        www_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, www_dir)
+        for name, content in self.files.items():
+            with open(os.path.join(www_dir, name), 'wb') as fd:
+                fd.write(content)
+
+        with mock.patch.object(swift_utils, 'get_ring_generation',
+                               lambda: generation):
+            swift_utils.write_ring_manifest(www_dir, previous,
+                                            location=location)
+
+        path = os.path.join(www_dir, swift_utils.RING_MANIFEST)
+        with open(path, 'rb') as fd:
+            self.files[swift_utils.RING_MANIFEST] = fd.read()
+
+        return path
+
+    def test_write_ring_manifest(self):
+        previous = self.publish(None, generation=3)
+        with open(previous) as fd:
+            manifest = json.load(fd)
+        self.assertEqual(manifest['generation'], 3)
+        self.assertEqual(manifest['files']['object.ring.gz'], {
+            'sha256': hashlib.sha256(
+                self.files['object.ring.gz']).hexdigest(),
+            'size': 1024,
+            'generation': 3})
+
+        # unchanged files keep the generation they last changed in
+        self.files['object.ring.gz'] = b'new ring'
+        del self.files[swift_utils.RING_MANIFEST]
+        path = self.publish(None, generation=4, previous=previous)
+        with open(path) as fd:
+            manifest = json.load(fd)
+        self.assertEqual(manifest['generation'], 4)
+        self.assertEqual(manifest['files']['object.ring.gz']['generation'], 4)
+        self.assertEqual(manifest['files']['object.builder']['generation'], 3)
+        self.assertEqual(len(manifest['files']), 6)
+
     def test_fetch_swift_rings_and_builders(self):
         """
         Based on the 'test_fetch_swift_rings' function from the swift-storage
         charm.
         """
-        url = 'http://someproxynode/rings'
-        _SWIFT_CONF_DIR = copy.deepcopy(swift_utils.SWIFT_CONF_DIR)
-        swift_utils.SWIFT_CONF_DIR = tempfile.mkdtemp()
-        try:
-            swift_utils.fetch_swift_rings_and_builders(url)
-            wgets = []
-            for s in ['account', 'object', 'container']:
-                for ext in ['ring.gz', 'builder']:
-                    _c = mock.call(['wget', '%s/%s.%s' % (url, s, ext),
-                                    '--retry-connrefused', '-t', '10',
-                                    '-O', swift_utils.SWIFT_CONF_DIR +
-                                    '/%s.%s' % (s, ext)])
-                wgets.append(_c)
-            self.assertEqual(wgets, self.check_call.call_args_list)
-        except Exception:
-            shutil.rmtree(swift_utils.SWIFT_CONF_DIR)
-        swift_utils.SWIFT_CONF_DIR = _SWIFT_CONF_DIR
+        broker = self.broker()
+        self.publish(broker)
+        names = ['{}.{}'.format(s, ext)
+                 for s in ['account', 'object', 'container']
+                 for ext in ['ring.gz', 'builder']]
+        with mock.patch.object(swift_utils, 'SWIFT_CONF_DIR', self.tmpdir):
+            swift_utils.fetch_swift_rings_and_builders(broker.url)
+            self.assertEqual(sorted(os.listdir(self.tmpdir)), sorted(names))
+            self.assertFetched(names)
+
+            # only the files that changed are fetched again, from the
+            # generation the manifest names
+            broker.requests.clear()
+            del broker.paths[:]
+            self.files['object.ring.gz'] = b'new ring'
+            self.publish(broker, location='gen-2.000000')
+            swift_utils.fetch_swift_rings_and_builders(broker.url)
+            self.assertFetched(names)
+            self.assertEqual(broker.requests, {'manifest.json': 1,
+                                               'object.ring.gz': 1})
+            self.assertEqual(broker.paths, [
+                '/swift-rings/manifest.json',
+                '/swift-rings/gen-2.000000/object.ring.gz'])
+
+    def test_fetch_compressed_builders(self):
+        broker = self.broker()
+        for s in ['account', 'object', 'container']:
+            name = '{}.builder'.format(s)
+            self.files['{}.gz'.format(name)] = gzip.compress(self.files[name])
+        self.publish(broker)
+        names = ['{}.{}'.format(s, ext)
+                 for s in ['account', 'object', 'container']
+                 for ext in ['ring.gz', 'builder']]
+        with mock.patch.object(swift_utils, 'SWIFT_CONF_DIR', self.tmpdir):
+            swift_utils.fetch_swift_rings_and_builders(broker.url)
+            self.assertEqual(sorted(os.listdir(self.tmpdir)), sorted(names))
+            # builders are fetched compressed and decompressed on the way
+            self.assertFetched(names)
+            self.assertEqual(broker.requests['object.builder.gz'], 1)
+            self.assertNotIn('object.builder', broker.requests)
+
+        # an interrupted download resumes where the compressed stream stopped
+        broker.requests.clear()
+        broker.truncated['object.builder.gz'] = 1
+        os.unlink(os.path.join(self.tmpdir, 'object.builder'))
+        swift_utils.fetch_files(broker.url, ['object.builder'], self.tmpdir,
+                                retry_delay=0, compressed=['object.builder'])
+        self.assertFetched(['object.builder'])
+        self.assertEqual(broker.ranges, [
+            ('object.builder.gz', 'bytes={}-'.format(
+                len(self.files['object.builder.gz']) // 2))])
+
+        # a corrupt download is retried like any other failure
+        broker.requests.clear()
+        self.files['object.builder.gz'] = b'not gzip'
+        with self.assertRaises(swift_utils.RingFetchError):
+            swift_utils.fetch_files(broker.url, ['object.builder'],
+                                    self.tmpdir, attempts=2, retry_delay=0,
+                                    compressed=['object.builder'])
+        self.assertEqual(broker.requests['object.builder.gz'], 2)
+
+    def test_fetch_changed_ring_files(self):
+        broker = self.broker()
+        names = sorted(self.files)
+        staging = tempfile.mkdtemp(dir=self.tmpdir)
+        with mock.patch.object(swift_utils, 'SWIFT_CONF_DIR', self.tmpdir):
+            # no manifest, so everything is fetched
+            self.assertEqual(swift_utils.fetch_changed_ring_files(
+                broker.url, names, staging), names)
+
+            with open(os.path.join(self.tmpdir, 'object.builder'), 'wb') as fd:
+                fd.write(self.files['object.builder'])
+
+            # checksums given by the caller are used over the manifest
+            checksums = {name: hashlib.sha256(content).hexdigest()
+                         for name, content in self.files.items()}
+            self.assertEqual(swift_utils.fetch_changed_ring_files(
+                broker.url, names, staging, checksums=checksums),
+                [n for n in names if n != 'object.builder'])
+
+            # and what is fetched is verified against them
+            checksums['object.ring.gz'] = 'stale'
+            broker.requests.clear()
+            with mock.patch.object(swift_utils.time, 'sleep'), \
+                    self.assertRaises(swift_utils.RingFetchError) as ctx:
+                swift_utils.fetch_changed_ring_files(
+                    broker.url, names, staging, checksums=checksums)
+            self.assertIn('object.ring.gz (checksum mismatch)',
+                          str(ctx.exception))
+            # only the file that didn't match was fetched again
+            self.assertEqual(broker.requests['object.ring.gz'],
+                             swift_utils.FETCH_ATTEMPTS)
+            self.assertEqual(broker.requests['account.ring.gz'], 1)